@@ -0,0 +1,395 @@
+import json
+import os
+import platform
+import resource
+import socket
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from typing import Dict, List, Optional
+
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+# Benchmark corpora: folder, size of the fixed subset taken from it (None
+# keeps every file) and include globs for files without a source extension
+CORPORA = {
+    "examples": ("examples", None, None),
+    "files": ("files", None, ["*.alg"]),
+    "openssl": ("openssl-master/crypto", 200, None),
+    "cryptography": ("cryptography-main/src", 200, None),
+}
+
+# Relative change of a metric beyond which compare flags a regression
+REGRESSION_THRESHOLD = 0.10
+# Latencies below this are too noisy to compare (milliseconds)
+MIN_COMPARED_LATENCY_MS = 1.0
+
+# Stages of run.scan_items, in order, and whether they take batches
+STAGES = [
+    ("read", False),
+    ("signatures", False),
+    ("prefilter", False),
+    ("neardup", False),
+    ("segment", False),
+    ("embed", True),
+    ("query", True),
+    ("llm", False),
+]
+
+
+def percentile(values: List[float], q: float) -> float:
+    # Nearest-rank percentile, q from 0 to 100
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(1, -(-len(ordered) * q // 100))
+    return ordered[int(rank) - 1]
+
+
+def latency_summary(durations: List[float], items: int, size: Optional[int] = None) -> dict:
+    # Latencies are per call, which is a batch of files for embed and query
+    total = sum(durations)
+    summary = {
+        "calls": len(durations),
+        "items": items,
+        "total_s": total,
+        "items_per_s": items / total if total else 0.0,
+        "p50_ms": percentile(durations, 50) * 1000,
+        "p95_ms": percentile(durations, 95) * 1000,
+        "p99_ms": percentile(durations, 99) * 1000,
+    }
+    if size is not None:
+        summary["mb_per_s"] = size / total / 1e6 if total else 0.0
+    return summary
+
+
+def corpus_files(folder: str, limit: Optional[int], include: Optional[List[str]] = None) -> List[str]:
+    # Evenly spaced over the sorted candidates, so the subset only changes
+    # when the corpus does
+    from discovery import discover_files
+    paths = sorted(discover_files(os.path.join(ROOT, folder), include=include))
+    if limit is None or len(paths) <= limit:
+        return paths
+    return [paths[i * len(paths) // limit] for i in range(limit)]
+
+
+def peak_rss_mb() -> float:
+    # Peak resident set of this process and of its finished children (the
+    # segmentation workers). ru_maxrss is in kilobytes on Linux.
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    scale = 1 / 1024 / 1024 if sys.platform == "darwin" else 1 / 1024
+    return max(own, children) * scale
+
+
+class StageTimer:
+    # Pipeline observer collecting the duration of every stage call
+    def __init__(self):
+        self.durations: Dict[str, List[float]] = {}
+        self.items = Counter()
+        self._lock = threading.Lock()
+
+    def __call__(self, stage: str, items: int, seconds: float):
+        with self._lock:
+            self.durations.setdefault(stage, []).append(seconds)
+            self.items[stage] += items
+
+
+class CallCounter:
+    # Embedding and LLM requests, read from the stand-in server when there
+    # is one; against a real server only the LLM client can tell
+    def __init__(self, fake=None):
+        self.fake = fake
+
+    def snapshot(self) -> Counter:
+        from llm_client import shared_client
+        client = shared_client()
+        # Tokens as received by the client: the server may still send a few
+        # after a stream is cut short
+        counts = Counter({"llm_requests": client.requests, "generated_tokens": client.generated_tokens})
+        if self.fake is not None:
+            stats = self.fake.snapshot()
+            counts["embedding_calls"] = stats.get("/api/embed", 0) + stats.get("/api/embeddings", 0)
+            counts["llm_calls"] = stats.get("/api/generate", 0) + stats.get("/api/chat", 0)
+        return counts
+
+    def since(self, before: Counter) -> dict:
+        after = self.snapshot()
+        return {name: after[name] - before.get(name, 0) for name in after}
+
+
+def fresh_neardup_store():
+    # Every run starts from an empty near-duplicate store: the verdicts the
+    # previous run remembered would otherwise answer its files
+    import run
+    from neardup import NearDupIndex
+    if run.neardup_index is not None:
+        path = os.path.join(tempfile.mkdtemp(prefix="tfm-benchmark-"), "neardup.sqlite")
+        run.neardup_index = NearDupIndex(path, run.neardup_index.version)
+
+
+def run_pipeline(paths: List[str], sizes: Dict[str, int], calls: CallCounter) -> dict:
+    from run import scan_items
+    fresh_neardup_store()
+    timer = StageTimer()
+    decided_by = Counter()
+    errors = 0
+    before = calls.snapshot()
+    start = time.perf_counter()
+    for item in scan_items(ROOT, observer=timer, paths=paths):
+        if item.error is not None:
+            errors += 1
+        else:
+            decided_by[item.stage] += 1
+    elapsed = time.perf_counter() - start
+    size = sum(sizes.values())
+    return {
+        "wall_s": elapsed,
+        "files_per_s": len(paths) / elapsed if elapsed else 0.0,
+        "mb_per_s": size / elapsed / 1e6 if elapsed else 0.0,
+        "errors": errors,
+        "decided_by": dict(decided_by),
+        "calls": calls.since(before),
+        "stages": {
+            stage: latency_summary(timer.durations[stage], timer.items[stage])
+            for stage, _ in STAGES if stage in timer.durations
+        },
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def run_isolated(paths: List[str], sizes: Dict[str, int], calls: CallCounter) -> dict:
+    # Every stage over every file, one stage at a time and in a single
+    # thread, whatever the previous stages decided
+    from config import CLASSIFY_BATCH_SIZE
+    from pipeline import ScanItem
+    from run import (
+        adjudicate_item,
+        embed_items,
+        neardup_item,
+        prefilter_item,
+        query_items,
+        read_item,
+        segment_item,
+        signature_item,
+    )
+    fresh_neardup_store()
+    functions = {
+        "read": read_item,
+        "signatures": signature_item,
+        "prefilter": prefilter_item,
+        "neardup": neardup_item,
+        "segment": segment_item,
+        "embed": embed_items,
+        "query": query_items,
+        "llm": adjudicate_item,
+    }
+    items = [ScanItem(index=index, path=path) for index, path in enumerate(paths)]
+    results = {}
+    for stage, batched in STAGES:
+        # A file that failed an earlier stage has nothing to work on
+        ready = [item for item in items if item.error is None]
+        groups = [ready[i:i + CLASSIFY_BATCH_SIZE] for i in range(0, len(ready), CLASSIFY_BATCH_SIZE)] if batched else [[item] for item in ready]
+        durations = []
+        before = calls.snapshot()
+        for group in groups:
+            start = time.perf_counter()
+            try:
+                functions[stage](group if batched else group[0])
+            except Exception as e:
+                for item in group:
+                    item.error = f"{stage}: {e!r}"
+            durations.append(time.perf_counter() - start)
+        results[stage] = latency_summary(durations, len(ready), sum(sizes[item.path] for item in ready))
+        results[stage]["errors"] = sum(item.error is not None and item.error.startswith(stage) for item in ready)
+        results[stage]["calls"] = calls.since(before)
+    return {"stages": results, "peak_rss_mb": peak_rss_mb()}
+
+
+def seed_references():
+    # The kNN stage needs reference vectors; an empty collection is filled
+    # with examples/ so that the benchmark runs the same way everywhere
+    from ingest import ingest, labeled_tree
+    from vecstore import collection
+    if collection.count() > 0:
+        return
+    print("Reference collection is empty, seeding it with examples/", file=sys.stderr)
+    ingest(labeled_tree("examples"), progress=False)
+
+
+def compare(baseline: dict, current: dict, threshold: float = REGRESSION_THRESHOLD) -> List[str]:
+    # Throughputs that dropped and latencies, call counts or memory that grew
+    # by more than threshold
+    regressions = []
+
+    def check(name: str, old: Optional[float], new: Optional[float], higher_is_better: bool, floor: float = 0.0):
+        if old is None or new is None or max(old, new) < floor or old == 0:
+            return
+        change = (new - old) / old
+        if (-change if higher_is_better else change) > threshold:
+            regressions.append(f"{name}: {old:.4g} -> {new:.4g} ({change:+.1%})")
+
+    for corpus, new in current.get("corpora", {}).items():
+        old = baseline.get("corpora", {}).get(corpus)
+        if old is None:
+            continue
+        for mode in ("pipeline", "isolated"):
+            if mode not in old or mode not in new:
+                continue
+            if mode == "pipeline":
+                for metric in ("files_per_s", "mb_per_s"):
+                    check(f"{corpus} {mode} {metric}", old[mode][metric], new[mode][metric], True)
+                for metric, value in new[mode]["calls"].items():
+                    check(f"{corpus} {mode} {metric}", old[mode]["calls"].get(metric), value, False, floor=1)
+            check(f"{corpus} {mode} peak_rss_mb", old[mode]["peak_rss_mb"], new[mode]["peak_rss_mb"], False)
+            for stage, stats in new[mode]["stages"].items():
+                old_stats = old[mode]["stages"].get(stage)
+                if old_stats is None:
+                    continue
+                for metric in ("p50_ms", "p95_ms", "p99_ms"):
+                    check(
+                        f"{corpus} {mode} {stage} {metric}",
+                        old_stats[metric],
+                        stats[metric],
+                        False,
+                        floor=MIN_COMPARED_LATENCY_MS
+                    )
+    return regressions
+
+
+def print_report(results: dict):
+    for corpus, result in results["corpora"].items():
+        print(f"{corpus}: {result['files']} files, {result['bytes'] / 1e6:.2f} MB")
+        pipeline = result.get("pipeline")
+        if pipeline is not None:
+            print(
+                f"  pipeline: {pipeline['files_per_s']:.2f} files/s, {pipeline['mb_per_s']:.3f} MB/s, "
+                f"{pipeline['errors']} errors, calls {pipeline['calls']}, peak RSS {pipeline['peak_rss_mb']:.0f} MB"
+            )
+            for stage, stats in pipeline["stages"].items():
+                print(
+                    f"    {stage:<10} {stats['calls']:>6} calls  p50 {stats['p50_ms']:9.2f} ms  "
+                    f"p95 {stats['p95_ms']:9.2f} ms  p99 {stats['p99_ms']:9.2f} ms"
+                )
+        isolated = result.get("isolated")
+        if isolated is not None:
+            print(f"  isolated stages: peak RSS {isolated['peak_rss_mb']:.0f} MB")
+            for stage, stats in isolated["stages"].items():
+                print(
+                    f"    {stage:<10} {stats['items_per_s']:9.1f} files/s {stats['mb_per_s']:8.3f} MB/s  "
+                    f"p50 {stats['p50_ms']:9.2f} ms  p95 {stats['p95_ms']:9.2f} ms  p99 {stats['p99_ms']:9.2f} ms  "
+                    f"calls {stats['calls']}"
+                )
+
+
+if __name__ == '__main__':
+    # python benchmark.py [--corpus openssl ...] [--output run.json]
+    # [--compare baseline.json [current.json]]: times the scan against the
+    # stand-in server (fake_ollama.py) unless --host points at a real one.
+    # The LLM and embedding caches are disabled so that every run does the
+    # same work.
+    import argparse
+    parser = argparse.ArgumentParser(description="Throughput and latency of the scan pipeline and of each stage")
+    parser.add_argument("--corpus", action="append", choices=sorted(CORPORA), help="default: all of them")
+    parser.add_argument("--subset-size", type=int, help="files taken from the vendored corpora")
+    parser.add_argument("--no-isolated", action="store_true", help="only time the whole pipeline")
+    parser.add_argument("--output", help="write the results as JSON")
+    parser.add_argument("--compare", nargs="+", metavar="RESULTS", help="baseline results, and optionally results to compare instead of running")
+    parser.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD, help="relative change flagged as a regression")
+    parser.add_argument("--host", help="model server to use instead of the stand-in")
+    parser.add_argument("--latency", type=float, default=0.05, help="stand-in seconds per request")
+    parser.add_argument("--token-latency", type=float, default=0.002, help="stand-in seconds per generated token")
+    parser.add_argument("--jitter", type=float, default=0.2)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--max-concurrency", type=int, default=0)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if args.compare and len(args.compare) > 1:
+        with open(args.compare[0]) as f:
+            baseline = json.load(f)
+        with open(args.compare[1]) as f:
+            current = json.load(f)
+        regressions = compare(baseline, current, args.threshold)
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        raise SystemExit(1 if regressions else 0)
+
+    # config reads the environment on import, so the server address and the
+    # disabled caches have to be set before any module of the scanner loads
+    host = args.host
+    port = None
+    if host is None:
+        with socket.socket() as s:
+            s.bind(("127.0.0.1", 0))
+            port = s.getsockname()[1]
+        host = f"http://127.0.0.1:{port}"
+    os.environ["TFM_OLLAMA_HOST"] = host
+    os.environ["TFM_LLM_CACHE_PATH"] = ""
+    os.environ["TFM_EMBEDDING_CACHE_DIR"] = ""
+    # Near-duplicates are found within a run, as on a first scan, but not
+    # across runs (see fresh_neardup_store) nor in the store of real scans
+    os.environ["TFM_NEARDUP_PATH"] = os.path.join(tempfile.mkdtemp(prefix="tfm-benchmark-"), "neardup.sqlite")
+
+    fake = None
+    behavior = None
+    if port is not None:
+        from dataclasses import asdict
+        from fake_ollama import Behavior, FakeOllama
+        behavior = Behavior(
+            latency=args.latency,
+            token_latency=args.token_latency,
+            jitter=args.jitter,
+            error_rate=args.error_rate,
+            max_concurrency=args.max_concurrency,
+            seed=args.seed
+        )
+        fake = FakeOllama(behavior, port=port).start()
+        behavior = asdict(behavior)
+    from config import EMBEDDING_BACKEND
+    seed_references()
+    calls = CallCounter(fake)
+
+    results = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "embedding_backend": EMBEDDING_BACKEND,
+            "server": "fake_ollama" if fake is not None else host,
+            "behavior": behavior,
+        },
+        "corpora": {},
+    }
+    try:
+        for name in args.corpus or list(CORPORA):
+            folder, limit, include = CORPORA[name]
+            if not os.path.isdir(os.path.join(ROOT, folder)):
+                print(f"Skipping {name}: {folder} does not exist", file=sys.stderr)
+                continue
+            paths = corpus_files(folder, args.subset_size if args.subset_size and limit else limit, include)
+            sizes = {path: os.path.getsize(path) for path in paths}
+            result = {"folder": folder, "files": len(paths), "bytes": sum(sizes.values())}
+            result["pipeline"] = run_pipeline(paths, sizes, calls)
+            if not args.no_isolated:
+                result["isolated"] = run_isolated(paths, sizes, calls)
+            results["corpora"][name] = result
+    finally:
+        if fake is not None:
+            fake.stop()
+
+    print_report(results)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=4)
+    if args.compare:
+        with open(args.compare[0]) as f:
+            baseline = json.load(f)
+        regressions = compare(baseline, results, args.threshold)
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        raise SystemExit(1 if regressions else 0)
@@ -0,0 +1,248 @@
+import math
+import re
+import threading
+import time
+from dataclasses import dataclass, field
+from functools import partial
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+from ollama import Options
+from config import LLM_CASCADE, LLM_NUM_PREDICT, LLM_STREAM
+from llm_cache import CachedAnswer, LLMCache
+from llm_client import shared_client
+from prompts import Excerpt
+from vecstore import Category, content_hash
+
+
+CASCADE_PROMPT_VERSION = "cascade-json-2"
+
+# Answers are a few tokens of JSON: generation stops at the closing brace,
+# and at num_predict tokens for models that ramble
+options = Options(temperature=0.0, num_predict=LLM_NUM_PREDICT, stop=["}"])
+
+# Names the models use for the categories, upper-cased, to Category values
+CATEGORY_ALIASES = {category.value.upper(): category.value for category in Category}
+CATEGORY_ALIASES.update({category.name: category.value for category in Category})
+CATEGORY_ALIASES.update({
+    "NO_CRYPTO": Category.NOCRYPTO.value,
+    "ELLIPTIC_CURVES": Category.ELIPTIC_CURVE.value,
+    "ELIPTIC_CURVES": Category.ELIPTIC_CURVE.value,
+    "CHACHA20": Category.CHACHA20.value,
+    "BCRYPT": Category.PASSWORD_BCRYPT.value,
+    "PBKDF2": Category.PASSWORD_PBKDF2_SHA256.value,
+})
+SHA_REGEX = re.compile(r"SHA-?(?:1|224|256|384|512|3)\b")
+
+# Category names as the prompts list them; answers have to be one of these
+PROMPT_CATEGORIES = (
+    "USES_AES", "PASSWORD_PBKDF2_SHA256", "PASSWORD_BCRYPT", "RSA", "DiffieHellman", "DSA", "ElipticCurves",
+    "ED448", "ED25519", "AES", "CAMELLIA", "CHACHA20", "DES", "HMAC", "MD5", "SHA", "NO_CRYPTO",
+)
+
+# Fields of a JSON answer, also when it was cut short by the stop sequence or
+# an early abort
+CATEGORY_FIELD_REGEX = re.compile(r'"category"\s*:\s*"([^"]*)"')
+CONFIDENCE_FIELD_REGEX = re.compile(r'"confidence"\s*:\s*"?([0-9]*\.?[0-9]+(?:[eE][-+]?[0-9]+)?)')
+# Characters after which a streamed number is complete; "0" of "0.85" is not
+NUMBER_ENDS = frozenset(',}" \t\r\n')
+
+# Any category name in a free text answer
+ANSWER_NAMES = CATEGORY_ALIASES.keys() | set(CATEGORY_ALIASES.values()) | {"bcrypt"}
+ANSWER_REGEX = re.compile(
+    r"(?<![A-Za-z0-9_])(SHA-?(?:1|224|256|384|512|3)|"
+    + "|".join(re.escape(name) for name in sorted(ANSWER_NAMES, key=len, reverse=True))
+    + r")(?![A-Za-z0-9_])"
+)
+
+
+def normalize_category(answer: str) -> Optional[str]:
+    name = answer.strip().upper().replace(" ", "_")
+    if name in CATEGORY_ALIASES:
+        return CATEGORY_ALIASES[name]
+    if SHA_REGEX.fullmatch(answer.strip().upper()):
+        return Category.SHA.value
+    return None
+
+
+def find_category(text: str) -> Optional[str]:
+    # First category named in a free text answer
+    match = ANSWER_REGEX.search(text)
+    return normalize_category(match.group(1)) if match is not None else None
+
+
+def answer_ready(text: str, need_confidence: bool = True) -> bool:
+    # Whether a streamed JSON answer already says all that is needed: its
+    # category and, when asked for, a confidence that is not cut mid-number.
+    # An unknown category also ends it, the rest would not make it usable.
+    match = CATEGORY_FIELD_REGEX.search(text)
+    if match is None:
+        return False
+    if normalize_category(match.group(1)) is None or not need_confidence:
+        return True
+    confidence = CONFIDENCE_FIELD_REGEX.search(text)
+    return confidence is not None and text[confidence.end():confidence.end() + 1] in NUMBER_ENDS
+
+
+def build_prompt(code: str, categories: Sequence[str]) -> str:
+    return f"""
+    You are a machine capable of recognizing algorithms or fragments of use of algorithms.
+    Given the following code, identify if it is an implementation of a cryptographic
+    algorithm, the use of a cryptographic algorithm, or it is just a general code.
+    Take into account that a use of cryptographic code can be considered anything
+    that tries to hash a password, digest a message, sign a token, or pretty much
+    anything that would be considered the use of a cryptographic primitive.
+
+    Uses of cryptographic primitives: USES_AES, PASSWORD_PBKDF2_SHA256, PASSWORD_BCRYPT.
+    Implementations: RSA, DiffieHellman, DSA, ElipticCurves, ED448, ED25519, AES,
+    CAMELLIA, CHACHA20, DES, HMAC, MD5, SHA.
+    Code that neither implements nor uses a cryptographic primitive: NO_CRYPTO.
+
+    The code is as follow:
+    {code}
+
+    If useful, a previous model has classified this code as one of these categories:
+    {", ".join(sorted(set(categories)))}
+
+    Answer with a JSON object and nothing else, where category is exactly one of
+    {", ".join(PROMPT_CATEGORIES)}:
+    {{"category": "<category>", "confidence": <number between 0 and 1>}}
+    """
+
+
+def parse_answer(response: str) -> Tuple[Optional[str], float]:
+    # Category and self-reported confidence; (None, 0.0) when unparseable
+    match = CATEGORY_FIELD_REGEX.search(response)
+    category = normalize_category(match.group(1)) if match is not None else None
+    if category is None:
+        return None, 0.0
+    confidence = CONFIDENCE_FIELD_REGEX.search(response)
+    if confidence is None:
+        return category, 0.0
+    return category, min(1.0, max(0.0, float(confidence.group(1))))
+
+
+@dataclass(init=True)
+class Tier:
+    model: str
+    # Answers below this confidence go to the next tier
+    min_confidence: float = 0.0
+    # Share of the calls of this tier allowed to escalate; once reached,
+    # only unparseable answers do
+    max_escalation_rate: float = 1.0
+
+
+@dataclass(init=True)
+class TierAnswer:
+    model: str
+    category: Optional[str]
+    confidence: float
+    latency: float
+    cached: bool
+    # Tokens the model generated for the answer
+    tokens: int = 0
+
+
+@dataclass(init=True)
+class TierStats:
+    calls: int = 0
+    cached: int = 0
+    escalated: int = 0
+    unparseable: int = 0
+    # Escalated answers that the next tier confirmed
+    agreed: int = 0
+    tokens: int = 0
+    latencies: List[float] = field(default_factory=list)
+
+    def summary(self) -> dict:
+        latencies = sorted(self.latencies)
+        answered = self.calls - self.cached
+        return {
+            "calls": self.calls,
+            "cached": self.cached,
+            "escalation_rate": self.escalated / self.calls if self.calls else 0.0,
+            "unparseable": self.unparseable,
+            "agreement": self.agreed / self.escalated if self.escalated else None,
+            "mean_latency": sum(latencies) / answered if answered else 0.0,
+            "mean_tokens": self.tokens / answered if answered else 0.0,
+            "p95_latency": latencies[math.ceil(0.95 * len(latencies)) - 1] if latencies else 0.0,
+        }
+
+
+# Asks the tiers in order, from the smallest model to the largest, and stops
+# at the first answer that is parseable and confident enough. The last tier
+# always answers.
+class Cascade:
+    def __init__(self, tiers: List[Tier], cache: Optional[LLMCache] = None):
+        if not tiers:
+            raise ValueError("A cascade needs at least one tier")
+        self.tiers = tiers
+        self.cache = cache
+        self.stats = {tier.model: TierStats() for tier in tiers}
+        self._lock = threading.Lock()
+
+    def _ask(self, tier: Tier, code: str, categories: Sequence[str], need_confidence: bool) -> TierAnswer:
+        # The last tier always answers, so its confidence is not waited for.
+        # Its cached answers may then lack one, and are not reused by a tier
+        # that needs it.
+        key = None
+        if self.cache is not None:
+            key = self.cache.key(tier.model, options, CASCADE_PROMPT_VERSION, content_hash(code), categories)
+            cached = self.cache.get(key)
+            if cached is not None and (not need_confidence or CONFIDENCE_FIELD_REGEX.search(cached.response)):
+                category, confidence = parse_answer(cached.response)
+                return TierAnswer(tier.model, category, confidence, 0.0, cached=True)
+        request = dict(model=tier.model, prompt=build_prompt(code, categories), format="json", options=options)
+        start = time.perf_counter()
+        if LLM_STREAM:
+            response = shared_client().generate_until(partial(answer_ready, need_confidence=need_confidence), **request)
+        else:
+            response = shared_client().generate(**request)
+        latency = time.perf_counter() - start
+        raw = response.get("response", "")
+        category, confidence = parse_answer(raw)
+        if self.cache is not None and category is not None:
+            self.cache.put(key, CASCADE_PROMPT_VERSION, CachedAnswer(category=category, response=raw))
+        return TierAnswer(tier.model, category, confidence, latency, cached=False, tokens=response.get("eval_count", 0))
+
+    def classify(
+        self,
+        excerpt_for: Callable[[str], Excerpt],
+        categories: Sequence[str]
+    ) -> Tuple[Optional[str], List[TierAnswer]]:
+        # excerpt_for(model) gives the code to show to that model, within
+        # its token budget. Returns the category (None when no tier gave a
+        # parseable answer) and the answers of every tier asked.
+        answers = []
+        for index, tier in enumerate(self.tiers):
+            last = index == len(self.tiers) - 1
+            answer = self._ask(tier, excerpt_for(tier.model).text, categories, need_confidence=not last)
+            stats = self.stats[tier.model]
+            with self._lock:
+                if answers and answers[-1].category is not None and answers[-1].category == answer.category:
+                    self.stats[answers[-1].model].agreed += 1
+                stats.calls += 1
+                stats.cached += answer.cached
+                if not answer.cached:
+                    stats.latencies.append(answer.latency)
+                    stats.tokens += answer.tokens
+                if answer.category is None:
+                    stats.unparseable += 1
+                escalate = not last and (
+                    answer.category is None
+                    or (
+                        answer.confidence < tier.min_confidence
+                        and stats.escalated < tier.max_escalation_rate * stats.calls
+                    )
+                )
+                stats.escalated += escalate
+            answers.append(answer)
+            if not escalate:
+                return answer.category, answers
+        return None, answers
+
+    def summary(self) -> Dict[str, dict]:
+        with self._lock:
+            return {model: stats.summary() for model, stats in self.stats.items()}
+
+
+def tiers_from_config(config: List[dict] = LLM_CASCADE) -> List[Tier]:
+    return [Tier(**tier) for tier in config]
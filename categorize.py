@@ -1,7 +1,19 @@
 from dataclasses import dataclass
 import json
-from typing import List
-from vecstore import collection
+import time
+from typing import Dict, List, Optional
+import numpy as np
+from chunking import Chunk
+from config import PROTOTYPES_PER_CATEGORY
+import metrics
+import prototypes
+from routing import prototype_margin, route
+from segmentation import segment_file
+from vecstore import collection, collection_name, embedding_function, reference_of
+
+
+# Neighbors fetched per chunk for every one kept
+FETCH_FACTOR = 3
 
 
 @dataclass(init=True)
@@ -42,29 +54,231 @@ def classify_doc(doc: Doc) -> str:
     return "NOCRYPTO"
 
 
-def classify_file(file_path: str, print_step = False) -> dict:
-    with open(file_path) as f:
+def aggregate_chunk_results(
+    chunks: List[Chunk],
+    documents: Dict,
+    n_results: int = 4,
+    exclude_sha256: Optional[str] = None
+) -> dict:
+    # A reference file counts with the smallest distance of any of its units
+    # to any chunk, so a crypto routine inside a large file is not drowned
+    # out by the rest of it, and the units of one reference file are a single
+    # neighbor. Each chunk also casts one vote split among its neighbors.
+    # exclude_sha256 drops the references taken from the file itself.
+    best = {}
+    votes = {}
+    chunk_matches = []
+    spans = []
+    for chunk, ids, metadatas, distances in zip(
+        chunks,
+        documents.get("ids"),
+        documents.get("metadatas"),
+        documents.get("distances")
+    ):
+        # The nearest units of every reference file, the one excluded aside;
+        # references that cannot be traced to a file are their own file
+        seen = set()
+        kept = []
+        for _id, metadata, distance in zip(ids, metadatas, distances):
+            reference = reference_of(_id, metadata) or _id
+            if reference in seen or (exclude_sha256 is not None and reference == exclude_sha256):
+                continue
+            seen.add(reference)
+            kept.append((reference, _id, metadata, distance))
+        kept = kept[:n_results]
+        ids = [_id for _, _id, _, _ in kept]
+        metadatas = [metadata for _, _, metadata, _ in kept]
+        distances = [distance for _, _, _, distance in kept]
+        for reference, _id, metadata, distance in kept:
+            if reference not in best or distance < best[reference][2]:
+                best[reference] = (_id, metadata, distance)
+            category = metadata["category"]
+            votes[category] = votes.get(category, 0.0) + 1 / (len(ids) * len(chunks))
+        if ids:
+            match = {
+                "name": chunk.name,
+                "start_line": chunk.start_line,
+                "end_line": chunk.end_line,
+                "category": metadatas[0]["category"],
+                "distance": distances[0]
+            }
+            chunk_matches.append(match)
+            # Line spans of the units whose nearest reference is crypto code
+            if match["category"] != "NOCRYPTO":
+                for first, last in chunk.line_runs or [(chunk.start_line, chunk.end_line)]:
+                    spans.append({**match, "start_line": first, "end_line": last})
+
+    ranked = sorted(best.values(), key=lambda item: item[2])[:n_results]
+    return {
+        "categories": [metadata for _, metadata, _ in ranked],
+        "distances": [distance for _, _, distance in ranked],
+        "ids": [_id for _id, _, _ in ranked],
+        "votes": votes,
+        "chunks": chunk_matches,
+        "spans": spans
+    }
+
+
+def embed_segments(segment_lists: List[List[Chunk]]) -> List[list]:
+    texts = [chunk.text for chunks in segment_lists for chunk in chunks]
+    with metrics.EMBEDDING_SECONDS.time():
+        embeddings = embedding_function(texts)
+    metrics.EMBEDDED_SEGMENTS.inc(len(texts))
+    per_file = []
+    offset = 0
+    for chunks in segment_lists:
+        per_file.append(list(embeddings[offset:offset + len(chunks)]))
+        offset += len(chunks)
+    return per_file
+
+
+def _split_results(documents: dict, offset: int, count: int) -> dict:
+    return {key: documents.get(key)[offset:offset + count] for key in ("ids", "metadatas", "distances")}
+
+
+def _without_own_references(index: prototypes.PrototypeIndex, sha256: str, segments: int) -> prototypes.PrototypeIndex:
+    # The prototypes without the references of a file, found by their ids:
+    # its content hash, with ":<segment>" when it has several segments
+    ids = [sha256] + [f"{sha256}:{i}" for i in range(segments)]
+    entries = collection.get(ids=ids, include=["embeddings", "metadatas"])
+    if not entries["ids"]:
+        return index
+    return index.without(
+        np.asarray(entries["embeddings"], dtype=np.float32),
+        [metadata["category"] for metadata in entries["metadatas"]]
+    )
+
+
+def prototype_answers(
+    segment_lists: List[List[Chunk]],
+    embeddings: List[list],
+    n_results: int = 4,
+    exclude_sha256: Optional[List[str]] = None
+) -> List[Optional[dict]]:
+    # The answer of the category prototypes for every file, with the margin
+    # of its least clear-cut segment, or None without prototypes.
+    # exclude_sha256 gives, per file, a content hash whose references are
+    # taken out of the prototypes first, one file at a time.
+    index = prototypes.for_collection(collection, collection_name()) if PROTOTYPES_PER_CATEGORY > 0 else None
+    if index is None or len(index) == 0:
+        return [None] * len(segment_lists)
+    if exclude_sha256 is None:
+        groups = [(index, list(range(len(segment_lists))))]
+    else:
+        groups = [
+            (_without_own_references(index, sha256, len(chunks)), [position])
+            for position, (sha256, chunks) in enumerate(zip(exclude_sha256, segment_lists))
+        ]
+    responses = [None] * len(segment_lists)
+    for group_index, positions in groups:
+        flat = np.asarray(
+            [embedding for position in positions for embedding in embeddings[position]],
+            dtype=np.float32
+        )
+        if len(flat) == 0 or len(group_index) == 0:
+            continue
+        margins = group_index.margins(flat)
+        documents = group_index.query(flat, n_results=n_results)
+        offset = 0
+        for position in positions:
+            chunks = segment_lists[position]
+            if chunks:
+                response = aggregate_chunk_results(chunks, _split_results(documents, offset, len(chunks)), n_results=n_results)
+                response["prototypes"] = True
+                response["margin"] = float(margins[offset:offset + len(chunks)].min())
+                responses[position] = response
+            offset += len(chunks)
+    return responses
+
+
+def query_prototypes(
+    segment_lists: List[List[Chunk]],
+    embeddings: List[list],
+    n_results: int = 4,
+    margin: Optional[float] = None,
+    exclude_sha256: Optional[List[str]] = None
+) -> List[Optional[dict]]:
+    # Classifies against the category prototypes the files whose segments
+    # all have a nearest category ahead of the others by margin (by default
+    # the calibrated one, see routing.prototype_margin), and whose
+    # answer routing keeps without the LLM. The rest get None and go through
+    # the whole collection: a prototype answer is never unanimous, so until
+    # its "prototypes:<category>" threshold is calibrated every file does.
+    margin = prototype_margin() if margin is None else margin
+    start = time.perf_counter()
+    responses = [
+        response if response is not None and response["margin"] >= margin and not route(response).escalate else None
+        for response in prototype_answers(segment_lists, embeddings, n_results=n_results, exclude_sha256=exclude_sha256)
+    ]
+    metrics.PROTOTYPE_QUERY_SECONDS.observe(time.perf_counter() - start)
+    hits = sum(response is not None for response in responses)
+    metrics.PROTOTYPE_FILES.labels("hit").inc(hits)
+    metrics.PROTOTYPE_FILES.labels("fallback").inc(len(responses) - hits)
+    return responses
+
+
+def query_segments(
+    segment_lists: List[List[Chunk]],
+    n_results: int = 4,
+    embeddings: Optional[List[list]] = None,
+    exclude_sha256: Optional[List[str]] = None,
+    use_prototypes: bool = True
+) -> List[dict]:
+    # The segments of many files are embedded and queried in a single request
+    # and the neighbors are split back per file afterwards. exclude_sha256
+    # gives, per file, a content hash whose references are left out, of the
+    # prototypes as well as of the collection, which is how files that are
+    # also in the collection are evaluated.
+    responses = [None] * len(segment_lists)
+    if use_prototypes and PROTOTYPES_PER_CATEGORY > 0:
+        if embeddings is None:
+            embeddings = embed_segments(segment_lists)
+        responses = query_prototypes(segment_lists, embeddings, n_results=n_results, exclude_sha256=exclude_sha256)
+    remaining = [index for index, response in enumerate(responses) if response is None]
+    if not remaining:
+        return responses
+
+    # More neighbors than kept: units of the same reference file count once,
+    # and the references of an excluded file are dropped
+    fetched = FETCH_FACTOR * n_results
+    start = time.perf_counter()
+    if embeddings is None:
+        documents = collection.query(
+            query_texts=[chunk.text for index in remaining for chunk in segment_lists[index]],
+            n_results=fetched
+        )
+    else:
         documents = collection.query(
-            query_texts=[f.read()],
-            n_results=4
+            query_embeddings=[embedding for index in remaining for embedding in embeddings[index]],
+            n_results=fetched
+        )
+    metrics.VECTOR_QUERY_SECONDS.observe(time.perf_counter() - start)
+    offset = 0
+    for index in remaining:
+        chunks = segment_lists[index]
+        responses[index] = aggregate_chunk_results(
+            chunks,
+            _split_results(documents, offset, len(chunks)),
+            n_results=n_results,
+            exclude_sha256=exclude_sha256[index] if exclude_sha256 is not None else None
+        )
+        offset += len(chunks)
+    return responses
+
+
+def classify_file(file_path: str, print_step = False) -> dict:
+    with metrics.CLASSIFY_FILE_SECONDS.time():
+        with open(file_path) as f:
+            response = query_segments([segment_file(file_path, f.read())], n_results=4)[0]
+    if print_step:
+        json_data = json.dumps(
+            response, 
+            indent=4, 
+            sort_keys=True, 
+            skipkeys=True
         )
-        _id = documents.get("ids")[0]
-        category = documents.get("metadatas")[0]
-        distance = documents.get("distances")[0]
-        response = {
-            "categories": category,
-            "distances": distance,
-            "ids": _id
-        }
-        if print_step:
-            json_data = json.dumps(
-                response, 
-                indent=4, 
-                sort_keys=True, 
-                skipkeys=True
-            )
-            print(json_data)
-        return response
+        print(json_data)
+    return response
 
 
 if __name__ == '__main__':
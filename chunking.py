@@ -0,0 +1,123 @@
+import re
+import sys
+import threading
+from dataclasses import dataclass, field
+from typing import List, Tuple
+from config import CHUNK_ENCODING, CHUNK_MAX_TOKENS, CHUNK_OVERLAP_TOKENS
+
+
+# A word, a number or a run of punctuation with the whitespace before it,
+# about one BPE token each on source code (a little over, which is the safe
+# side for budgets)
+TOKEN_REGEX = re.compile(r"\s*(?:\w+|[^\w\s]+)|\s+")
+
+
+# Stand-in for the tiktoken encoding when it cannot be loaded, e.g. offline
+# with no cached copy of the BPE ranks
+class RegexEncoding:
+    def encode_ordinary(self, text: str) -> List[str]:
+        return TOKEN_REGEX.findall(text)
+
+    def decode(self, tokens: List[str]) -> str:
+        return "".join(tokens)
+
+
+_encoding = None
+_encoding_lock = threading.Lock()
+
+
+def get_encoding():
+    # Loaded on first use: tiktoken downloads the ranks the first time, so
+    # importing this module must not need the network
+    global _encoding
+    if _encoding is None:
+        with _encoding_lock:
+            if _encoding is None:
+                try:
+                    import tiktoken
+                    _encoding = tiktoken.get_encoding(CHUNK_ENCODING)
+                except Exception as e:
+                    print(f"Could not load the {CHUNK_ENCODING} encoding ({e}), counting tokens with a regex", file=sys.stderr)
+                    _encoding = RegexEncoding()
+    return _encoding
+
+
+@dataclass(init=True)
+class Chunk:
+    text: str
+    start_line: int
+    end_line: int
+    tokens: int
+    name: str = ""
+    # (first, last) runs of consecutive lines, only set when the lines of the
+    # chunk are not contiguous in the file, as for the module unit
+    line_runs: List[Tuple[int, int]] = field(default_factory=list)
+
+
+def count_tokens(text: str) -> int:
+    return len(get_encoding().encode_ordinary(text))
+
+
+def split_lines(text: str) -> List[str]:
+    # Only "\n" ends a line, matching the line numbers reported by editors
+    # and tree-sitter (str.splitlines also breaks on form feeds and others).
+    lines = [line + "\n" for line in text.split("\n")]
+    lines[-1] = lines[-1][:-1]
+    if not lines[-1]:
+        lines.pop()
+    return lines
+
+
+def _split_long_line(line: str, max_tokens: int) -> List[str]:
+    encoding = get_encoding()
+    tokens = encoding.encode_ordinary(line)
+    return [encoding.decode(tokens[i:i + max_tokens]) for i in range(0, len(tokens), max_tokens)]
+
+
+def chunk_text(
+    text: str,
+    max_tokens: int = CHUNK_MAX_TOKENS,
+    overlap: int = CHUNK_OVERLAP_TOKENS,
+    first_line: int = 1
+) -> List[Chunk]:
+    # Chunks are made of whole lines so that every chunk maps back to a line
+    # span of the file. Consecutive chunks share up to `overlap` tokens.
+    lines = split_lines(text)
+    if not lines:
+        return [Chunk(text=text, start_line=first_line, end_line=first_line, tokens=0)]
+
+    pieces = []
+    for line_number, (line, size) in enumerate(
+        zip(lines, map(count_tokens, lines)),
+        start=first_line
+    ):
+        if size > max_tokens:
+            for part in _split_long_line(line, max_tokens):
+                pieces.append((line_number, part, count_tokens(part)))
+        else:
+            pieces.append((line_number, line, size))
+
+    chunks = []
+    start = 0
+    while start < len(pieces):
+        end = start
+        size = 0
+        while end < len(pieces) and (end == start or size + pieces[end][2] <= max_tokens):
+            size += pieces[end][2]
+            end += 1
+        chunks.append(Chunk(
+            text="".join(piece[1] for piece in pieces[start:end]),
+            start_line=pieces[start][0],
+            end_line=pieces[end - 1][0],
+            tokens=size
+        ))
+        if end == len(pieces):
+            break
+        # Step back over the trailing pieces that fit in the overlap budget
+        next_start = end
+        shared = 0
+        while next_start - 1 > start and shared + pieces[next_start - 1][2] <= overlap:
+            next_start -= 1
+            shared += pieces[next_start][2]
+        start = next_start
+    return chunks
@@ -0,0 +1,156 @@
+import json
+import os
+
+
+OLLAMA_HOST = os.environ.get("TFM_OLLAMA_HOST", "http://localhost:11434")
+
+# "ollama" embeds through the model server, "hashing" computes hashed n-gram
+# TF-IDF vectors in-process and needs no server at all.
+EMBEDDING_BACKEND = os.environ.get("TFM_EMBEDDING_BACKEND", "ollama")
+
+EMBEDDING_MODEL = os.environ.get("TFM_EMBEDDING_MODEL", "nomic-embed-text")
+# Documents sent per /api/embed request. A batch size of 1 falls back to the
+# per-document /api/embeddings endpoint, which is what older collections were
+# built with (it does not normalize the vectors).
+EMBEDDING_BATCH_SIZE = int(os.environ.get("TFM_EMBEDDING_BATCH_SIZE", "32"))
+# Embedding requests kept in flight at the same time.
+EMBEDDING_CONCURRENCY = int(os.environ.get("TFM_EMBEDDING_CONCURRENCY", "4"))
+
+# Directory of the persistent embedding cache; set it to an empty string to
+# disable the cache.
+EMBEDDING_CACHE_DIR = os.environ.get("TFM_EMBEDDING_CACHE_DIR", "embedding_cache")
+EMBEDDING_CACHE_MAX_ENTRIES = int(os.environ.get("TFM_EMBEDDING_CACHE_MAX_ENTRIES", "100000"))
+
+HASHING_DIM = int(os.environ.get("TFM_HASHING_DIM", "1024"))
+HASHING_IDF_PATH = os.environ.get("TFM_HASHING_IDF_PATH", "hashing_idf.npy")
+
+# Files are split into overlapping, token-bounded chunks before they are
+# embedded so that large files are neither truncated nor unbounded in cost.
+CHUNK_ENCODING = os.environ.get("TFM_CHUNK_ENCODING", "cl100k_base")
+CHUNK_MAX_TOKENS = int(os.environ.get("TFM_CHUNK_MAX_TOKENS", "512"))
+CHUNK_OVERLAP_TOKENS = int(os.environ.get("TFM_CHUNK_OVERLAP_TOKENS", "64"))
+
+# Parse trees kept in memory, keyed by content hash
+PARSE_CACHE_SIZE = int(os.environ.get("TFM_PARSE_CACHE_SIZE", "256"))
+
+# Files embedded, and queried against the collection, at once by the embed
+# and query stages of the scan
+CLASSIFY_BATCH_SIZE = int(os.environ.get("TFM_CLASSIFY_BATCH_SIZE", "16"))
+
+# Workers of each stage of the scan pipeline. Reading, embedding, querying
+# and the LLM run in threads, segmentation (tree-sitter) in processes. LLM
+# workers mostly wait on the shared client, which limits the requests that
+# actually reach the server (LLM_MAX_IN_FLIGHT).
+SCAN_READ_WORKERS = int(os.environ.get("TFM_SCAN_READ_WORKERS", "4"))
+SCAN_SEGMENT_WORKERS = int(os.environ.get("TFM_SCAN_SEGMENT_WORKERS", str(min(4, os.cpu_count() or 1))))
+SCAN_EMBED_WORKERS = int(os.environ.get("TFM_SCAN_EMBED_WORKERS", "2"))
+SCAN_QUERY_WORKERS = int(os.environ.get("TFM_SCAN_QUERY_WORKERS", "2"))
+SCAN_LLM_WORKERS = int(os.environ.get("TFM_SCAN_LLM_WORKERS", "8"))
+# Items buffered between two stages
+SCAN_QUEUE_SIZE = int(os.environ.get("TFM_SCAN_QUEUE_SIZE", "64"))
+
+# Files larger than this are not scanned (bytes, 0 disables the limit)
+DISCOVERY_MAX_FILE_SIZE = int(os.environ.get("TFM_DISCOVERY_MAX_FILE_SIZE", str(1024 * 1024)))
+
+# Results of previous scans, used by run.py to only rescan changed files
+SCAN_MANIFEST_PATH = os.environ.get("TFM_SCAN_MANIFEST_PATH", "scan_manifest.sqlite")
+
+# Score a single category needs in the lexical prefilter to be labeled
+# without going through the model stages
+PREFILTER_STRONG_SCORE = float(os.environ.get("TFM_PREFILTER_STRONG_SCORE", "1.0"))
+
+# Confidence the constant signature engine needs to label a file on its own
+SIGNATURE_MIN_CONFIDENCE = float(os.environ.get("TFM_SIGNATURE_MIN_CONFIDENCE", "0.9"))
+
+# Confidence the kNN neighbors need for a file to skip the LLM, per
+# category, as calibrated by `python evaluate.py --calibrate`. Categories
+# that were not calibrated use the default, which only accepts unanimous
+# neighbors.
+ROUTING_THRESHOLDS_PATH = os.environ.get("TFM_ROUTING_THRESHOLDS_PATH", "routing_thresholds.json")
+ROUTING_DEFAULT_THRESHOLD = float(os.environ.get("TFM_ROUTING_DEFAULT_THRESHOLD", "1.0"))
+# Share of the calibration files kept from the LLM that have to be right
+ROUTING_TARGET_PRECISION = float(os.environ.get("TFM_ROUTING_TARGET_PRECISION", "0.95"))
+
+# Answers of the LLM adjudication step, keyed by model, options, prompt
+# version, content hash and neighbor categories (empty disables the cache)
+LLM_CACHE_PATH = os.environ.get("TFM_LLM_CACHE_PATH", "llm_cache.sqlite")
+LLM_CACHE_MAX_ENTRIES = int(os.environ.get("TFM_LLM_CACHE_MAX_ENTRIES", "50000"))
+
+# Prompt tokens the LLM adjudication may use per model. Files that do not fit
+# are cut down to their most relevant regions by prompts.build_excerpt.
+PROMPT_TOKEN_BUDGETS = json.loads(os.environ.get("TFM_PROMPT_TOKEN_BUDGETS", '{"llama3.1": 8192, "codellama:7b": 4096}'))
+PROMPT_DEFAULT_TOKEN_BUDGET = int(os.environ.get("TFM_PROMPT_DEFAULT_TOKEN_BUDGET", "4096"))
+
+# Shared LLM client (llm_client.py): requests sent to the server at once,
+# requests allowed to wait before callers block, pooled connections, and the
+# timeout and retries of every request (seconds)
+LLM_MAX_IN_FLIGHT = int(os.environ.get("TFM_LLM_MAX_IN_FLIGHT", "4"))
+LLM_MAX_PENDING = int(os.environ.get("TFM_LLM_MAX_PENDING", "64"))
+LLM_MAX_CONNECTIONS = int(os.environ.get("TFM_LLM_MAX_CONNECTIONS", "8"))
+LLM_TIMEOUT = float(os.environ.get("TFM_LLM_TIMEOUT", "120"))
+LLM_RETRIES = int(os.environ.get("TFM_LLM_RETRIES", "3"))
+LLM_RETRY_BACKOFF = float(os.environ.get("TFM_LLM_RETRY_BACKOFF", "0.5"))
+
+# Models asked by the LLM adjudication, smallest first. A tier's answer is
+# kept when it is parseable and its confidence reaches min_confidence; at
+# most max_escalation_rate of a tier's calls go on to the next one.
+LLM_CASCADE = json.loads(os.environ.get(
+    "TFM_LLM_CASCADE",
+    '[{"model": "llama3.2:3b", "min_confidence": 0.8, "max_escalation_rate": 1.0}, {"model": "llama3.1"}]'
+))
+
+# Model that decides whether a vulnerability affects an algorithm
+VULN_CHECKER_MODEL = os.environ.get("TFM_VULN_CHECKER_MODEL", "codellama:7b")
+
+# Decoding of the adjudication answers: tokens a model may generate per
+# answer, and whether answers are streamed so that generation stops as soon
+# as the category (and the confidence the cascade asks for) is known
+LLM_NUM_PREDICT = int(os.environ.get("TFM_LLM_NUM_PREDICT", "32"))
+LLM_STREAM = os.environ.get("TFM_LLM_STREAM", "1") == "1"
+
+# Port of the Prometheus metrics endpoint of scans (metrics.py); 0 leaves
+# it off, the summary at the end of a scan is printed either way
+METRICS_PORT = int(os.environ.get("TFM_METRICS_PORT", "0"))
+
+# Where the reference vectors live: "chroma" (chroma.db) or "numpy", the
+# memory-mapped exact kNN index of npindex.py, kept under NPINDEX_DIR in
+# float32 or float16. The numpy backend does not import chromadb at all.
+VECTOR_BACKEND = os.environ.get("TFM_VECTOR_BACKEND", "chroma")
+NPINDEX_DIR = os.environ.get("TFM_NPINDEX_DIR", "npindex")
+NPINDEX_DTYPE = os.environ.get("TFM_NPINDEX_DTYPE", "float32")
+
+# Category prototypes (prototypes.py): up to PROTOTYPES_PER_CATEGORY k-means
+# centroids per category of the reference collection, kept under
+# PROTOTYPES_DIR. Files whose segments all sit closer to one category than
+# to any other, by at least PROTOTYPE_MARGIN of the distance to the runner
+# up, and whose answer clears the "prototypes:<category>" routing threshold
+# that evaluate.py --calibrate sets, are classified against them instead of
+# the whole collection. 0 prototypes per category, or no calibrated
+# thresholds, always queries the collection.
+PROTOTYPES_PER_CATEGORY = int(os.environ.get("TFM_PROTOTYPES_PER_CATEGORY", "4"))
+PROTOTYPES_DIR = os.environ.get("TFM_PROTOTYPES_DIR", "prototypes")
+# Used until evaluate.py --calibrate sets one. On examples/ and files/, no
+# prototype answer above 0.1 got wrong a file that kNN got right.
+PROTOTYPE_MARGIN = float(os.environ.get("TFM_PROTOTYPE_MARGIN", "0.1"))
+PROTOTYPE_KMEANS_ITERATIONS = int(os.environ.get("TFM_PROTOTYPE_KMEANS_ITERATIONS", "20"))
+
+# Reference documents embedded and upserted at once by ingest.py. Large
+# batches matter for the numpy backend, which rewrites its files on every
+# upsert; an interrupted ingest redoes at most one batch.
+INGEST_BATCH_SIZE = int(os.environ.get("TFM_INGEST_BATCH_SIZE", "2048"))
+
+# Quantized search of the numpy backend: "int8" or "binary" codes held in
+# memory pick NPINDEX_RERANK_CANDIDATES rows per query, which are ranked
+# exactly against the float vectors on disk; "none" scans the floats
+NPINDEX_QUANTIZATION = os.environ.get("TFM_NPINDEX_QUANTIZATION", "none")
+NPINDEX_RERANK_CANDIDATES = int(os.environ.get("TFM_NPINDEX_RERANK_CANDIDATES", "64"))
+
+# Near-duplicate reuse (neardup.py): MinHash sketches of NEARDUP_SHINGLE token
+# shingles with NEARDUP_PERMUTATIONS values, in NEARDUP_BANDS LSH bands. A
+# file at least NEARDUP_MIN_SIMILARITY similar to one the model stages
+# classified takes its verdict. Empty path disables it.
+NEARDUP_PATH = os.environ.get("TFM_NEARDUP_PATH", "neardup.sqlite")
+NEARDUP_SHINGLE = int(os.environ.get("TFM_NEARDUP_SHINGLE", "5"))
+NEARDUP_PERMUTATIONS = int(os.environ.get("TFM_NEARDUP_PERMUTATIONS", "128"))
+NEARDUP_BANDS = int(os.environ.get("TFM_NEARDUP_BANDS", "16"))
+NEARDUP_MIN_SIMILARITY = float(os.environ.get("TFM_NEARDUP_MIN_SIMILARITY", "0.8"))
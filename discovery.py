@@ -0,0 +1,243 @@
+import fnmatch
+import os
+import re
+import subprocess
+from collections import Counter
+from typing import Iterable, Iterator, List, Optional, Set, Tuple
+from config import DISCOVERY_MAX_FILE_SIZE
+
+
+LANGUAGE_EXTENSIONS = {
+    "python": (".py",),
+    "javascript": (".js", ".mjs", ".cjs", ".jsx"),
+    "typescript": (".ts", ".tsx"),
+    "go": (".go",),
+    "ruby": (".rb",),
+    "c": (".c", ".h"),
+    "cpp": (".cc", ".cpp", ".cxx", ".hh", ".hpp", ".hxx"),
+    "rust": (".rs",),
+    "java": (".java",),
+    "kotlin": (".kt",),
+    "csharp": (".cs",),
+    "php": (".php",),
+    "swift": (".swift",),
+    "scala": (".scala",),
+    "perl": (".pl", ".pm"),
+}
+
+# Never worth descending into
+DEFAULT_EXCLUDES = (".git", ".hg", ".svn", "node_modules", "__pycache__", ".venv", "venv", ".tox")
+
+SNIFF_BYTES = 8192
+
+
+def _glob_regex(pattern: str) -> str:
+    # fnmatch semantics plus "**", which also matches across "/"
+    regex = ""
+    i = 0
+    while i < len(pattern):
+        if pattern.startswith("**/", i):
+            regex += "(?:.*/)?"
+            i += 3
+        elif pattern.startswith("**", i):
+            regex += ".*"
+            i += 2
+        elif pattern[i] == "*":
+            regex += "[^/]*"
+            i += 1
+        elif pattern[i] == "?":
+            regex += "[^/]"
+            i += 1
+        elif pattern[i] == "[":
+            end = pattern.find("]", i + 1)
+            if end == -1:
+                regex += re.escape(pattern[i])
+                i += 1
+            else:
+                body = pattern[i + 1:end].replace("\\", "\\\\")
+                if body.startswith("!"):
+                    body = "^" + body[1:]
+                regex += f"[{body}]"
+                i = end + 1
+        else:
+            regex += re.escape(pattern[i])
+            i += 1
+    return regex
+
+
+class GitIgnore:
+    def __init__(self, base: str, lines: Iterable[str]):
+        # base is the directory of the .gitignore, relative to the scan root
+        self.rules: List[Tuple[re.Pattern, bool, bool]] = []
+        for line in lines:
+            line = line.rstrip("\n").rstrip()
+            if not line or line.startswith("#"):
+                continue
+            negated = line.startswith("!")
+            if negated:
+                line = line[1:]
+            dir_only = line.endswith("/")
+            line = line.strip("/") if dir_only else line
+            anchored = "/" in line.rstrip("/")
+            line = line.lstrip("/")
+            prefix = re.escape(base + "/") if base else ""
+            if anchored:
+                regex = prefix + _glob_regex(line)
+            else:
+                regex = prefix + "(?:.*/)?" + _glob_regex(line)
+            self.rules.append((re.compile(regex + r"\Z"), negated, dir_only))
+
+    @classmethod
+    def load(cls, directory: str, base: str) -> Optional["GitIgnore"]:
+        path = os.path.join(directory, ".gitignore")
+        try:
+            with open(path, errors="replace") as f:
+                ignore = cls(base, f)
+        except OSError:
+            return None
+        return ignore if ignore.rules else None
+
+    def match(self, relative_path: str, is_dir: bool) -> Optional[bool]:
+        # None when no rule applies, otherwise whether the path is ignored
+        result = None
+        for regex, negated, dir_only in self.rules:
+            if dir_only and not is_dir:
+                continue
+            if regex.match(relative_path):
+                result = not negated
+        return result
+
+
+def is_binary(path: str) -> bool:
+    try:
+        with open(path, "rb") as f:
+            head = f.read(SNIFF_BYTES)
+    except OSError:
+        return True
+    return b"\0" in head
+
+
+def _compile_globs(patterns: Iterable[str]) -> List[Tuple[str, re.Pattern]]:
+    return [(pattern, re.compile(_glob_regex(pattern) + r"\Z")) for pattern in patterns]
+
+
+def _matches(globs: List[Tuple[str, re.Pattern]], relative_path: str, name: str) -> bool:
+    # A glob matches either the file name or the path relative to the root
+    return any(
+        fnmatch.fnmatchcase(name, pattern) or regex.match(relative_path)
+        for pattern, regex in globs
+    )
+
+
+def discover_files(
+    root: str,
+    include: Optional[List[str]] = None,
+    exclude: Optional[List[str]] = None,
+    languages: Optional[List[str]] = None,
+    max_file_size: int = DISCOVERY_MAX_FILE_SIZE,
+    use_gitignore: bool = True,
+    stats: Optional[Counter] = None
+) -> Iterator[str]:
+    # Yields candidate source files under root in the same order os.walk
+    # would (files of a directory first, then its subdirectories, all sorted).
+    # A file is a candidate when it matches one of the include globs or, if
+    # there are none, when its extension belongs to one of the languages.
+    stats = stats if stats is not None else Counter()
+    include = _compile_globs(include or [])
+    exclude = _compile_globs(list(DEFAULT_EXCLUDES) + list(exclude or []))
+    extensions = tuple(
+        extension
+        for language in (languages or LANGUAGE_EXTENSIONS)
+        for extension in LANGUAGE_EXTENSIONS[language]
+    )
+
+    def accept(path: str, relative_path: str, name: str, size: int) -> bool:
+        if include:
+            if not _matches(include, relative_path, name):
+                stats["not_included"] += 1
+                return False
+        elif not name.lower().endswith(extensions):
+            stats["extension"] += 1
+            return False
+        if max_file_size and size > max_file_size:
+            stats["too_large"] += 1
+            return False
+        if is_binary(path):
+            stats["binary"] += 1
+            return False
+        return True
+
+    if os.path.isfile(root):
+        name = os.path.basename(root)
+        if accept(root, name, name, os.path.getsize(root)):
+            stats["files"] += 1
+            yield root
+        return
+
+    stack = [(root, "", [])]
+    while stack:
+        directory, relative_directory, ignores = stack.pop()
+        if use_gitignore:
+            ignore = GitIgnore.load(directory, relative_directory)
+            if ignore is not None:
+                ignores = ignores + [ignore]
+        try:
+            with os.scandir(directory) as it:
+                entries = sorted(it, key=lambda entry: entry.name)
+        except OSError:
+            stats["unreadable"] += 1
+            continue
+
+        subdirectories = []
+        for entry in entries:
+            relative_path = f"{relative_directory}/{entry.name}" if relative_directory else entry.name
+            try:
+                is_dir = entry.is_dir(follow_symlinks=False)
+                is_file = not is_dir and entry.is_file()
+            except OSError:
+                continue
+            if not is_dir and not is_file:
+                continue
+            if _matches(exclude, relative_path, entry.name):
+                stats["excluded"] += 1
+                continue
+            ignored = None
+            for ignore in ignores:
+                matched = ignore.match(relative_path, is_dir)
+                if matched is not None:
+                    ignored = matched
+            if ignored:
+                stats["gitignored"] += 1
+                continue
+            if is_dir:
+                subdirectories.append((entry.path, relative_path, ignores))
+            elif accept(entry.path, relative_path, entry.name, entry.stat().st_size):
+                stats["files"] += 1
+                yield entry.path
+        stack.extend(reversed(subdirectories))
+
+
+def git_changed_files(root: str, ref: str) -> Set[str]:
+    # Real paths of the files that differ from ref in the working tree, plus
+    # untracked files that are not ignored.
+    directory = root if os.path.isdir(root) else os.path.dirname(root) or "."
+
+    def git(*args) -> List[str]:
+        try:
+            result = subprocess.run(
+                ["git", "-C", directory, *args],
+                capture_output=True,
+                text=True,
+                check=True
+            )
+        except subprocess.CalledProcessError as e:
+            raise ValueError(f"git {' '.join(args)} failed: {e.stderr.strip()}") from e
+        return [line for line in result.stdout.splitlines() if line]
+
+    top = git("rev-parse", "--show-toplevel")[0]
+    changed = {os.path.realpath(os.path.join(top, path)) for path in git("diff", "--name-only", ref, "--")}
+    changed.update(
+        os.path.realpath(os.path.join(directory, path))
+        for path in git("ls-files", "--others", "--exclude-standard")
+    )
+    return changed
@@ -0,0 +1,151 @@
+import os
+import re
+import sqlite3
+import threading
+import time
+from typing import Dict, List, Optional, Sequence
+import numpy as np
+
+
+# Content-addressed embedding cache. Vectors live in one memory-mapped float32
+# matrix per model, and a SQLite index maps (model, key) to a row of that
+# matrix together with its last access time for LRU eviction.
+class EmbeddingCache:
+    INITIAL_CAPACITY = 1024
+
+    def __init__(self, path: str, max_entries: int = 100_000):
+        self.path = path
+        self.max_entries = max(1, max_entries)
+        self._lock = threading.Lock()
+        self._matrices: Dict[str, np.memmap] = {}
+        os.makedirs(path, exist_ok=True)
+        self._db = sqlite3.connect(os.path.join(path, "index.sqlite"), check_same_thread=False)
+        self._db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS models (
+                model TEXT PRIMARY KEY,
+                dim INTEGER NOT NULL,
+                capacity INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS entries (
+                model TEXT NOT NULL,
+                key TEXT NOT NULL,
+                slot INTEGER NOT NULL,
+                last_used REAL NOT NULL,
+                PRIMARY KEY (model, key)
+            );
+            CREATE INDEX IF NOT EXISTS entries_lru ON entries (model, last_used);
+            """
+        )
+        self._db.commit()
+
+    def _vectors_path(self, model: str) -> str:
+        return os.path.join(self.path, re.sub(r"[^A-Za-z0-9_.-]", "_", model) + ".f32")
+
+    def _matrix(self, model: str, dim: Optional[int] = None, rows: int = 0) -> Optional[np.memmap]:
+        row = self._db.execute("SELECT dim, capacity FROM models WHERE model = ?", (model,)).fetchone()
+        if row is None:
+            if dim is None:
+                return None
+            capacity = min(self.max_entries, max(self.INITIAL_CAPACITY, rows))
+            self._db.execute("INSERT INTO models VALUES (?, ?, ?)", (model, dim, capacity))
+            self._matrices.pop(model, None)
+            row = (dim, capacity)
+        model_dim, capacity = row
+        if dim is not None and dim != model_dim:
+            raise ValueError(f"Embedding dimension changed for model {model}: {model_dim} != {dim}")
+
+        wanted = min(self.max_entries, max(capacity, rows))
+        if wanted > capacity:
+            # Grow geometrically so that appends stay amortized O(1)
+            capacity = min(self.max_entries, max(wanted, capacity * 2))
+            self._db.execute("UPDATE models SET capacity = ? WHERE model = ?", (capacity, model))
+            self._matrices.pop(model, None)
+
+        matrix = self._matrices.get(model)
+        if matrix is None:
+            vectors_path = self._vectors_path(model)
+            size = capacity * model_dim * 4
+            with open(vectors_path, "ab") as f:
+                if f.tell() < size:
+                    f.truncate(size)
+            matrix = np.memmap(vectors_path, dtype=np.float32, mode="r+", shape=(capacity, model_dim))
+            self._matrices[model] = matrix
+        return matrix
+
+    def get_many(self, model: str, keys: Sequence[str]) -> Dict[str, List[float]]:
+        if not keys:
+            return {}
+        with self._lock:
+            matrix = self._matrix(model)
+            if matrix is None:
+                return {}
+            found = {}
+            unique_keys = list(dict.fromkeys(keys))
+            for i in range(0, len(unique_keys), 500):
+                chunk = unique_keys[i:i + 500]
+                placeholders = ",".join("?" * len(chunk))
+                found.update(self._db.execute(
+                    f"SELECT key, slot FROM entries WHERE model = ? AND key IN ({placeholders})",
+                    (model, *chunk)
+                ).fetchall())
+            if not found:
+                return {}
+            now = time.time()
+            self._db.executemany(
+                "UPDATE entries SET last_used = ? WHERE model = ? AND key = ?",
+                [(now, model, key) for key in found]
+            )
+            self._db.commit()
+            return {key: matrix[slot].tolist() for key, slot in found.items()}
+
+    def put_many(self, model: str, keys: Sequence[str], vectors: Sequence[Sequence[float]]):
+        items = dict(zip(keys, vectors))
+        if not items:
+            return
+        with self._lock:
+            dim = len(next(iter(items.values())))
+            existing = {}
+            for key in items:
+                row = self._db.execute(
+                    "SELECT slot FROM entries WHERE model = ? AND key = ?", (model, key)
+                ).fetchone()
+                if row is not None:
+                    existing[key] = row[0]
+            new_keys = [key for key in items if key not in existing]
+            count = self._db.execute("SELECT COUNT(*) FROM entries WHERE model = ?", (model,)).fetchone()[0]
+            matrix = self._matrix(model, dim=dim, rows=count + len(new_keys))
+
+            slots = dict(existing)
+            free = max(0, min(self.max_entries, matrix.shape[0]) - count)
+            for key in new_keys[:free]:
+                slots[key] = count
+                count += 1
+            evict = new_keys[free:]
+            if evict:
+                # Reuse the rows of the least recently used entries
+                victims = self._db.execute(
+                    "SELECT key, slot FROM entries WHERE model = ? AND key NOT IN (%s) "
+                    "ORDER BY last_used LIMIT ?" % ",".join("?" * len(existing)),
+                    (model, *existing, len(evict))
+                ).fetchall()
+                self._db.executemany(
+                    "DELETE FROM entries WHERE model = ? AND key = ?",
+                    [(model, victim) for victim, _ in victims]
+                )
+                for key, (_, slot) in zip(evict, victims):
+                    slots[key] = slot
+
+            for key, slot in slots.items():
+                matrix[slot] = np.asarray(items[key], dtype=np.float32)
+            matrix.flush()
+            now = time.time()
+            self._db.executemany(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)",
+                [(model, key, slot, now) for key, slot in slots.items()]
+            )
+            self._db.commit()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
@@ -1,21 +1,228 @@
+# Labels of the files/ folder, by file name prefix
+FILES_CATEGORIES = {
+    "aes-use": "USES_AES",
+    "pass1": "PASSWORD_PBKDF2_SHA256",
+    "pass2": "PASSWORD_PBKDF2_SHA256",
+    "pass": "PASSWORD_BCRYPT",
+    "rsa": "RSA",
+    "random-xor": "NOCRYPTO",
+    "regular_controller": "NOCRYPTO",
+}
+
+
 def get_right_category_from_file_name(file_name):
-    return file_name.split('/')[-2].split('.')[0]
+    # Folder names as the scan names the categories (ELIPTIC_CURVES is
+    # ElipticCurves)
+    from cascade import normalize_category
+    name = file_name.split('/')[-2].split('.')[0]
+    return normalize_category(name) or name
+
+
+def get_right_category(file_path):
+    # examples/ is labeled by folder, files/ by file name
+    if file_path.split('/')[-2] == 'files':
+        name = file_path.split('/')[-1]
+        for prefix, category in FILES_CATEGORIES.items():
+            if name.startswith(prefix):
+                return category
+    return get_right_category_from_file_name(file_path)
+
+
+def calibration_samples(files, margin):
+    # The kNN answers of every file and the prototype answers that clear
+    # margin, which are the ones a scan may keep
+    samples = [knn for knn, _ in files]
+    for _, prototype in files:
+        if prototype is not None and prototype[0] >= margin:
+            samples.append(prototype[1])
+    return samples
+
+
+def scan_samples(files, thresholds, margin):
+    # The answer that decides every file in a scan: the prototype one when it
+    # clears margin and its threshold, the kNN one otherwise
+    from routing import ROUTING_DEFAULT_THRESHOLD
+    samples = []
+    for knn, prototype in files:
+        if prototype is not None and prototype[0] >= margin:
+            key, confidence, _ = prototype[1]
+            if round(confidence, 9) >= thresholds.get(key, ROUTING_DEFAULT_THRESHOLD):
+                samples.append(prototype[1])
+                continue
+        samples.append(knn)
+    return samples
+
+
+def calibrate_routing(folder, target_precision, include=None, use_signatures=True, use_prefilter=True):
+    # Routes every file of folder without its own references in the
+    # collection, and keeps, per category, the lowest confidence at which
+    # the kNN answer is right often enough to skip the LLM, and the same for
+    # the answers of the category prototypes, along with the margin those
+    # answers need (see categorize.query_prototypes). Files that the
+    # signatures or the prefilter label never reach the router in a scan,
+    # so they are left out.
+    from categorize import embed_segments, prototype_answers, query_segments
+    from config import PROTOTYPE_MARGIN
+    from discovery import discover_files
+    from prefilter import prefilter
+    from routing import (
+        PROTOTYPE_MARGIN_KEY,
+        ROUTING_DEFAULT_THRESHOLD,
+        calibrate,
+        route,
+        routing_cost,
+        save_thresholds,
+        threshold_key,
+    )
+    from segmentation import segment_file
+    from signatures import match_signatures
+    from vecstore import collection, content_hash, reference_of
+
+    # Each file is routed without its own references, which are found by
+    # content hash; one that cannot be left out matches itself at distance 0
+    # and calibrates the thresholds far too low
+    entries = collection.get(include=["metadatas"])
+    untraceable = [
+        _id for _id, metadata in zip(entries["ids"], entries["metadatas"])
+        if reference_of(_id, metadata) is None
+    ]
+    if untraceable:
+        raise SystemExit(
+            f"{len(untraceable)} references carry neither a sha256 nor a content hash id (e.g. {untraceable[0]}); "
+            f"re-ingest the collection with ingest.py before calibrating"
+        )
+
+    # Per file, the kNN sample and, when the file has one, the margin and
+    # sample of its prototype answer, each keyed as route looks thresholds
+    # up, so that prototype answers are calibrated apart
+    files = []
+    excluded = {"signatures": 0, "prefilter": 0}
+    for file_path in discover_files(folder, include=include):
+        with open(file_path) as f:
+            code = f.read()
+        if use_signatures and match_signatures(code).category is not None:
+            excluded["signatures"] += 1
+            continue
+        if use_prefilter and prefilter(code).category is not None:
+            excluded["prefilter"] += 1
+            continue
+        segments = [segment_file(file_path, code)]
+        embeddings = embed_segments(segments)
+        exclude = [content_hash(code)]
+        right = get_right_category(file_path)
+        response = query_segments(segments, embeddings=embeddings, exclude_sha256=exclude, use_prototypes=False)[0]
+        decision = route(response, {})
+        knn = (decision.category, decision.confidence, right)
+        answer = prototype_answers(segments, embeddings, exclude_sha256=exclude)[0]
+        prototype = None
+        if answer is not None:
+            decision = route(answer, {})
+            prototype = (answer["margin"], (threshold_key(decision.category, answer), decision.confidence, threshold_key(right, answer)))
+        files.append((knn, prototype))
+
+    print(
+        f"Routed {len(files)} files; left out {excluded['signatures']} labeled by the signatures "
+        f"and {excluded['prefilter']} by the prefilter"
+    )
+    if not files:
+        raise SystemExit("No file reaches the router, nothing to calibrate")
+    # The margin a prototype answer needs: the one that answers the most
+    # files from the prototypes without more LLM calls, nor more wrong
+    # answers kept, than the collection alone; the largest of those tied
+    without = calibrate(calibration_samples(files, float("inf")), target_precision)
+    without_cost = routing_cost(scan_samples(files, without, float("inf")), without)
+    print("Prototype margin | Prototype answers | LLM calls | Wrong without LLM")
+    print(f"no prototypes    | 0                 | {without_cost['llm_calls']:<9} | {without_cost['kept_errors']}")
+    margin = None
+    answered = 0
+    for candidate in sorted({PROTOTYPE_MARGIN} | {prototype[0] for _, prototype in files if prototype is not None}):
+        thresholds = calibrate(calibration_samples(files, candidate), target_precision)
+        samples = scan_samples(files, thresholds, candidate)
+        cost = routing_cost(samples, thresholds)
+        count = sum(key.startswith("prototypes:") for key, _, _ in samples)
+        print(f"{candidate:<16.4f} | {count:<17} | {cost['llm_calls']:<9} | {cost['kept_errors']}")
+        if cost["llm_calls"] <= without_cost["llm_calls"] and cost["kept_errors"] <= without_cost["kept_errors"]:
+            if margin is None or count >= answered:
+                margin, answered = candidate, count
+    if margin is None:
+        margin = PROTOTYPE_MARGIN
+
+    print("Target precision | LLM call rate | Accuracy without LLM")
+    baseline = routing_cost(scan_samples(files, {}, margin), {})
+    print(f"unanimous only   | {baseline['llm_call_rate']:.2f}          | {baseline['kept_accuracy']:.2f}")
+    for target in sorted({0.8, 0.9, 0.95, 0.99, 1.0, target_precision}):
+        thresholds = calibrate(calibration_samples(files, margin), target)
+        cost = routing_cost(scan_samples(files, thresholds, margin), thresholds)
+        print(f"{target:<16.2f} | {cost['llm_call_rate']:.2f}          | {cost['kept_accuracy']:.2f}")
+
+    thresholds = calibrate(calibration_samples(files, margin), target_precision)
+    samples = scan_samples(files, thresholds, margin)
+    cost = routing_cost(samples, thresholds)
+    thresholds[PROTOTYPE_MARGIN_KEY] = round(margin, 6)
+    save_thresholds(thresholds)
+    print(f"Thresholds (default {ROUTING_DEFAULT_THRESHOLD}): {thresholds}")
+    print(
+        f"Files: {cost['files']}, LLM calls: {cost['llm_calls']} ({cost['llm_call_rate']:.0%}), "
+        f"kept without LLM: {cost['files'] - cost['llm_calls']}, wrong among them: {cost['kept_errors']}, "
+        f"answered by the prototypes: {sum(key.startswith('prototypes:') for key, _, _ in samples)}"
+    )
 
 
 if __name__ == '__main__':
-    from run import scan_folder
+    import argparse
+    import os
+    import time
+    from config import EMBEDDING_BACKEND, ROUTING_TARGET_PRECISION
+    from run import scan_items
+    parser = argparse.ArgumentParser(description="Accuracy and throughput of the scan on labeled examples")
+    parser.add_argument("folder", nargs="?", default="examples")
+    parser.add_argument("--calibrate", action="store_true", help="calibrate the kNN routing thresholds instead")
+    parser.add_argument("--target-precision", type=float, default=ROUTING_TARGET_PRECISION)
+    parser.add_argument("--include", action="append", help="only scan files matching this glob, e.g. '*.alg' for files/")
+    parser.add_argument("--no-prefilter", action="store_true", help="do not label files by their crypto keywords")
+    parser.add_argument("--no-signatures", action="store_true", help="do not label files by known crypto constants")
+    args = parser.parse_args()
+    if args.calibrate:
+        calibrate_routing(
+            args.folder,
+            args.target_precision,
+            args.include,
+            use_signatures=not args.no_signatures,
+            use_prefilter=not args.no_prefilter
+        )
+        raise SystemExit(0)
+
     total = 0
     correct = 0
     wrongs = []
-    folder = 'examples'
+    folder = args.folder
     rights = []
-    for file_path, category in scan_folder(folder):
+    total_bytes = 0
+    # Files and right answers per deciding stage
+    by_stage = {}
+    start = time.perf_counter()
+    for item in scan_items(
+        folder,
+        include=args.include,
+        use_signatures=not args.no_signatures,
+        use_prefilter=not args.no_prefilter
+    ):
+        if item.error is not None:
+            print(f"Could not scan {item.path}: {item.error}")
+            continue
+        file_path, category = item.path, item.category
+        total_bytes += os.path.getsize(file_path)
         total += 1
-        if get_right_category_from_file_name(file_path) == category:
+        stage_files, stage_correct = by_stage.get(item.stage, (0, 0))
+        right_category = get_right_category(file_path)
+        is_right = right_category == category
+        by_stage[item.stage] = (stage_files + 1, stage_correct + is_right)
+        if is_right:
             correct += 1
             rights.append((file_path, category))
         else:
-            wrongs.append((file_path, category, get_right_category_from_file_name(file_path)))
+            wrongs.append((file_path, category, right_category))
+    elapsed = time.perf_counter() - start
 
     # Create the confusion matrix for the categories
     matrix = {}
@@ -33,5 +240,19 @@ if __name__ == '__main__':
         print(f"{row_label}: {row}")
 
     print(f"Total: {total}, Correct: {correct}, Accuracy: {correct/total}")
+    for stage, (stage_files, stage_correct) in sorted(by_stage.items()):
+        print(f"Decided by {stage}: {stage_files} files, accuracy {stage_correct/stage_files:.2f}")
+    escalated = sum(files for stage, (files, _) in by_stage.items() if stage.startswith("llm"))
+    routed = by_stage.get("knn", (0, 0))[0] + escalated
+    if routed:
+        print(f"LLM call rate: {escalated/routed:.2f} of the files that reached the router")
+    from run import cascade
+    for model, stats in cascade.summary().items():
+        if stats["calls"]:
+            print(f"LLM tier {model}: {stats}")
+    print(
+        f"Embedding backend: {EMBEDDING_BACKEND}, Time: {elapsed:.2f}s, "
+        f"Throughput: {total/elapsed:.2f} files/s, {total_bytes/elapsed/1e6:.3f} MB/s"
+    )
     for wrong in wrongs:
         print(f"File: {wrong[0]}, Predicted: {wrong[1]}, Actual: {wrong[2]}")
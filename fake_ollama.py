@@ -0,0 +1,406 @@
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from collections import Counter
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+from hashing_embedding import HashingEmbedding
+from prefilter import prefilter
+from signatures import match_signatures
+from vecstore import Category
+
+
+# Code of the adjudication prompts, between their header and what follows it
+CODE_REGEX = re.compile(
+    r"The code is as follows?:\s*\n(.*?)(?:\n\s*(?:If usef?ul|Answer with|OUTPUT ONLY)|\Z)",
+    re.DOTALL
+)
+VULN_REGEX = re.compile(r"Does the vulnerability affect the algorithm (.+?)\?")
+# Pieces of an answer streamed one per chunk, and counted as one token each
+TOKEN_REGEX = re.compile(r"\s+|\w+|[^\w\s]")
+
+# Algorithm names counted in code that neither signatures nor the prefilter
+# could label
+KEYWORDS = [
+    (re.compile(r"\brsa", re.IGNORECASE), Category.RSA.value),
+    (re.compile(r"diffie|hellman", re.IGNORECASE), Category.DIFFIE_HELLMAN.value),
+    (re.compile(r"\bdsa", re.IGNORECASE), Category.DSA.value),
+    (re.compile(r"elliptic|ecdsa|ecdh|secp\d|curve25519", re.IGNORECASE), Category.ELIPTIC_CURVE.value),
+    (re.compile(r"ed25519", re.IGNORECASE), Category.ED25519.value),
+    (re.compile(r"ed448", re.IGNORECASE), Category.ED448.value),
+    (re.compile(r"\baes|rijndael", re.IGNORECASE), Category.AES.value),
+    (re.compile(r"camellia", re.IGNORECASE), Category.CAMELLIA.value),
+    (re.compile(r"chacha", re.IGNORECASE), Category.CHACHA20.value),
+    (re.compile(r"\bdes\b|\bdes_", re.IGNORECASE), Category.DES.value),
+    (re.compile(r"hmac", re.IGNORECASE), Category.HMAC.value),
+    (re.compile(r"md5", re.IGNORECASE), Category.MD5.value),
+    (re.compile(r"\bsha", re.IGNORECASE), Category.SHA.value),
+]
+# Categories guessed from the prefilter signals when no algorithm is named
+SIGNAL_CATEGORIES = {
+    "math_primitives": Category.RSA.value,
+    "bit_mixing": Category.SHA.value,
+}
+
+
+@dataclass(init=True)
+class Behavior:
+    # Seconds every request takes, plus every generated token for answers
+    latency: float = 0.0
+    token_latency: float = 0.0
+    # Latencies vary uniformly by up to this share, up or down
+    jitter: float = 0.0
+    # Share of the requests that take slow_factor times longer
+    slow_rate: float = 0.0
+    slow_factor: float = 10.0
+    # Share of the requests that fail with error_status
+    error_rate: float = 0.0
+    error_status: int = 503
+    # Requests served at once (0 is unlimited) and waiting for a slot; the
+    # rest are rejected with 503, as Ollama does when its queue is full
+    max_concurrency: int = 0
+    max_queue: int = 512
+    # Latency per model, for cascades of models of different sizes
+    model_latency: Dict[str, float] = field(default_factory=dict)
+    embedding_dim: int = 768
+    seed: int = 0
+
+
+def classify(code: str) -> Tuple[str, float]:
+    # Category and confidence of the rule-based answer: the constants of an
+    # implementation, then unambiguous library usage, then the algorithm
+    # named the most, then the kind of code the prefilter saw
+    signatures = match_signatures(code)
+    if signatures.category is not None:
+        return signatures.category, 0.95
+    result = prefilter(code)
+    if result.category is not None:
+        return result.category, 0.95 if result.category != Category.NOCRYPTO.value else 0.9
+    counts = Counter()
+    for regex, category in KEYWORDS:
+        counts[category] += len(regex.findall(code))
+    category, count = counts.most_common(1)[0]
+    if count > 0:
+        return category, 0.6
+    for name in sorted(result.signals, key=result.signals.get, reverse=True):
+        if name in SIGNAL_CATEGORIES:
+            return SIGNAL_CATEGORIES[name], 0.5
+    return Category.NOCRYPTO.value, 0.6
+
+
+def answer_for(prompt: str, json_format: bool) -> str:
+    match = VULN_REGEX.search(prompt)
+    if match is not None:
+        algorithm = match.group(1).strip().lower()
+        described = prompt[:match.start()].lower()
+        return "yes" if algorithm in described else "no"
+    match = CODE_REGEX.search(prompt)
+    category, confidence = classify(match.group(1) if match is not None else prompt)
+    if not json_format:
+        return category
+    if '"confidence"' in prompt:
+        return json.dumps({"category": category, "confidence": confidence})
+    return json.dumps({"category": category})
+
+
+def decode(answer: str, options: dict) -> List[str]:
+    # Tokens of answer up to the first stop sequence and num_predict
+    for stop in options.get("stop") or []:
+        if stop in answer:
+            answer = answer[:answer.index(stop)]
+    tokens = TOKEN_REGEX.findall(answer)
+    limit = options.get("num_predict")
+    if limit is not None and limit >= 0:
+        tokens = tokens[:limit]
+    return tokens
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: "_Server"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status: int, payload: dict):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_GET(self):
+        fake = self.server.fake
+        if self.path == "/":
+            body = b"Ollama is running"
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        elif self.path == "/api/tags":
+            self._send_json(200, {"models": []})
+        elif self.path == "/api/stats":
+            self._send_json(200, fake.snapshot())
+        else:
+            self._send_json(404, {"error": "not found"})
+
+    def do_POST(self):
+        fake = self.server.fake
+        raw = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        try:
+            request = json.loads(raw or b"{}")
+        except json.JSONDecodeError:
+            self._send_json(400, {"error": "invalid JSON"})
+            return
+        routes = {
+            "/api/embeddings": self._embeddings,
+            "/api/embed": self._embed,
+            "/api/generate": self._generate,
+            "/api/chat": self._chat,
+        }
+        route = routes.get(self.path)
+        if route is None:
+            self._send_json(404, {"error": "not found"})
+            return
+        fake.count(self.path)
+        if not fake.enter():
+            fake.count("rejected")
+            self._send_json(503, {"error": "server busy, please try again.  maximum pending requests exceeded"})
+            return
+        try:
+            rng = fake.rng(raw)
+            if rng.random() < fake.behavior.error_rate:
+                fake.count("injected_errors")
+                fake.sleep(fake.base_latency(request.get("model", ""), rng))
+                self._send_json(fake.behavior.error_status, {"error": "injected failure"})
+                return
+            route(request, rng)
+        except (BrokenPipeError, ConnectionResetError):
+            fake.count("disconnected")
+        finally:
+            fake.leave()
+
+    def _embeddings(self, request: dict, rng: random.Random):
+        fake = self.server.fake
+        fake.sleep(fake.base_latency(request.get("model", ""), rng))
+        embedding = fake.embed([request.get("prompt", "")])[0]
+        self._send_json(200, {"embedding": embedding})
+
+    def _embed(self, request: dict, rng: random.Random):
+        fake = self.server.fake
+        inputs = request.get("input", "")
+        inputs = [inputs] if isinstance(inputs, str) else list(inputs)
+        fake.sleep(fake.base_latency(request.get("model", ""), rng))
+        self._send_json(200, {"model": request.get("model", ""), "embeddings": fake.embed(inputs)})
+
+    def _generate(self, request: dict, rng: random.Random):
+        answer = answer_for(request.get("prompt", ""), request.get("format") == "json")
+        self._answer(request, rng, answer, lambda text: {"response": text})
+
+    def _chat(self, request: dict, rng: random.Random):
+        messages = request.get("messages") or [{}]
+        prompt = messages[-1].get("content", "")
+        answer = answer_for(prompt, request.get("format") == "json")
+        self._answer(request, rng, answer, lambda text: {"message": {"role": "assistant", "content": text}})
+
+    def _answer(self, request: dict, rng: random.Random, answer: str, wrap):
+        # Sends answer whole or streamed, one token per chunk, as Ollama does
+        fake = self.server.fake
+        model = request.get("model", "")
+        tokens = decode(answer, request.get("options") or {})
+        prompt_tokens = len(TOKEN_REGEX.findall(request.get("prompt", "") or json.dumps(request.get("messages"))))
+        base = fake.base_latency(model, rng)
+        per_token = fake.behavior.token_latency
+        final = {"model": model, "done": True, "done_reason": "stop", "prompt_eval_count": prompt_tokens, "eval_count": len(tokens)}
+        if not request.get("stream", True):
+            fake.sleep(base + per_token * len(tokens))
+            fake.count("generated_tokens", len(tokens))
+            self._send_json(200, {**wrap("".join(tokens)), **final})
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        fake.sleep(base)
+        sent = 0
+        try:
+            for token in tokens:
+                self._send_chunk({"model": model, **wrap(token), "done": False})
+                sent += 1
+                fake.sleep(per_token)
+            self._send_chunk({**wrap(""), **final})
+            self.wfile.write(b"0\r\n\r\n")
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            # The client had what it needed and closed the stream
+            fake.count("aborted_streams")
+            self.close_connection = True
+        finally:
+            fake.count("generated_tokens", sent)
+
+    def _send_chunk(self, payload: dict):
+        line = (json.dumps(payload) + "\n").encode()
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(line), line))
+        self.wfile.flush()
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    fake: "FakeOllama"
+
+
+# Ollama-compatible stand-in for tests and benchmarks. Embeddings are the
+# in-process hashing embeddings and answers come from the prefilter and the
+# signatures, so the same request always gets the same response. Latency,
+# jitter, failures and the concurrency limit are set through Behavior; the
+# random draws depend on the seed and the request, not on thread timing.
+class FakeOllama:
+    def __init__(self, behavior: Optional[Behavior] = None, host: str = "127.0.0.1", port: int = 0):
+        self.behavior = behavior or Behavior()
+        self.stats = Counter()
+        self._embedding = HashingEmbedding(dim=self.behavior.embedding_dim, idf_path=None)
+        self._lock = threading.Lock()
+        self._seen = Counter()
+        self._slots = threading.Semaphore(self.behavior.max_concurrency) if self.behavior.max_concurrency > 0 else None
+        self._waiting = 0
+        self._active = 0
+        self._server = _Server((host, port), Handler)
+        self._server.fake = self
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> "FakeOllama":
+        self._thread = threading.Thread(target=self._server.serve_forever, name="fake-ollama", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+    def __enter__(self) -> "FakeOllama":
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def count(self, name: str, amount: int = 1):
+        with self._lock:
+            self.stats[name] += amount
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return dict(self.stats)
+
+    def rng(self, raw: bytes) -> random.Random:
+        # Repeats of a request (retries) get the next draws of its own stream
+        digest = hashlib.sha256(raw).hexdigest()
+        with self._lock:
+            attempt = self._seen[digest]
+            self._seen[digest] += 1
+        return random.Random(f"{self.behavior.seed}:{digest}:{attempt}")
+
+    def enter(self) -> bool:
+        if self._slots is None:
+            with self._lock:
+                self._active += 1
+                self.stats["peak_concurrency"] = max(self.stats["peak_concurrency"], self._active)
+            return True
+        with self._lock:
+            if self._waiting >= self.behavior.max_queue:
+                return False
+            self._waiting += 1
+        self._slots.acquire()
+        with self._lock:
+            self._waiting -= 1
+            self._active += 1
+            self.stats["peak_concurrency"] = max(self.stats["peak_concurrency"], self._active)
+        return True
+
+    def leave(self):
+        with self._lock:
+            self._active -= 1
+        if self._slots is not None:
+            self._slots.release()
+
+    def base_latency(self, model: str, rng: random.Random) -> float:
+        latency = self.behavior.model_latency.get(model, self.behavior.latency)
+        latency *= 1 + self.behavior.jitter * (2 * rng.random() - 1)
+        if rng.random() < self.behavior.slow_rate:
+            latency *= self.behavior.slow_factor
+        return max(0.0, latency)
+
+    def sleep(self, seconds: float):
+        if seconds > 0:
+            time.sleep(seconds)
+
+    def embed(self, inputs: List[str]) -> List[List[float]]:
+        return [vector.tolist() for vector in self._embedding(inputs)]
+
+
+if __name__ == '__main__':
+    # python fake_ollama.py [--port 11434] [--latency 0.2 --jitter 0.3 ...]:
+    # serve until interrupted, then print the request counters
+    import argparse
+
+    def model_latency(value: str) -> Tuple[str, float]:
+        model, _, seconds = value.rpartition("=")
+        return model, float(seconds)
+
+    defaults = Behavior()
+    parser = argparse.ArgumentParser(description="Deterministic Ollama-compatible server for tests and benchmarks")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=11434)
+    parser.add_argument("--latency", type=float, default=defaults.latency, help="seconds per request")
+    parser.add_argument("--token-latency", type=float, default=defaults.token_latency, help="seconds per generated token")
+    parser.add_argument("--jitter", type=float, default=defaults.jitter, help="relative latency variation, 0 to 1")
+    parser.add_argument("--slow-rate", type=float, default=defaults.slow_rate, help="share of requests that are slow")
+    parser.add_argument("--slow-factor", type=float, default=defaults.slow_factor)
+    parser.add_argument("--error-rate", type=float, default=defaults.error_rate, help="share of requests that fail")
+    parser.add_argument("--error-status", type=int, default=defaults.error_status)
+    parser.add_argument("--max-concurrency", type=int, default=defaults.max_concurrency, help="0 is unlimited")
+    parser.add_argument("--max-queue", type=int, default=defaults.max_queue)
+    parser.add_argument("--model-latency", type=model_latency, action="append", default=[], metavar="MODEL=SECONDS")
+    parser.add_argument("--embedding-dim", type=int, default=defaults.embedding_dim)
+    parser.add_argument("--seed", type=int, default=defaults.seed)
+    args = parser.parse_args()
+    behavior = Behavior(
+        latency=args.latency,
+        token_latency=args.token_latency,
+        jitter=args.jitter,
+        slow_rate=args.slow_rate,
+        slow_factor=args.slow_factor,
+        error_rate=args.error_rate,
+        error_status=args.error_status,
+        max_concurrency=args.max_concurrency,
+        max_queue=args.max_queue,
+        model_latency=dict(args.model_latency),
+        embedding_dim=args.embedding_dim,
+        seed=args.seed
+    )
+    server = FakeOllama(behavior, args.host, args.port)
+    print(f"Serving a fake Ollama on {server.url}")
+    try:
+        server._server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server._server.server_close()
+        print(json.dumps(server.snapshot(), indent=4, sort_keys=True))
@@ -0,0 +1,105 @@
+import os
+import re
+import zlib
+from collections import Counter
+from typing import Iterable, List, Optional
+import numpy as np
+from config import HASHING_DIM, HASHING_IDF_PATH, VECTOR_BACKEND
+
+if VECTOR_BACKEND == "chroma":
+    from chromadb import EmbeddingFunction
+else:
+    EmbeddingFunction = object
+
+
+TOKEN_REGEX = re.compile(r"[A-Za-z_][A-Za-z0-9_]*|\d+|[^\sA-Za-z0-9_]")
+CHAR_NGRAMS = (3, 4)
+# Odd 64 bit multiplier used to spread the packed character n-grams
+MIX = np.uint64(0x9E3779B97F4A7C15)
+
+
+# Embedding function that runs entirely in-process: hashed token unigrams,
+# token bigrams and character n-grams, sublinear TF weighting, an optional IDF
+# vector fitted on a reference corpus, and L2 normalization.
+class HashingEmbedding(EmbeddingFunction):
+    def __init__(self, dim: int = HASHING_DIM, idf_path: Optional[str] = HASHING_IDF_PATH):
+        self.dim = dim
+        self.idf_path = idf_path
+        self.idf = None
+        if idf_path and os.path.exists(idf_path):
+            idf = np.load(idf_path)
+            if idf.shape == (dim,):
+                self.idf = idf.astype(np.float32)
+
+    def _token_features(self, code: str) -> np.ndarray:
+        tokens = TOKEN_REGEX.findall(code.lower())
+        grams = Counter(tokens)
+        grams.update(a + " " + b for a, b in zip(tokens, tokens[1:]))
+        if not grams:
+            return np.zeros(0, dtype=np.int64)
+        hashes = np.fromiter(
+            (zlib.crc32(gram.encode()) for gram in grams),
+            dtype=np.int64,
+            count=len(grams)
+        )
+        return np.repeat(hashes, np.fromiter(grams.values(), dtype=np.int64, count=len(grams)))
+
+    def _char_features(self, code: str) -> np.ndarray:
+        data = np.frombuffer(code.lower().encode("utf-8", "replace"), dtype=np.uint8).astype(np.uint64)
+        features = []
+        for n in CHAR_NGRAMS:
+            if len(data) < n:
+                continue
+            packed = np.zeros(len(data) - n + 1, dtype=np.uint64)
+            for i in range(n):
+                packed = (packed << np.uint64(8)) | data[i:len(data) - n + 1 + i]
+            mixed = (packed + np.uint64(n)) * MIX
+            features.append((mixed >> np.uint64(32)).astype(np.int64))
+        if not features:
+            return np.zeros(0, dtype=np.int64)
+        return np.concatenate(features)
+
+    def term_frequencies(self, code: str) -> np.ndarray:
+        hashes = np.concatenate([self._token_features(code), self._char_features(code)])
+        buckets = hashes % self.dim
+        # The next hash bit decides the sign so that collisions cancel out on average
+        signs = np.where((hashes // self.dim) & 1, -1.0, 1.0)
+        tf = np.bincount(buckets, weights=signs, minlength=self.dim)
+        return np.sign(tf) * np.log1p(np.abs(tf))
+
+    def __call__(self, input: List[str]) -> List[np.ndarray]:
+        if len(input) == 0:
+            return []
+        matrix = np.vstack([self.term_frequencies(doc) for doc in input]).astype(np.float32)
+        if self.idf is not None:
+            matrix *= self.idf
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        matrix /= np.maximum(norms, 1e-12)
+        return list(matrix)
+
+    def fit(self, documents: Iterable[str]) -> np.ndarray:
+        df = np.zeros(self.dim, dtype=np.float64)
+        total = 0
+        for doc in documents:
+            df += self.term_frequencies(doc) != 0
+            total += 1
+        self.idf = (np.log((1 + total) / (1 + df)) + 1).astype(np.float32)
+        if self.idf_path:
+            np.save(self.idf_path, self.idf)
+        return self.idf
+
+
+if __name__ == '__main__':
+    # python hashing_embedding.py <folder>: fit the IDF vector on a reference
+    # corpus. The reference collection has to be re-seeded afterwards.
+    import sys
+    folder = sys.argv[1]
+
+    def read_all(root):
+        for dir_path, _, file_names in os.walk(root):
+            for file_name in file_names:
+                with open(os.path.join(dir_path, file_name), errors="replace") as f:
+                    yield f.read()
+
+    HashingEmbedding().fit(read_all(folder))
+    print(f"Fitted IDF over {HASHING_DIM} buckets, saved to {HASHING_IDF_PATH}")
@@ -0,0 +1,163 @@
+import csv
+import os
+import sys
+import time
+from collections import Counter
+from typing import Iterable, Iterator, List, Optional, Tuple
+from tqdm import tqdm
+from cascade import normalize_category
+from config import DISCOVERY_MAX_FILE_SIZE, INGEST_BATCH_SIZE
+from discovery import LANGUAGE_EXTENSIONS, discover_files
+from vecstore import collection, content_hash, documents_for_file, upsert_references
+
+
+def reference_category(label: str, source: str) -> str:
+    # The Category value of a folder name or manifest label, as signatures,
+    # prefilter and the LLM name it, so that kNN verdicts use the same names
+    category = normalize_category(label)
+    if category is None:
+        raise ValueError(f"{source}: unknown category {label!r}")
+    return category
+
+
+def labeled_tree(
+    root: str,
+    include: Optional[List[str]] = None,
+    languages: Optional[List[str]] = None,
+    max_file_size: int = DISCOVERY_MAX_FILE_SIZE
+) -> Iterator[Tuple[str, str]]:
+    # (path, category) of the files of a tree laid out like examples/, where
+    # the first folder under root names the category. Files directly under
+    # root have none and are left out.
+    for path in discover_files(root, include=include, languages=languages, max_file_size=max_file_size):
+        parts = os.path.relpath(path, root).split(os.sep)
+        if len(parts) > 1:
+            yield path, reference_category(parts[0], path)
+
+
+def labeled_manifest(manifest_path: str) -> Iterator[Tuple[str, str]]:
+    # (path, category) rows of a CSV file, relative paths being relative to
+    # the folder of the file. A header row "path,category" is skipped.
+    base = os.path.dirname(os.path.abspath(manifest_path))
+    with open(manifest_path, newline="") as f:
+        reader = csv.reader(f)
+        for row in reader:
+            if not row or row[0].startswith("#") or row[:2] == ["path", "category"]:
+                continue
+            if len(row) < 2:
+                raise ValueError(f"{manifest_path}:{reader.line_num}: expected path,category, got {row}")
+            path, category = row[0].strip(), row[1].strip()
+            yield os.path.join(base, path), reference_category(category, f"{manifest_path}:{reader.line_num}")
+
+
+def present_hashes(hashes: List[str], batch_size: int = INGEST_BATCH_SIZE) -> set:
+    # Content hashes with references in the collection: a file is stored
+    # under its hash, or under hash:i when it has several segments
+    present = set()
+    for start in range(0, len(hashes), batch_size):
+        batch = hashes[start:start + batch_size]
+        found = collection.get(ids=batch + [f"{sha256}:0" for sha256 in batch], include=[])["ids"]
+        present.update(id.split(":", 1)[0] for id in found)
+    return present
+
+
+def ingest(
+    files: Iterable[Tuple[str, str]],
+    batch_size: int = INGEST_BATCH_SIZE,
+    progress: bool = True,
+    stats: Optional[Counter] = None
+) -> Counter:
+    # Upserts the references of (path, category) pairs. Files are hashed
+    # first and the ones already in the collection skipped, so an
+    # interrupted ingest picks up where it stopped: a file is upserted with
+    # all of its segments in the same batch.
+    stats = stats if stats is not None else Counter()
+    pending = {}
+    for path, category in files:
+        try:
+            with open(path, errors="replace") as f:
+                code = f.read()
+        except OSError as e:
+            print(f"Could not read {path}: {e}", file=sys.stderr)
+            stats["unreadable"] += 1
+            continue
+        sha256 = content_hash(code)
+        if sha256 in pending:
+            stats["duplicates"] += 1
+            continue
+        pending[sha256] = (path, category, code)
+    stats["files"] += len(pending)
+
+    present = present_hashes(list(pending), batch_size)
+    stats["present"] += len(present)
+    todo = [entry for sha256, entry in pending.items() if sha256 not in present]
+
+    ids, metadatas, documents = [], [], []
+
+    def flush():
+        if ids:
+            upsert_references(ids, metadatas, documents)
+            stats["documents"] += len(ids)
+            ids.clear()
+            metadatas.clear()
+            documents.clear()
+
+    with tqdm(total=len(todo), unit="file", disable=not progress, file=sys.stderr) as bar:
+        for path, category, code in todo:
+            file_ids, file_metadatas, file_documents = documents_for_file(path, code, category)
+            ids.extend(file_ids)
+            metadatas.extend(file_metadatas)
+            documents.extend(file_documents)
+            stats["ingested"] += 1
+            stats[f"category:{category}"] += 1
+            if len(ids) >= batch_size:
+                flush()
+                bar.update(stats["ingested"] - bar.n)
+        flush()
+        bar.update(stats["ingested"] - bar.n)
+    return stats
+
+
+if __name__ == '__main__':
+    # python ingest.py examples/ or python ingest.py --manifest labels.csv:
+    # fill the reference collection of the current embedding and vector
+    # backends. Running it again only adds what is missing.
+    import argparse
+    parser = argparse.ArgumentParser(description="Add labeled reference files to the collection")
+    parser.add_argument("folder_path", nargs="?", help="tree whose first level folders name the categories")
+    parser.add_argument("--manifest", action="append", default=[], help="CSV file of path,category rows")
+    parser.add_argument("--include", action="append", help="only take files of the tree matching this glob")
+    parser.add_argument(
+        "--language",
+        action="append",
+        choices=sorted(LANGUAGE_EXTENSIONS),
+        help="only take files of the tree of this language (default: all)"
+    )
+    parser.add_argument("--max-size", type=int, default=DISCOVERY_MAX_FILE_SIZE, help="skip larger files (bytes)")
+    parser.add_argument("--batch-size", type=int, default=INGEST_BATCH_SIZE, help="documents embedded and upserted at once")
+    parser.add_argument("--no-progress", action="store_true")
+    args = parser.parse_args()
+    if args.folder_path is None and not args.manifest:
+        parser.error("give a folder, a manifest, or both")
+
+    def sources():
+        if args.folder_path is not None:
+            yield from labeled_tree(args.folder_path, args.include, args.language, args.max_size)
+        for manifest_path in args.manifest:
+            yield from labeled_manifest(manifest_path)
+
+    start = time.perf_counter()
+    try:
+        stats = ingest(sources(), batch_size=max(1, args.batch_size), progress=not args.no_progress)
+    except ValueError as e:
+        parser.error(str(e))
+    elapsed = time.perf_counter() - start
+    categories = {key.split(":", 1)[1]: count for key, count in sorted(stats.items()) if key.startswith("category:")}
+    print(
+        f"{stats['files']} files: {stats['present']} already present, {stats['ingested']} ingested "
+        f"as {stats['documents']} documents in {elapsed:.1f} s "
+        f"({stats['duplicates']} duplicates, {stats['unreadable']} unreadable)"
+    )
+    if categories:
+        print(f"Ingested by category: {categories}")
+    print(f"Collection size: {collection.count()}")
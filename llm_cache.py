@@ -0,0 +1,120 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+from typing import Iterable, Optional
+import metrics
+
+
+@dataclass(init=True)
+class CachedAnswer:
+    category: str
+    response: str
+
+
+# Answers of the LLM adjudication step. Prompts are deterministic and run at
+# temperature 0, so an answer only depends on the model, its options, the
+# prompt template, the code and the neighbor categories shown in the prompt.
+# Entries are evicted least recently used first once max_entries is reached.
+class LLMCache:
+    def __init__(self, path: str, max_entries: int = 50_000):
+        self.path = path
+        self.max_entries = max(1, max_entries)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.executescript(
+            """
+            PRAGMA journal_mode = WAL;
+            PRAGMA synchronous = NORMAL;
+            CREATE TABLE IF NOT EXISTS answers (
+                key TEXT PRIMARY KEY,
+                prompt_version TEXT NOT NULL,
+                category TEXT NOT NULL,
+                response TEXT NOT NULL,
+                last_used REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS answers_lru ON answers (last_used);
+            CREATE INDEX IF NOT EXISTS answers_prompt_version ON answers (prompt_version);
+            """
+        )
+        self._db.commit()
+
+    @staticmethod
+    def key(model: str, options: Optional[dict], prompt_version: str, sha256: str, categories: Iterable[str]) -> str:
+        # Neighbor categories are sorted: the prompt lists them as a set
+        material = json.dumps(
+            [model, dict(options or {}), prompt_version, sha256, sorted(set(categories))],
+            sort_keys=True
+        )
+        return hashlib.sha256(material.encode()).hexdigest()
+
+    def get(self, key: str) -> Optional[CachedAnswer]:
+        with self._lock:
+            row = self._db.execute("SELECT category, response FROM answers WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                metrics.LLM_CACHE.labels("miss").inc()
+                return None
+            self.hits += 1
+            metrics.LLM_CACHE.labels("hit").inc()
+            self._db.execute("UPDATE answers SET last_used = ? WHERE key = ?", (time.time(), key))
+            self._db.commit()
+        return CachedAnswer(category=row[0], response=row[1])
+
+    def put(self, key: str, prompt_version: str, answer: CachedAnswer):
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO answers VALUES (?, ?, ?, ?, ?)",
+                (key, prompt_version, answer.category, answer.response, time.time())
+            )
+            count = self._db.execute("SELECT COUNT(*) FROM answers").fetchone()[0]
+            if count > self.max_entries:
+                self._db.execute(
+                    "DELETE FROM answers WHERE key IN (SELECT key FROM answers ORDER BY last_used LIMIT ?)",
+                    (count - self.max_entries,)
+                )
+            self._db.commit()
+
+    def invalidate(self, prompt_version: Optional[str] = None, keep: Optional[Iterable[str]] = None) -> int:
+        # Drops the answers of one prompt version, or of every version that
+        # is not in keep. Returns the number of answers removed.
+        with self._lock:
+            if prompt_version is not None:
+                cursor = self._db.execute("DELETE FROM answers WHERE prompt_version = ?", (prompt_version,))
+            else:
+                keep = list(keep or [])
+                placeholders = ", ".join("?" for _ in keep)
+                cursor = self._db.execute(
+                    f"DELETE FROM answers WHERE prompt_version NOT IN ({placeholders})",
+                    keep
+                )
+            self._db.commit()
+            return cursor.rowcount
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM answers").fetchone()[0]
+
+
+if __name__ == '__main__':
+    import argparse
+    from config import LLM_CACHE_PATH
+    parser = argparse.ArgumentParser(description="Inspect or invalidate the LLM answer cache")
+    parser.add_argument("--path", default=LLM_CACHE_PATH)
+    parser.add_argument("--invalidate", metavar="PROMPT_VERSION", help="drop the answers of this prompt version")
+    parser.add_argument("--stale", action="store_true", help="drop the answers of every prompt version not in use")
+    args = parser.parse_args()
+    cache = LLMCache(args.path)
+    if args.invalidate:
+        print(f"Removed {cache.invalidate(args.invalidate)} answers")
+    if args.stale:
+        from run import PROMPT_VERSIONS
+        print(f"Removed {cache.invalidate(keep=PROMPT_VERSIONS.values())} answers")
+    with cache._lock:
+        rows = cache._db.execute("SELECT prompt_version, COUNT(*) FROM answers GROUP BY prompt_version").fetchall()
+    for prompt_version, count in rows:
+        print(f"{prompt_version}: {count} answers")
@@ -0,0 +1,182 @@
+import asyncio
+import json
+import random
+import threading
+from concurrent.futures import Future
+from typing import Callable, Mapping, Optional
+import httpx
+from ollama import ResponseError
+import metrics
+from config import (
+    LLM_MAX_CONNECTIONS,
+    LLM_MAX_IN_FLIGHT,
+    LLM_MAX_PENDING,
+    LLM_RETRIES,
+    LLM_RETRY_BACKOFF,
+    LLM_TIMEOUT,
+    OLLAMA_HOST,
+)
+
+
+# Status codes worth retrying: the server is overloaded or restarting
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+def _retryable(error: BaseException) -> bool:
+    if isinstance(error, ResponseError):
+        return error.status_code in RETRY_STATUS_CODES
+    return isinstance(error, (httpx.TransportError, asyncio.TimeoutError))
+
+
+# Shared LLM client. One httpx.AsyncClient (and so one pool of keep-alive
+# connections) to the Ollama API runs on a background event loop; callers
+# from any thread submit requests to it. At most max_in_flight requests
+# reach the server at a time, and at most max_pending wait for it: further
+# callers block until there is room, which slows the pipeline down instead
+# of piling requests up.
+class LLMClient:
+    def __init__(
+        self,
+        host: str = OLLAMA_HOST,
+        max_in_flight: int = LLM_MAX_IN_FLIGHT,
+        max_pending: int = LLM_MAX_PENDING,
+        timeout: float = LLM_TIMEOUT,
+        retries: int = LLM_RETRIES,
+        backoff: float = LLM_RETRY_BACKOFF
+    ):
+        self.host = host
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.requests = 0
+        self.failures = 0
+        self.retried = 0
+        # Tokens generated by the server, and generations cut short
+        self.generated_tokens = 0
+        self.aborted = 0
+        self._pending = threading.BoundedSemaphore(max(1, max_pending))
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name="llm-client", daemon=True)
+        self._thread.start()
+
+        async def setup():
+            self._in_flight = asyncio.Semaphore(max(1, max_in_flight))
+            self._http = httpx.AsyncClient(
+                # OLLAMA_HOST may be given as host:port, as ollama accepts it
+                base_url=host if "://" in host else f"http://{host}",
+                timeout=timeout,
+                limits=httpx.Limits(max_connections=LLM_MAX_CONNECTIONS, max_keepalive_connections=LLM_MAX_CONNECTIONS)
+            )
+        asyncio.run_coroutine_threadsafe(setup(), self._loop).result()
+
+    async def _stream_until(self, until: Callable[[str], bool], kwargs: dict) -> dict:
+        # Streams a generation and closes the connection, which makes the
+        # server stop generating, as soon as until accepts the text so far.
+        # Returns the final chunk with the whole text as its response.
+        parts = []
+        chunks = 0
+        last = {}
+        async with self._http.stream("POST", "/api/generate", json={**kwargs, "stream": True}) as response:
+            if response.is_error:
+                await response.aread()
+                raise ResponseError(response.text, response.status_code)
+            async for line in response.aiter_lines():
+                if not line:
+                    continue
+                chunk = json.loads(line)
+                if error := chunk.get("error"):
+                    raise ResponseError(error)
+                chunks += 1
+                parts.append(chunk.get("response", ""))
+                last = chunk
+                if chunk.get("done"):
+                    break
+                if until("".join(parts)):
+                    self.aborted += 1
+                    metrics.LLM_ABORTED_STREAMS.inc()
+                    break
+        # Every streamed chunk carries one token
+        return {**last, "response": "".join(parts), "eval_count": last.get("eval_count", chunks)}
+
+    async def _post(self, method: str, kwargs: dict) -> dict:
+        # Error responses raise ResponseError, as with the ollama client, so
+        # that the status code decides whether to retry
+        response = await self._http.post(f"/api/{method}", json={**kwargs, "stream": False})
+        if response.is_error:
+            raise ResponseError(response.text, response.status_code)
+        return response.json()
+
+    async def _request(self, method: str, kwargs: dict, until: Optional[Callable[[str], bool]] = None):
+        attempt = 0
+        while True:
+            try:
+                async with self._in_flight:
+                    self.requests += 1
+                    metrics.LLM_IN_FLIGHT.inc()
+                    try:
+                        with metrics.LLM_REQUEST_SECONDS.labels(method).time():
+                            if until is not None:
+                                response = await asyncio.wait_for(self._stream_until(until, kwargs), self.timeout)
+                            else:
+                                response = await asyncio.wait_for(self._post(method, kwargs), self.timeout)
+                    finally:
+                        metrics.LLM_IN_FLIGHT.dec()
+                    if isinstance(response, Mapping):
+                        self.generated_tokens += response.get("eval_count", 0)
+                        metrics.LLM_GENERATED_TOKENS.inc(response.get("eval_count", 0))
+                    metrics.LLM_REQUESTS.labels(method, "ok").inc()
+                    return response
+            except Exception as e:
+                if attempt >= self.retries or not _retryable(e):
+                    self.failures += 1
+                    metrics.LLM_REQUESTS.labels(method, "error").inc()
+                    raise
+                metrics.LLM_REQUESTS.labels(method, "retry").inc()
+            attempt += 1
+            self.retried += 1
+            # Exponential backoff with jitter, outside of the semaphore
+            await asyncio.sleep(self.backoff * 2 ** (attempt - 1) * (0.5 + random.random()))
+
+    def submit(self, method: str, until: Optional[Callable[[str], bool]] = None, **kwargs) -> Future:
+        # method is "generate" or "chat", kwargs the JSON body of the request
+        # to the Ollama API (model, prompt or messages, format, options...).
+        # With until, a generation is streamed and cut short once until
+        # returns True for the text generated so far.
+        self._pending.acquire()
+        try:
+            future = asyncio.run_coroutine_threadsafe(self._request(method, kwargs, until), self._loop)
+        except BaseException:
+            self._pending.release()
+            raise
+        future.add_done_callback(lambda _: self._pending.release())
+        return future
+
+    def generate(self, **kwargs):
+        return self.submit("generate", **kwargs).result()
+
+    def generate_until(self, until: Callable[[str], bool], **kwargs):
+        return self.submit("generate", until=until, **kwargs).result()
+
+    def chat(self, **kwargs):
+        return self.submit("chat", **kwargs).result()
+
+    def close(self):
+        async def shutdown():
+            await self._http.aclose()
+        asyncio.run_coroutine_threadsafe(shutdown(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+
+_shared: Optional[LLMClient] = None
+_shared_lock = threading.Lock()
+
+
+def shared_client() -> LLMClient:
+    # Created on first use, so importing a module that may call the LLM does
+    # not start the event loop thread
+    global _shared
+    with _shared_lock:
+        if _shared is None:
+            _shared = LLMClient()
+        return _shared
@@ -0,0 +1,108 @@
+import json
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+from typing import List, Optional
+
+
+@dataclass(init=True)
+class ManifestEntry:
+    path: str
+    size: int
+    mtime_ns: int
+    sha256: str
+    category: str
+    neighbor_ids: List[str]
+    neighbor_distances: List[float]
+    # Stage of the pipeline that decided the category
+    stage: str
+
+
+# Persistent record of previous scans. A file whose size and mtime did not
+# change, or whose content hash is already known, is answered from here
+# without embedding, kNN or LLM work. Entries are recorded under a version of
+# whatever else the verdicts depend on (see run.verdict_version); entries of
+# another version are not answered from.
+class ScanManifest:
+    def __init__(self, path: str, version: str = ""):
+        self.path = path
+        self.version = version
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.executescript(
+            """
+            PRAGMA journal_mode = WAL;
+            PRAGMA synchronous = NORMAL;
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                sha256 TEXT NOT NULL,
+                category TEXT NOT NULL,
+                neighbor_ids TEXT NOT NULL,
+                neighbor_distances TEXT NOT NULL,
+                stage TEXT NOT NULL,
+                updated_at REAL NOT NULL,
+                version TEXT NOT NULL DEFAULT ''
+            );
+            CREATE INDEX IF NOT EXISTS files_sha256 ON files (sha256);
+            """
+        )
+        # Manifests written before entries had a version
+        columns = [row[1] for row in self._db.execute("PRAGMA table_info(files)")]
+        if "version" not in columns:
+            self._db.execute("ALTER TABLE files ADD COLUMN version TEXT NOT NULL DEFAULT ''")
+        self._db.commit()
+
+    @staticmethod
+    def _entry(row) -> ManifestEntry:
+        return ManifestEntry(
+            path=row[0],
+            size=row[1],
+            mtime_ns=row[2],
+            sha256=row[3],
+            category=row[4],
+            neighbor_ids=json.loads(row[5]),
+            neighbor_distances=json.loads(row[6]),
+            stage=row[7]
+        )
+
+    def lookup_stat(self, path: str, size: int, mtime_ns: int) -> Optional[ManifestEntry]:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT * FROM files WHERE path = ? AND size = ? AND mtime_ns = ? AND version = ?",
+                (path, size, mtime_ns, self.version)
+            ).fetchone()
+        return self._entry(row) if row is not None else None
+
+    def lookup_hash(self, sha256: str) -> Optional[ManifestEntry]:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT * FROM files WHERE sha256 = ? AND version = ? ORDER BY updated_at DESC LIMIT 1",
+                (sha256, self.version)
+            ).fetchone()
+        return self._entry(row) if row is not None else None
+
+    def record(self, entry: ManifestEntry):
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    entry.path,
+                    entry.size,
+                    entry.mtime_ns,
+                    entry.sha256,
+                    entry.category,
+                    json.dumps(entry.neighbor_ids),
+                    json.dumps(entry.neighbor_distances),
+                    entry.stage,
+                    time.time(),
+                    self.version
+                )
+            )
+            self._db.commit()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM files").fetchone()[0]
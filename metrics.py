@@ -0,0 +1,131 @@
+import math
+import threading
+from typing import List, Optional, Tuple
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+from config import METRICS_PORT
+
+
+# From 1 ms to 2 minutes: a stage call on one small file up to an LLM answer
+# on a busy server
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+STAGE_SECONDS = Histogram("tfm_stage_seconds", "Duration of one call of a scan pipeline stage", ["stage"], buckets=LATENCY_BUCKETS)
+STAGE_ITEMS = Counter("tfm_stage_items", "Files handled by a scan pipeline stage", ["stage"])
+FILES = Counter("tfm_files", "Files scanned, by the stage that decided their category", ["decided_by"])
+FILE_ERRORS = Counter("tfm_file_errors", "Files that could not be scanned, by the stage that failed", ["stage"])
+BYTES_READ = Counter("tfm_bytes_read", "Bytes of source code read")
+CLASSIFY_FILE_SECONDS = Histogram("tfm_classify_file_seconds", "Duration of categorize.classify_file", buckets=LATENCY_BUCKETS)
+
+EMBEDDING_SECONDS = Histogram("tfm_embedding_seconds", "Duration of embedding the segments of a batch of files", buckets=LATENCY_BUCKETS)
+EMBEDDED_SEGMENTS = Counter("tfm_embedded_segments", "Segments embedded")
+EMBEDDING_REQUESTS = Counter("tfm_embedding_requests", "Requests to the Ollama embedding endpoints", ["endpoint"])
+EMBEDDING_REQUEST_SECONDS = Histogram("tfm_embedding_request_seconds", "Duration of an Ollama embedding request", ["endpoint"], buckets=LATENCY_BUCKETS)
+EMBEDDING_CACHE = Counter("tfm_embedding_cache_lookups", "Embedding cache lookups", ["result"])
+VECTOR_QUERY_SECONDS = Histogram("tfm_vector_query_seconds", "Duration of a nearest neighbor query to the reference collection", buckets=LATENCY_BUCKETS)
+PROTOTYPE_QUERY_SECONDS = Histogram("tfm_prototype_query_seconds", "Duration of a query to the category prototypes", buckets=LATENCY_BUCKETS)
+PROTOTYPE_FILES = Counter("tfm_prototype_files", "Files classified against the category prototypes, or sent on to the whole collection", ["result"])
+
+NEARDUP_FILES = Counter("tfm_neardup_files", "Files looked up among the sketches of classified files", ["result"])
+NEARDUP_SAVED_BYTES = Counter("tfm_neardup_saved_bytes", "Bytes of near-duplicate files that were not segmented nor embedded")
+NEARDUP_SAVED_LLM_CALLS = Counter("tfm_neardup_saved_llm_calls", "LLM adjudications that near-duplicate files did not need")
+
+LLM_REQUESTS = Counter("tfm_llm_requests", "LLM requests, by how they ended", ["method", "outcome"])
+LLM_REQUEST_SECONDS = Histogram("tfm_llm_request_seconds", "Duration of an LLM request", ["method"], buckets=LATENCY_BUCKETS)
+LLM_IN_FLIGHT = Gauge("tfm_llm_in_flight", "LLM requests waiting for the server")
+LLM_GENERATED_TOKENS = Counter("tfm_llm_generated_tokens", "Tokens generated by the LLM")
+LLM_ABORTED_STREAMS = Counter("tfm_llm_aborted_streams", "LLM generations cut short once the answer was known")
+LLM_CACHE = Counter("tfm_llm_cache_lookups", "LLM answer cache lookups", ["result"])
+
+SUMMARY_METRICS = [
+    STAGE_SECONDS, STAGE_ITEMS, FILES, FILE_ERRORS, BYTES_READ, CLASSIFY_FILE_SECONDS,
+    EMBEDDING_SECONDS, EMBEDDED_SEGMENTS, EMBEDDING_REQUESTS, EMBEDDING_REQUEST_SECONDS, EMBEDDING_CACHE,
+    VECTOR_QUERY_SECONDS, PROTOTYPE_QUERY_SECONDS, PROTOTYPE_FILES,
+    NEARDUP_FILES, NEARDUP_SAVED_BYTES, NEARDUP_SAVED_LLM_CALLS,
+    LLM_REQUESTS, LLM_REQUEST_SECONDS, LLM_GENERATED_TOKENS, LLM_ABORTED_STREAMS, LLM_CACHE,
+]
+
+_server_lock = threading.Lock()
+_server_port: Optional[int] = None
+
+
+def observe_stage(stage: str, items: int, seconds: float):
+    # Pipeline observer
+    STAGE_SECONDS.labels(stage).observe(seconds)
+    STAGE_ITEMS.labels(stage).inc(items)
+
+
+def record_item(item):
+    # A file that came out of the scan pipeline
+    if item.error is not None:
+        FILE_ERRORS.labels(item.error.split(":", 1)[0]).inc()
+    else:
+        FILES.labels(item.stage or "none").inc()
+
+
+def serve(port: int = METRICS_PORT) -> bool:
+    # Starts the /metrics endpoint once per process; False when port is 0
+    global _server_port
+    if not port:
+        return False
+    with _server_lock:
+        if _server_port is None:
+            start_http_server(port)
+            _server_port = port
+    return True
+
+
+def _quantile(buckets: List[Tuple[float, float]], q: float) -> float:
+    # Estimate from cumulative (upper bound, count) buckets, interpolating
+    # linearly inside the bucket like Prometheus' histogram_quantile
+    total = buckets[-1][1]
+    if total == 0:
+        return 0.0
+    rank = q * total
+    lower, below = 0.0, 0.0
+    for upper, count in buckets:
+        if count >= rank:
+            if math.isinf(upper):
+                return lower
+            return lower + (upper - lower) * (rank - below) / max(count - below, 1e-12)
+        lower, below = upper, count
+    return lower
+
+
+def summary() -> List[str]:
+    # One line per non-zero counter and histogram series
+    lines = []
+    for metric in SUMMARY_METRICS:
+        for family in metric.collect():
+            if family.type == "histogram":
+                series = {}
+                for sample in family.samples:
+                    labels = tuple(sorted((k, v) for k, v in sample.labels.items() if k != "le"))
+                    entry = series.setdefault(labels, {"buckets": []})
+                    if sample.name.endswith("_bucket"):
+                        entry["buckets"].append((float(sample.labels["le"]), sample.value))
+                    elif sample.name.endswith("_count"):
+                        entry["count"] = sample.value
+                    elif sample.name.endswith("_sum"):
+                        entry["sum"] = sample.value
+                for labels, entry in sorted(series.items()):
+                    if not entry.get("count"):
+                        continue
+                    buckets = sorted(entry["buckets"])
+                    lines.append(
+                        f"{family.name}{_format_labels(labels)}: {entry['count']:.0f} calls, {entry['sum']:.2f}s, "
+                        f"mean {entry['sum'] / entry['count'] * 1000:.1f} ms, "
+                        f"~p50 {_quantile(buckets, 0.5) * 1000:.1f} ms, ~p95 {_quantile(buckets, 0.95) * 1000:.1f} ms"
+                    )
+            else:
+                for sample in family.samples:
+                    if sample.name.endswith("_created") or not sample.value:
+                        continue
+                    labels = tuple(sorted(sample.labels.items()))
+                    lines.append(f"{sample.name}{_format_labels(labels)}: {sample.value:.0f}")
+    return lines
+
+
+def _format_labels(labels) -> str:
+    if not labels:
+        return ""
+    return "{" + ", ".join(f'{k}="{v}"' for k, v in labels) + "}"
@@ -0,0 +1,252 @@
+import re
+import sqlite3
+import threading
+import time
+import zlib
+from dataclasses import dataclass
+from typing import Optional
+import numpy as np
+from config import NEARDUP_BANDS, NEARDUP_MIN_SIMILARITY, NEARDUP_PERMUTATIONS, NEARDUP_SHINGLE
+import metrics
+
+
+# Identifiers and numbers; punctuation and whitespace are left out so that
+# formatting and the syntax of the language matter less than the names and
+# the constants, which is what copies of an algorithm share
+TOKEN_REGEX = re.compile(r"0[xX][0-9a-fA-F]+|\d+|[A-Za-z_][A-Za-z0-9_]*")
+# Odd 64 bit multipliers of the shingle hash and of its final mixing
+SHINGLE_MULTIPLIER = np.uint64(0x9E3779B97F4A7C15)
+MIX_MULTIPLIER = np.uint64(0xBF58476D1CE4E5B9)
+# Fixed, so that sketches stored by earlier scans stay comparable
+PERMUTATION_SEED = 0x5EED
+# Shingles hashed at once per block of the (shingles x permutations) matrix
+BLOCK_SHINGLES = 4096
+
+
+def normalized_tokens(code: str) -> list:
+    # Lower case, and hexadecimal literals in decimal so that 0x6A09E667 in
+    # C matches 0x6a09e667 in Go and 1779033703 in Python
+    tokens = []
+    for token in TOKEN_REGEX.findall(code):
+        if token[:2] in ("0x", "0X"):
+            token = str(int(token, 16))
+        tokens.append(token.lower())
+    return tokens
+
+
+def _permutations(count: int):
+    rng = np.random.default_rng(PERMUTATION_SEED)
+    a = rng.integers(1, 2 ** 63, size=count, dtype=np.uint64) * np.uint64(2) + np.uint64(1)
+    b = rng.integers(0, 2 ** 63, size=count, dtype=np.uint64)
+    return a, b
+
+
+PERMUTATION_A, PERMUTATION_B = _permutations(NEARDUP_PERMUTATIONS)
+
+
+def shingle_hashes(tokens: list, size: int = NEARDUP_SHINGLE) -> np.ndarray:
+    # Distinct 64 bit hashes of the runs of size consecutive tokens; a file
+    # shorter than that is one shingle
+    if not tokens:
+        return np.zeros(0, dtype=np.uint64)
+    vocabulary = {}
+    ids = np.fromiter((vocabulary.setdefault(token, len(vocabulary)) for token in tokens), dtype=np.int64, count=len(tokens))
+    token_hashes = np.fromiter(
+        (zlib.crc32(token.encode()) for token in vocabulary),
+        dtype=np.uint64,
+        count=len(vocabulary)
+    )[ids]
+    size = min(size, len(tokens))
+    shingles = np.zeros(len(tokens) - size + 1, dtype=np.uint64)
+    for offset in range(size):
+        shingles = shingles * SHINGLE_MULTIPLIER + token_hashes[offset:len(tokens) - size + 1 + offset]
+    # Spread the bits, the min-hashes below only keep the high half
+    shingles ^= shingles >> np.uint64(31)
+    shingles *= MIX_MULTIPLIER
+    shingles ^= shingles >> np.uint64(29)
+    return np.unique(shingles)
+
+
+def minhash(shingles: np.ndarray) -> np.ndarray:
+    # The smallest value of every permutation (a * x + b mod 2^64, high 32
+    # bits) over the shingles, a block of shingles at a time
+    signature = np.full(len(PERMUTATION_A), np.iinfo(np.uint32).max, dtype=np.uint32)
+    with np.errstate(over="ignore"):
+        for start in range(0, len(shingles), BLOCK_SHINGLES):
+            block = shingles[start:start + BLOCK_SHINGLES, None]
+            hashed = ((block * PERMUTATION_A + PERMUTATION_B) >> np.uint64(32)).astype(np.uint32)
+            signature = np.minimum(signature, hashed.min(axis=0))
+    return signature
+
+
+def sketch(code: str) -> Optional[np.ndarray]:
+    # MinHash signature of the file, None when it has no tokens
+    shingles = shingle_hashes(normalized_tokens(code))
+    return minhash(shingles) if len(shingles) else None
+
+
+def similarity(a: np.ndarray, b: np.ndarray) -> float:
+    # Estimated Jaccard similarity of the shingle sets
+    return float(np.mean(a == b))
+
+
+def band_keys(signature: np.ndarray, bands: int = NEARDUP_BANDS) -> list:
+    # One key per band of rows; two files share a key with probability
+    # s^rows per band, so pairs above about (1/bands)^(1/rows) are found
+    rows = len(signature) // bands
+    return [bytes([band]) + signature[band * rows:(band + 1) * rows].tobytes() for band in range(bands)]
+
+
+@dataclass(init=True)
+class NearDuplicate:
+    sha256: str
+    path: str
+    category: str
+    # Stage that decided the category of the earlier file
+    stage: str
+    similarity: float
+
+
+# Sketches of files the model stages classified, with their verdicts, and an
+# LSH table of their band keys in SQLite. A file whose sketch is close enough
+# to one of them takes its verdict instead of going through the embedding,
+# kNN and LLM stages. Verdicts are stored under a version of whatever else
+# they depend on (see run.verdict_version); those of another version are
+# not reused.
+class NearDupIndex:
+    def __init__(
+        self,
+        path: str,
+        version: str = "",
+        min_similarity: float = NEARDUP_MIN_SIMILARITY,
+        bands: int = NEARDUP_BANDS
+    ):
+        self.path = path
+        self.version = version
+        self.min_similarity = min_similarity
+        self.bands = bands
+        self.lookups = 0
+        self.hits = 0
+        self.late_hits = 0
+        # Work the hits did not redo: bytes of code not segmented and
+        # embedded, and LLM adjudications
+        self.saved_bytes = 0
+        self.saved_llm_calls = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.executescript(
+            """
+            PRAGMA journal_mode = WAL;
+            PRAGMA synchronous = NORMAL;
+            CREATE TABLE IF NOT EXISTS sketches (
+                sha256 TEXT PRIMARY KEY,
+                path TEXT NOT NULL,
+                category TEXT NOT NULL,
+                stage TEXT NOT NULL,
+                signature BLOB NOT NULL,
+                updated_at REAL NOT NULL,
+                version TEXT NOT NULL DEFAULT ''
+            );
+            CREATE TABLE IF NOT EXISTS bands (
+                key BLOB NOT NULL,
+                sha256 TEXT NOT NULL,
+                PRIMARY KEY (key, sha256)
+            ) WITHOUT ROWID;
+            """
+        )
+        # Stores written before verdicts had a version
+        columns = [row[1] for row in self._db.execute("PRAGMA table_info(sketches)")]
+        if "version" not in columns:
+            self._db.execute("ALTER TABLE sketches ADD COLUMN version TEXT NOT NULL DEFAULT ''")
+        self._db.commit()
+
+    def lookup(self, signature: np.ndarray, size: int = 0, late: bool = False) -> Optional[NearDuplicate]:
+        # The most similar known file above min_similarity. size is the
+        # length of the file asking, not embedded on a hit. late lookups are
+        # those of files the kNN stage sent on to the LLM, which a hit spares,
+        # asked again in case their original was classified meanwhile.
+        keys = band_keys(signature, self.bands)
+        with self._lock:
+            rows = self._db.execute(
+                f"""
+                SELECT sha256, path, category, stage, signature FROM sketches WHERE version = ? AND sha256 IN (
+                    SELECT sha256 FROM bands WHERE key IN ({", ".join("?" * len(keys))})
+                )
+                """,
+                [self.version, *keys]
+            ).fetchall()
+        best = None
+        for sha256, path, category, stage, stored in rows:
+            score = similarity(signature, np.frombuffer(stored, dtype=np.uint32))
+            if score >= self.min_similarity and (best is None or score > best.similarity):
+                best = NearDuplicate(sha256, path, category, stage, score)
+        saves_llm_call = best is not None and (late or best.stage.startswith("llm"))
+        with self._lock:
+            self.lookups += not late
+            if best is not None:
+                self.hits += 1
+                self.late_hits += late
+                self.saved_bytes += size
+                self.saved_llm_calls += saves_llm_call
+        if not late or best is not None:
+            metrics.NEARDUP_FILES.labels("miss" if best is None else "late_hit" if late else "hit").inc()
+        if best is not None:
+            metrics.NEARDUP_SAVED_BYTES.inc(size)
+            metrics.NEARDUP_SAVED_LLM_CALLS.inc(saves_llm_call)
+        return best
+
+    def add(self, sha256: str, path: str, category: str, stage: str, signature: np.ndarray):
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO sketches VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (sha256, path, category, stage, signature.astype(np.uint32).tobytes(), time.time(), self.version)
+            )
+            self._db.executemany(
+                "INSERT OR IGNORE INTO bands VALUES (?, ?)",
+                [(key, sha256) for key in band_keys(signature, self.bands)]
+            )
+            self._db.commit()
+
+    def count(self) -> int:
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM sketches").fetchone()[0]
+
+
+if __name__ == '__main__':
+    # python neardup.py <folder>: groups of near-duplicate files of a folder,
+    # with the time spent sketching them
+    import argparse
+    import os
+    from discovery import discover_files
+    parser = argparse.ArgumentParser(description="Near-duplicate files of a folder")
+    parser.add_argument("folder_path")
+    parser.add_argument("--min-similarity", type=float, default=NEARDUP_MIN_SIMILARITY)
+    args = parser.parse_args()
+
+    paths = list(discover_files(args.folder_path))
+    start = time.perf_counter()
+    sketches = {}
+    for path in paths:
+        with open(path, errors="replace") as f:
+            signature = sketch(f.read())
+        if signature is not None:
+            sketches[path] = signature
+    elapsed = time.perf_counter() - start
+    print(f"Sketched {len(sketches)} files in {elapsed:.2f} s ({elapsed * 1000 / max(1, len(sketches)):.2f} ms per file)")
+
+    # An in-memory index: the first file of every group stands for it
+    index = NearDupIndex(":memory:", min_similarity=args.min_similarity)
+    groups = {}
+    for path, signature in sketches.items():
+        match = index.lookup(signature, os.path.getsize(path))
+        if match is None:
+            index.add(path, path, "", "", signature)
+            groups[path] = []
+        else:
+            groups[match.path].append((path, match.similarity))
+    duplicates = {path: copies for path, copies in groups.items() if copies}
+    for path, copies in sorted(duplicates.items()):
+        print(path)
+        for copy, score in copies:
+            print(f"  {score:.2f} {copy}")
+    print(f"{sum(len(copies) for copies in duplicates.values())} near-duplicates of {len(duplicates)} files, {index.saved_bytes} bytes")
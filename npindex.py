@@ -0,0 +1,431 @@
+import json
+import os
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Sequence
+import numpy as np
+from config import NPINDEX_DTYPE, NPINDEX_QUANTIZATION, NPINDEX_RERANK_CANDIDATES
+
+
+# Distances computed at once per block of reference rows, bounding the
+# temporary (queries x rows) and (rows x dimension) matrices to about 64 MB
+# of float32
+BLOCK_ELEMENTS = 16 * 1024 * 1024
+
+# The matrix and norms of every write go to new files named after its
+# generation, and the sidecar, replaced last, names the ones to use: an
+# interrupted write leaves the previous generation in place
+METADATA_FILE = "metadata.json"
+
+
+QUANTIZATIONS = ("none", "int8", "binary")
+# The +-1 values of the 8 sign bits of every byte, most significant first
+# like np.packbits
+SIGN_TABLE = np.where(np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1), 1.0, -1.0).astype(np.float32)
+
+
+def _write_atomic(path: str, write: Callable[[str], None]):
+    tmp = f"{path}.tmp"
+    write(tmp)
+    os.replace(tmp, path)
+
+
+def quantization_params(vectors: np.ndarray, quantization: str) -> np.ndarray:
+    # int8: the scale of every dimension, its largest magnitude over 127.
+    # binary: the mean of every dimension, which the signs are taken around
+    # so that dimensions that are mostly positive still tell vectors apart.
+    sums = np.zeros(vectors.shape[1], dtype=np.float64)
+    peaks = np.zeros(vectors.shape[1], dtype=np.float32)
+    block = max(1, BLOCK_ELEMENTS // max(1, vectors.shape[1]))
+    for start in range(0, len(vectors), block):
+        rows = np.asarray(vectors[start:start + block], dtype=np.float32)
+        sums += rows.sum(axis=0)
+        peaks = np.maximum(peaks, np.abs(rows).max(axis=0))
+    if quantization == "int8":
+        return np.maximum(peaks / 127, np.finfo(np.float32).tiny)
+    return (sums / max(1, len(vectors))).astype(np.float32)
+
+
+def quantize(vectors: np.ndarray, quantization: str, params: np.ndarray) -> np.ndarray:
+    # int8 codes, or the sign bits packed 8 to a byte
+    codes = []
+    block = max(1, BLOCK_ELEMENTS // max(1, vectors.shape[1]))
+    for start in range(0, len(vectors), block):
+        rows = np.asarray(vectors[start:start + block], dtype=np.float32)
+        if quantization == "int8":
+            codes.append(np.clip(np.rint(rows / params), -127, 127).astype(np.int8))
+        else:
+            codes.append(np.packbits(rows > params, axis=1))
+    if not codes:
+        width = vectors.shape[1] if quantization == "int8" else (vectors.shape[1] + 7) // 8
+        return np.empty((0, width), dtype=np.int8 if quantization == "int8" else np.uint8)
+    return np.concatenate(codes)
+
+
+# Exact kNN index over a memory-mapped matrix, with the ids and metadata in
+# a JSON sidecar. It answers the calls categorize and vecstore make on a
+# Chroma collection (query, upsert, get, count) with the same squared L2
+# distances, so the routing thresholds carry over. Opening it maps the files
+# and reads the sidecar; queries are blocked matrix products. Writes rewrite
+# the files, which suits a reference corpus that grows slowly; there is one
+# writer at a time.
+#
+# With an int8 or binary quantization, only the codes are read into memory:
+# they pick rerank candidates per query (int8 dot products, or Hamming
+# distances between sign bits), and the float rows of those candidates are
+# read from the mapped matrix to rank them exactly. The distances are exact;
+# a neighbor can only be missed when it is not among the candidates.
+class NumpyIndex:
+    def __init__(
+        self,
+        path: str,
+        embedding_function: Optional[Callable] = None,
+        dtype: str = NPINDEX_DTYPE,
+        quantization: str = NPINDEX_QUANTIZATION,
+        rerank: int = NPINDEX_RERANK_CANDIDATES
+    ):
+        if quantization not in QUANTIZATIONS:
+            raise ValueError(f"Unknown quantization {quantization}, expected one of {QUANTIZATIONS}")
+        self.path = path
+        self.embedding_function = embedding_function
+        self.dtype = np.dtype(dtype)
+        self.quantization = quantization
+        self.rerank = rerank
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        metadata_path = os.path.join(self.path, METADATA_FILE)
+        if not os.path.exists(metadata_path):
+            self._generation = 0
+            self._ids: List[str] = []
+            self._metadatas: List[dict] = []
+            self._vectors = None
+            self._norms = None
+            self._codes = None
+            self._params = None
+        else:
+            with open(metadata_path) as f:
+                sidecar = json.load(f)
+            self._generation = sidecar["generation"]
+            self._ids = sidecar["ids"]
+            self._metadatas = sidecar["metadatas"]
+            self._vectors = np.load(os.path.join(self.path, sidecar["vectors"]), mmap_mode="r")
+            self._norms = np.load(os.path.join(self.path, sidecar["norms"]), mmap_mode="r")
+            if len(self._vectors) != len(self._ids):
+                raise ValueError(f"{self.path}: {len(self._vectors)} vectors for {len(self._ids)} ids")
+            self._codes = self._params = None
+            if self.quantization != "none":
+                if sidecar.get("quantization") == self.quantization:
+                    # Read in full, they are what stays in memory
+                    self._codes = np.load(os.path.join(self.path, sidecar["codes"]))
+                    self._params = np.load(os.path.join(self.path, sidecar["params"]))
+                else:
+                    # Written with another quantization: computed once here
+                    # and stored by the next write
+                    self._params = quantization_params(self._vectors, self.quantization)
+                    self._codes = quantize(self._vectors, self.quantization, self._params)
+        self._positions = {id: position for position, id in enumerate(self._ids)}
+
+    @property
+    def dim(self) -> Optional[int]:
+        return None if self._vectors is None else self._vectors.shape[1]
+
+    def count(self) -> int:
+        return len(self._ids)
+
+    def _embed(self, documents: Sequence[str]) -> np.ndarray:
+        if self.embedding_function is None:
+            raise ValueError("Documents given to an index without an embedding function")
+        return np.asarray(self.embedding_function(list(documents)), dtype=np.float32)
+
+    def upsert(
+        self,
+        ids: Sequence[str],
+        metadatas: Optional[Sequence[dict]] = None,
+        documents: Optional[Sequence[str]] = None,
+        embeddings: Optional[Sequence[Sequence[float]]] = None
+    ):
+        # Documents are embedded, not stored: the scan never reads them back
+        if len(ids) == 0:
+            return
+        if embeddings is None:
+            vectors = self._embed(documents)
+        else:
+            vectors = np.asarray(embeddings, dtype=np.float32)
+        metadatas = list(metadatas) if metadatas is not None else [{} for _ in ids]
+        with self._lock:
+            if self._vectors is not None and vectors.shape[1] != self.dim:
+                raise ValueError(f"Vectors of dimension {vectors.shape[1]} for an index of dimension {self.dim}")
+            all_ids = list(self._ids)
+            all_metadatas = list(self._metadatas)
+            matrix = np.empty((0, vectors.shape[1]), dtype=self.dtype) if self._vectors is None else np.array(self._vectors)
+            positions = dict(self._positions)
+            new_rows = []
+            for id, metadata, vector in zip(ids, metadatas, vectors):
+                position = positions.get(id)
+                if position is None:
+                    positions[id] = len(all_ids)
+                    all_ids.append(id)
+                    all_metadatas.append(metadata)
+                    new_rows.append(vector)
+                else:
+                    all_metadatas[position] = metadata
+                    # An id given twice is still in new_rows
+                    if position < len(matrix):
+                        matrix[position] = vector
+                    else:
+                        new_rows[position - len(matrix)] = vector
+            if new_rows:
+                matrix = np.concatenate([matrix, np.asarray(new_rows, dtype=self.dtype)])
+            self._write(all_ids, all_metadatas, matrix.astype(self.dtype, copy=False))
+            self._load()
+
+    def _write(self, ids: List[str], metadatas: List[dict], matrix: np.ndarray):
+        os.makedirs(self.path, exist_ok=True)
+        # Norms of the stored (possibly float16) vectors, so that distances
+        # stay consistent with the products computed from them
+        as_float32 = matrix.astype(np.float32)
+        norms = np.einsum("ij,ij->i", as_float32, as_float32)
+
+        def save(array):
+            # Through a file object, as np.save appends .npy to names that lack it
+            def write(tmp):
+                with open(tmp, "wb") as f:
+                    np.save(f, array)
+            return write
+
+        generation = self._generation + 1
+        files = {"vectors": f"vectors-{generation}.npy", "norms": f"norms-{generation}.npy"}
+        _write_atomic(os.path.join(self.path, files["vectors"]), save(matrix))
+        _write_atomic(os.path.join(self.path, files["norms"]), save(norms))
+        if self.quantization != "none":
+            files.update(codes=f"codes-{generation}.npy", params=f"params-{generation}.npy")
+            params = quantization_params(matrix, self.quantization)
+            _write_atomic(os.path.join(self.path, files["codes"]), save(quantize(matrix, self.quantization, params)))
+            _write_atomic(os.path.join(self.path, files["params"]), save(params))
+
+        def save_metadata(tmp):
+            with open(tmp, "w") as f:
+                json.dump(
+                    {"generation": generation, "quantization": self.quantization, **files, "ids": ids, "metadatas": metadatas},
+                    f
+                )
+
+        _write_atomic(os.path.join(self.path, METADATA_FILE), save_metadata)
+        # Older generations and leftovers of interrupted writes; mapped
+        # files stay readable until unmapped
+        for name in os.listdir(self.path):
+            if name.endswith((".npy", ".tmp")) and name not in files.values():
+                os.remove(os.path.join(self.path, name))
+
+    def get(self, ids: Optional[Sequence[str]] = None, include: Sequence[str] = ("metadatas",)) -> dict:
+        # The entries with the given ids that exist, or every entry
+        positions = range(len(self._ids)) if ids is None else [self._positions[id] for id in ids if id in self._positions]
+        result = {"ids": [self._ids[position] for position in positions]}
+        if "metadatas" in include:
+            result["metadatas"] = [self._metadatas[position] for position in positions]
+        if "embeddings" in include:
+            result["embeddings"] = [np.asarray(self._vectors[position], dtype=np.float32) for position in positions]
+        return result
+
+    @staticmethod
+    def _smallest(count: int, k: int, queries: int, block: int, scores_of: Callable[[int, int], np.ndarray]):
+        # Indices and scores of the k smallest scores of every query, lowest
+        # first, ties by index. scores_of(start, stop) scores a block of rows,
+        # and only the running best k are kept between blocks.
+        best_indices = np.empty((queries, 0), dtype=np.int64)
+        best_scores = np.empty((queries, 0), dtype=np.float32)
+        for start in range(0, count, block):
+            scores = scores_of(start, min(count, start + block))
+            indices = np.broadcast_to(np.arange(start, start + scores.shape[1]), scores.shape)
+            scores = np.concatenate([best_scores, scores], axis=1)
+            indices = np.concatenate([best_indices, indices], axis=1)
+            if scores.shape[1] > k:
+                keep = np.argpartition(scores, k - 1, axis=1)[:, :k]
+                scores = np.take_along_axis(scores, keep, axis=1)
+                indices = np.take_along_axis(indices, keep, axis=1)
+            best_scores, best_indices = scores, indices
+        order = np.lexsort((best_indices, best_scores), axis=1)
+        return np.take_along_axis(best_indices, order, axis=1), np.take_along_axis(best_scores, order, axis=1)
+
+    def _exact(self, queries: np.ndarray, k: int):
+        # |q|^2 + |x|^2 - 2 q.x over every row
+        vectors, norms = self._vectors, self._norms
+        query_norms = np.einsum("ij,ij->i", queries, queries)
+
+        def scores_of(start, stop):
+            distances = queries @ np.asarray(vectors[start:stop], dtype=np.float32).T
+            distances *= -2
+            distances += query_norms[:, None]
+            distances += norms[start:stop][None, :]
+            return distances
+
+        block = max(256, BLOCK_ELEMENTS // max(len(queries), queries.shape[1]))
+        return self._smallest(len(vectors), k, len(queries), block, scores_of)
+
+    def _candidates(self, queries: np.ndarray, k: int) -> np.ndarray:
+        # The k best rows of every query by their codes
+        codes, norms = self._codes, self._norms
+        if self.quantization == "int8":
+            # |x|^2 - 2 q.x, the same ranking as the squared distance, with
+            # the dot product taken against the scaled codes
+            scaled = queries * self._params
+
+            def scores_of(start, stop):
+                scores = scaled @ codes[start:stop].astype(np.float32).T
+                scores *= -2
+                scores += norms[start:stop][None, :]
+                return scores
+        else:
+            # The Hamming distance between sign bits ranks like minus the
+            # dot product of the +-1 vectors, which BLAS computes much faster
+            # than counting bits
+            signs = np.where(queries > self._params, 1.0, -1.0).astype(np.float32)
+            dim = queries.shape[1]
+
+            def scores_of(start, stop):
+                unpacked = SIGN_TABLE[codes[start:stop]].reshape(stop - start, -1)[:, :dim]
+                return -(signs @ unpacked.T)
+
+        block = max(256, BLOCK_ELEMENTS // max(len(queries), queries.shape[1]))
+        return self._smallest(len(codes), k, len(queries), block, scores_of)[0]
+
+    def _rerank(self, queries: np.ndarray, candidates: np.ndarray, k: int):
+        # Exact distances to the candidates, reading only their float rows,
+        # a few queries at a time so the rows read stay bounded
+        indices = np.empty((len(queries), k), dtype=np.int64)
+        distances = np.empty((len(queries), k), dtype=np.float32)
+        step = max(1, BLOCK_ELEMENTS // max(1, candidates.shape[1] * queries.shape[1]))
+        for start in range(0, len(queries), step):
+            chunk = candidates[start:start + step]
+            rows, positions = np.unique(chunk, return_inverse=True)
+            vectors = np.asarray(self._vectors[rows], dtype=np.float32)
+            dots = queries[start:start + step] @ vectors.T
+            chunk_distances = (
+                np.einsum("ij,ij->i", queries[start:start + step], queries[start:start + step])[:, None]
+                + self._norms[rows][None, :]
+                - 2 * dots
+            )
+            chunk_distances = np.take_along_axis(chunk_distances, positions.reshape(chunk.shape), axis=1)
+            order = np.lexsort((chunk, chunk_distances), axis=1)[:, :k]
+            indices[start:start + step] = np.take_along_axis(chunk, order, axis=1)
+            distances[start:start + step] = np.take_along_axis(chunk_distances, order, axis=1)
+        return indices, distances
+
+    def top_k(self, queries: np.ndarray, k: int, exact: bool = False):
+        # Indices and squared L2 distances of the k nearest rows of every
+        # query, nearest first, ties by insertion order. exact skips the
+        # quantized candidate search.
+        queries = np.ascontiguousarray(queries, dtype=np.float32)
+        count = 0 if self._vectors is None else len(self._vectors)
+        k = min(k, count)
+        if k == 0:
+            return np.empty((len(queries), 0), dtype=np.int64), np.empty((len(queries), 0), dtype=np.float32)
+        candidates = max(k, self.rerank)
+        if exact or self._codes is None or candidates >= count:
+            indices, distances = self._exact(queries, k)
+        else:
+            indices, distances = self._rerank(queries, self._candidates(queries, candidates), k)
+        return indices, np.maximum(distances, 0.0)
+
+    def memory(self) -> Dict[str, int]:
+        # Bytes of the float matrix, and of what queries keep in memory: the
+        # codes with their parameters, or the whole matrix without them
+        floats = 0 if self._vectors is None else self._vectors.nbytes
+        resident = floats if self._codes is None else self._codes.nbytes + self._params.nbytes
+        norms = 0 if self._norms is None else self._norms.nbytes
+        return {"vectors": floats, "resident": resident + norms}
+
+    def query(
+        self,
+        query_texts: Optional[Sequence[str]] = None,
+        query_embeddings: Optional[Sequence[Sequence[float]]] = None,
+        n_results: int = 10,
+        include: Sequence[str] = ("metadatas", "distances")
+    ) -> Dict[str, Optional[list]]:
+        queries = self._embed(query_texts) if query_embeddings is None else np.asarray(query_embeddings, dtype=np.float32)
+        if self._vectors is not None and queries.shape[1] != self.dim:
+            raise ValueError(f"Queries of dimension {queries.shape[1]} for an index of dimension {self.dim}")
+        indices, distances = self.top_k(queries, n_results)
+        return {
+            "ids": [[self._ids[i] for i in row] for row in indices.tolist()],
+            "metadatas": [[self._metadatas[i] for i in row] for row in indices.tolist()] if "metadatas" in include else None,
+            "distances": distances.tolist() if "distances" in include else None,
+            "documents": None,
+            "embeddings": None,
+        }
+
+
+def recall_at(index: "NumpyIndex", k: int = 4, samples: int = 200, seed: int = 0) -> Dict[str, float]:
+    # Share of the exact k nearest neighbors that the quantized search finds,
+    # with stored vectors as queries and their own rows left out of both
+    rng = np.random.default_rng(seed)
+    rows = np.sort(rng.choice(index.count(), size=min(samples, index.count()), replace=False))
+    queries = np.asarray(index._vectors[rows], dtype=np.float32)
+    start = time.perf_counter()
+    exact, _ = index.top_k(queries, k + 1, exact=True)
+    exact_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    found, _ = index.top_k(queries, k + 1)
+    seconds = time.perf_counter() - start
+    hits = 0
+    for row, exact_row, found_row in zip(rows, exact.tolist(), found.tolist()):
+        expected = [i for i in exact_row if i != row][:k]
+        hits += len(set(expected) & set(i for i in found_row if i != row))
+    return {
+        "recall": hits / (k * len(rows)) if len(rows) else 1.0,
+        "queries": len(rows),
+        "exact_ms_per_query": exact_seconds * 1000 / max(1, len(rows)),
+        "ms_per_query": seconds * 1000 / max(1, len(rows)),
+    }
+
+
+if __name__ == '__main__':
+    # python npindex.py [--from-chroma] [--quantization int8]: copy the Chroma
+    # reference collection of the current embedding backend into the NumPy
+    # index, and time opening and querying it. --recall compares every
+    # quantization with the exact search.
+    import argparse
+    from config import NPINDEX_DIR
+    parser = argparse.ArgumentParser(description="NumPy kNN index of the reference vectors")
+    parser.add_argument("--from-chroma", action="store_true", help="copy the Chroma collection into the index")
+    parser.add_argument("--dtype", default=NPINDEX_DTYPE, choices=["float32", "float16"])
+    parser.add_argument("--quantization", default=NPINDEX_QUANTIZATION, choices=QUANTIZATIONS)
+    parser.add_argument("--rerank", type=int, default=NPINDEX_RERANK_CANDIDATES, help="candidates ranked exactly")
+    parser.add_argument("--recall", action="store_true", help="report memory and recall@4 of each quantization")
+    parser.add_argument("--samples", type=int, default=200, help="queries of the recall report")
+    args = parser.parse_args()
+
+    from vecstore import collection_name
+    path = os.path.join(NPINDEX_DIR, collection_name())
+    if args.from_chroma:
+        import chromadb
+        source = chromadb.PersistentClient('chroma.db').get_collection(collection_name())
+        entries = source.get(include=["embeddings", "metadatas"])
+        NumpyIndex(path, dtype=args.dtype, quantization=args.quantization).upsert(
+            entries["ids"], entries["metadatas"], embeddings=entries["embeddings"]
+        )
+        print(f"Copied {len(entries['ids'])} vectors from Chroma to {path}")
+
+    start = time.perf_counter()
+    index = NumpyIndex(path, dtype=args.dtype, quantization=args.quantization, rerank=args.rerank)
+    opened = time.perf_counter() - start
+    stored = index._vectors.dtype if index.count() else args.dtype
+    print(f"{index.count()} vectors of dimension {index.dim} ({stored}, {args.quantization}), opened in {opened * 1000:.2f} ms")
+    if index.count() and not args.recall:
+        queries = np.asarray(index._vectors[:64], dtype=np.float32)
+        start = time.perf_counter()
+        index.top_k(queries, 4)
+        elapsed = time.perf_counter() - start
+        print(f"{len(queries)} queries in {elapsed * 1000:.2f} ms")
+    if index.count() and args.recall:
+        print("Quantization | Resident MB | Saved | Recall@4 | ms/query (exact)")
+        for quantization in QUANTIZATIONS:
+            quantized = NumpyIndex(path, dtype=args.dtype, quantization=quantization, rerank=args.rerank)
+            memory = quantized.memory()
+            report = recall_at(quantized, samples=args.samples)
+            print(
+                f"{quantization:12} | {memory['resident'] / 2 ** 20:11.1f} | {1 - memory['resident'] / (memory['vectors'] + index._norms.nbytes):5.0%} "
+                f"| {report['recall']:8.3f} | {report['ms_per_query']:.3f} ({report['exact_ms_per_query']:.3f})"
+            )
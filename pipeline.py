@@ -0,0 +1,200 @@
+import queue
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from typing import Callable, Iterable, Iterator, List, Optional
+
+
+_DONE = object()
+
+
+@dataclass(init=True)
+class ScanItem:
+    index: int
+    path: str
+    size: Optional[int] = None
+    mtime_ns: Optional[int] = None
+    sha256: Optional[str] = None
+    code: Optional[str] = None
+    # signatures.SignatureResult and prefilter.PrefilterResult of the file
+    signatures: Optional[object] = None
+    prefilter: Optional[object] = None
+    # neardup.sketch of the file, once the cheap stages did not label it
+    sketch: Optional[object] = None
+    segments: Optional[list] = None
+    embeddings: Optional[list] = None
+    metadata: Optional[dict] = None
+    category: Optional[str] = None
+    # Name of the stage that decided the category
+    stage: Optional[str] = None
+    error: Optional[str] = None
+
+    @property
+    def finished(self) -> bool:
+        return self.category is not None or self.error is not None
+
+
+@dataclass(init=True)
+class Stage:
+    name: str
+    # Takes an item, or a list of items when batch_size > 1, and returns it
+    # updated. Items that are already finished skip the remaining stages.
+    fn: Callable
+    workers: int = 1
+    # "thread" for I/O bound work, "process" for CPU bound work. Process
+    # stages need a picklable, module level fn.
+    kind: str = "thread"
+    batch_size: int = 1
+    queue_size: int = 64
+
+
+class Pipeline:
+    def __init__(
+        self,
+        stages: List[Stage],
+        ordered: bool = True,
+        observer: Optional[Callable[[str, int, float], None]] = None
+    ):
+        # observer(stage name, items, seconds) is called from the worker
+        # threads after every call of a stage function
+        self.stages = stages
+        self.ordered = ordered
+        self.observer = observer
+        self._stop = threading.Event()
+        self._errors: List[BaseException] = []
+
+    def _put(self, q: queue.Queue, item):
+        while not self._stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def _get(self, q: queue.Queue):
+        while not self._stop.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return _DONE
+
+    def _take_batch(self, q: queue.Queue, size: int) -> list:
+        first = self._get(q)
+        if first is _DONE:
+            return []
+        batch = [first]
+        while len(batch) < size:
+            try:
+                item = q.get_nowait()
+            except queue.Empty:
+                break
+            if item is _DONE:
+                # Keep the sentinel for the next call of this worker
+                q.put(item)
+                break
+            batch.append(item)
+        return batch
+
+    def _apply(self, stage: Stage, executor, items: list) -> list:
+        pending = [item for item in items if not item.finished]
+        if not pending:
+            return items
+        start = time.perf_counter()
+        try:
+            if stage.batch_size > 1:
+                stage.fn(pending)
+            elif executor is not None:
+                for item, result in zip(pending, executor.map(stage.fn, pending)):
+                    item.__dict__.update(result.__dict__)
+            else:
+                for item in pending:
+                    stage.fn(item)
+        except Exception as e:
+            for item in pending:
+                if not item.finished:
+                    item.error = f"{stage.name}: {e!r}"
+        if self.observer is not None:
+            self.observer(stage.name, len(pending), time.perf_counter() - start)
+        return items
+
+    def _worker(self, stage: Stage, executor, inbox: queue.Queue, outbox: queue.Queue, remaining: list, lock, consumers: int):
+        try:
+            while not self._stop.is_set():
+                batch = self._take_batch(inbox, stage.batch_size)
+                if not batch:
+                    break
+                for item in self._apply(stage, executor, batch):
+                    self._put(outbox, item)
+        except BaseException as e:
+            self._errors.append(e)
+            self._stop.set()
+        finally:
+            with lock:
+                remaining[0] -= 1
+                last = remaining[0] == 0
+            # The last worker of a stage tells every worker of the next one
+            if last:
+                for _ in range(consumers):
+                    self._put(outbox, _DONE)
+
+    def _feed(self, items: Iterable[ScanItem], outbox: queue.Queue, consumers: int):
+        try:
+            for item in items:
+                if self._stop.is_set():
+                    break
+                self._put(outbox, item)
+        except BaseException as e:
+            self._errors.append(e)
+            self._stop.set()
+        finally:
+            for _ in range(consumers):
+                self._put(outbox, _DONE)
+
+    def run(self, items: Iterable[ScanItem]) -> Iterator[ScanItem]:
+        queues = [queue.Queue(maxsize=stage.queue_size) for stage in self.stages]
+        queues.append(queue.Queue(maxsize=self.stages[-1].queue_size))
+        workers = [max(1, stage.workers) for stage in self.stages] + [1]
+        executors = []
+        threads = [threading.Thread(target=self._feed, args=(items, queues[0], workers[0]), daemon=True)]
+        for i, stage in enumerate(self.stages):
+            executor = None
+            if stage.kind == "process":
+                executor = ProcessPoolExecutor(max_workers=workers[i])
+                executors.append(executor)
+            remaining = [workers[i]]
+            lock = threading.Lock()
+            for _ in range(workers[i]):
+                threads.append(threading.Thread(
+                    target=self._worker,
+                    args=(stage, executor, queues[i], queues[i + 1], remaining, lock, workers[i + 1]),
+                    name=f"{stage.name}-worker",
+                    daemon=True
+                ))
+        for thread in threads:
+            thread.start()
+
+        try:
+            next_index = 0
+            buffered = {}
+            while True:
+                item = self._get(queues[-1])
+                if item is _DONE:
+                    break
+                if not self.ordered:
+                    yield item
+                    continue
+                # Items are emitted in input order, holding back early ones
+                buffered[item.index] = item
+                while next_index in buffered:
+                    yield buffered.pop(next_index)
+                    next_index += 1
+            for index in sorted(buffered):
+                yield buffered[index]
+            if self._errors:
+                raise self._errors[0]
+        finally:
+            self._stop.set()
+            for executor in executors:
+                executor.shutdown(wait=False, cancel_futures=True)
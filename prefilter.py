@@ -0,0 +1,157 @@
+import re
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+from config import PREFILTER_STRONG_SCORE
+from vecstore import Category
+
+
+@dataclass(init=True)
+class Pattern:
+    name: str
+    regex: str
+    weight: float
+    # Lowercase literals, one of which is part of every match. The regex only
+    # runs on the lines that contain one of them: str.find is far cheaper than
+    # trying every alternative of every pattern at each position of the file.
+    anchors: tuple
+    # Set for patterns that identify the category by themselves
+    category: Optional[str] = None
+
+
+PATTERNS = [
+    # Library usage that pins down the category
+    Pattern("bcrypt", r"\bbcrypt\b|\bBCrypt\b|has_secure_password", 1.0, ("bcrypt", "has_secure_password"), Category.PASSWORD_BCRYPT.value),
+    Pattern("bcrypt_api", r"\bhashpw\b|\bgensalt\b|GenerateFromPassword|CompareHashAndPassword|BCrypt::Password", 1.0, ("hashpw", "gensalt", "generatefrompassword", "comparehashandpassword"), Category.PASSWORD_BCRYPT.value),
+    Pattern("pbkdf2", r"(?i:pbkdf2)", 1.0, ("pbkdf2",), Category.PASSWORD_PBKDF2_SHA256.value),
+    Pattern("password_hasher", r"\bmake_password\b|\bcheck_password\b|\bgenerate_password_hash\b|\bcheck_password_hash\b", 1.0, ("make_password", "check_password", "generate_password_hash"), Category.PASSWORD_PBKDF2_SHA256.value),
+    Pattern("aes_api", r"\bAES\.new\b|\bAES\.MODE_|algorithms\.AES\b|aes\.NewCipher|(?i:createCipheriv\(\s*['\"]aes)|(?i:EVP_aes_)|Cipher\.getInstance\(\s*\"AES|OpenSSL::Cipher(?:::AES|\.new\(\s*['\"]aes)", 1.0, ("aes",), Category.USES_AES.value),
+    # Crypto libraries and APIs
+    Pattern("import_crypto", r"\bhashlib\b|\bCrypto\.(?:Cipher|Hash|PublicKey|Signature|Util|Random)\b|\bCryptodome\b|\bcryptography\.hazmat\b|\bnacl\b|\bjwt\b|\bhmac\b", 0.6, ("hashlib", "crypto.", "cryptodome", "cryptography.hazmat", "nacl", "jwt", "hmac")),
+    Pattern("openssl", r"\bOpenSSL\b|\bopenssl/|\bEVP_[A-Za-z]|\bRSA_[a-z]|\bEC_KEY\b|\bBN_[a-z]", 0.6, ("openssl", "evp_", "rsa_", "ec_key", "bn_")),
+    Pattern("go_crypto", r"\"crypto/[a-z0-9/]+\"|golang\.org/x/crypto", 0.6, ("crypto/",)),
+    Pattern("node_crypto", r"require\(\s*['\"](?:node:)?crypto['\"]\s*\)|from\s+['\"](?:node:)?crypto['\"]|\bcrypto\.subtle\b|\bcrypto-js\b|\bCryptoJS\b|\bforge\.", 0.6, ("crypto", "forge.")),
+    Pattern("ruby_crypto", r"\bDigest::|\bOpenSSL::", 0.6, ("digest::", "openssl::")),
+    # Algorithm names and crypto vocabulary
+    Pattern("hash_names", r"(?i:\bsha-?(?:1|224|256|384|512|3)\b|\bsha\d*_|\bsha(?:1|256|512)\w*|\bmd5\b|\bmd5_|\bkeccak|\bblake2|\bripemd)", 0.5, ("sha", "md5", "keccak", "blake2", "ripemd")),
+    Pattern("cipher_names", r"\bAES\b|\baes_|(?i:\brijndael|\bcamellia|\bchacha|\bpoly1305|\bsalsa20|\bblowfish|\btwofish|\b3des\b|\btriple_?des)|\bDES\b", 0.5, ("aes", "des", "rijndael", "camellia", "chacha", "poly1305", "salsa20", "blowfish", "twofish", "triple")),
+    Pattern("pk_names", r"\bRSA\b|\brsa_|(?i:\bdiffie|\bhellman|\becdsa|\becdh|\bed25519|\bed448|\bx25519|\bx448|\belliptic|\bsecp\d+|\bcurve25519)|\bDSA\b|\bdsa_", 0.5, ("rsa", "dsa", "diffie", "hellman", "ecd", "ed25519", "ed448", "x25519", "x448", "elliptic", "secp", "curve25519")),
+    Pattern("crypto_words", r"(?i:\bencrypt|\bdecrypt|\bcipher|\bciphertext|\bplaintext|\bdigest\b|\bhmac|\bsignature\b|\bprivate_?key|\bpublic_?key|\bnonce\b|\bkdf\b|\bmodular|\bmod_?inverse|\bmod_?pow|\bmodpow)", 0.4, ("crypt", "cipher", "plaintext", "digest", "hmac", "signature", "private", "public", "nonce", "kdf", "mod")),
+    Pattern("math_primitives", r"(?i:\bis_?prime|\bgenerate_?prime|\brandom_?prime|\bgcd\b|\begcd|\bextended_?gcd|\btotient|\bmillerrabin|\bmiller_rabin)|\bpow\([^()]*,[^()]*,[^()]*\)", 0.3, ("prime", "gcd", "totient", "miller", "pow(")),
+    Pattern("bit_mixing", r"\brot[lr]\b|(?i:\bright_?rotate|\bleft_?rotate|\brotr|\brotl)|>>>", 0.3, ("rot", ">>>")),
+    Pattern("hash_words", r"(?i:\bhash\b|\bhashed\b|\bsalt\b|\bpassword_hash)", 0.2, ("hash", "salt")),
+    # Frameworks that hash passwords behind the scenes
+    Pattern("auth_frameworks", r"\bdjango\.contrib\.auth\b|\bUserCreationForm\b|\bset_password\b|\bauthenticate\(|\bdevise\b|\bpassport\b", 0.2, ("django.contrib.auth", "usercreationform", "set_password", "authenticate(", "devise", "passport")),
+]
+
+COMPILED = [re.compile(pattern.regex) for pattern in PATTERNS]
+
+# Lowercases ASCII only, so offsets in the lowered copy match the original
+ASCII_LOWER = str.maketrans("ABCDEFGHIJKLMNOPQRSTUVWXYZ", "abcdefghijklmnopqrstuvwxyz")
+
+
+@dataclass(init=True)
+class PrefilterResult:
+    # NOCRYPTO when there is no signal at all, a fast-path category for strong
+    # library usage, None when the file has to go through the model stages
+    category: Optional[str]
+    score: float
+    signals: Dict[str, int]
+    # (line number, pattern name) of every hit, used to build prompts
+    hits: List[tuple]
+
+
+def _line_matches(code: str, lowered: str, pattern: Pattern, regex: re.Pattern) -> List[int]:
+    positions = []
+    seen = set()
+    for anchor in pattern.anchors:
+        found = lowered.find(anchor)
+        while found != -1:
+            start = code.rfind("\n", 0, found) + 1
+            end = code.find("\n", found)
+            end = len(code) if end == -1 else end
+            if start not in seen:
+                seen.add(start)
+                positions.extend(start + match.start() for match in regex.finditer(code, start, end))
+            found = lowered.find(anchor, end)
+    return positions
+
+
+def prefilter(code: str) -> PrefilterResult:
+    lowered = code.lower()
+    if len(lowered) != len(code):
+        lowered = code.translate(ASCII_LOWER)
+    signals = {}
+    found = []
+    for pattern, regex in zip(PATTERNS, COMPILED):
+        positions = _line_matches(code, lowered, pattern, regex)
+        if positions:
+            signals[pattern.name] = len(positions)
+            found.extend((position, pattern.name) for position in positions)
+
+    hits = []
+    line = 1
+    position = 0
+    for start, name in sorted(found):
+        line += code.count("\n", position, start)
+        position = start
+        hits.append((line, name))
+
+    if not signals:
+        return PrefilterResult(category=Category.NOCRYPTO.value, score=0.0, signals={}, hits=[])
+
+    by_name = {pattern.name: pattern for pattern in PATTERNS}
+    score = sum(by_name[name].weight for name in signals)
+    category_scores = {}
+    for name in signals:
+        pattern = by_name[name]
+        if pattern.category is not None:
+            category_scores[pattern.category] = category_scores.get(pattern.category, 0.0) + pattern.weight
+    category = None
+    if category_scores:
+        best, best_score = max(category_scores.items(), key=lambda item: item[1])
+        # Only when a single category has strong evidence
+        if best_score >= PREFILTER_STRONG_SCORE and len(category_scores) == 1:
+            category = best
+    return PrefilterResult(category=category, score=score, signals=signals, hits=hits)
+
+
+if __name__ == '__main__':
+    # python prefilter.py <folder>...: precision and recall of the prefilter
+    # against the labeled examples/ and files/ folders.
+    import sys
+    from discovery import discover_files
+    from evaluate import get_right_category
+
+    decided = 0
+    total = 0
+    no_signal = {"tp": 0, "fp": 0, "fn": 0}
+    fast_path = {"tp": 0, "fp": 0}
+    for folder in sys.argv[1:]:
+        for file_path in discover_files(folder, include=["*"]):
+            with open(file_path) as f:
+                result = prefilter(f.read())
+            actual = get_right_category(file_path)
+            total += 1
+            is_nocrypto = actual == Category.NOCRYPTO.value
+            if result.category == Category.NOCRYPTO.value:
+                decided += 1
+                no_signal["tp" if is_nocrypto else "fp"] += 1
+                if not is_nocrypto:
+                    print(f"Missed crypto: {file_path} ({actual})")
+            elif is_nocrypto:
+                no_signal["fn"] += 1
+            if result.category is not None and result.category != Category.NOCRYPTO.value:
+                decided += 1
+                fast_path["tp" if result.category == actual else "fp"] += 1
+                if result.category != actual:
+                    print(f"Wrong fast path: {file_path} {result.category} ({actual})")
+
+    def ratio(a, b):
+        return a / b if b else 0.0
+
+    print(f"Files: {total}, short-circuited: {decided} ({ratio(decided, total):.0%})")
+    print(
+        f"NOCRYPTO routing: precision {ratio(no_signal['tp'], no_signal['tp'] + no_signal['fp']):.2f}, "
+        f"recall {ratio(no_signal['tp'], no_signal['tp'] + no_signal['fn']):.2f}"
+    )
+    print(f"Fast path labels: precision {ratio(fast_path['tp'], fast_path['tp'] + fast_path['fp']):.2f}")
@@ -0,0 +1,136 @@
+import re
+import threading
+from collections import Counter
+from dataclasses import dataclass
+from typing import Iterable, List, Optional
+from chunking import count_tokens, split_lines
+from config import PROMPT_DEFAULT_TOKEN_BUDGET, PROMPT_TOKEN_BUDGETS
+
+
+# Room left in the budget for the instructions around the code and the answer
+RESERVED_TOKENS = 512
+# Lines shown around every prefilter or signature hit
+HIT_CONTEXT_LINES = 2
+# Share of the budget import blocks can take
+IMPORT_BUDGET_SHARE = 0.25
+# Charged for the marker that replaces every run of omitted lines
+MARKER_TOKENS = 8
+
+IMPORT_REGEX = re.compile(
+    r"\s*(?:import\s|from\s+\S+\s+import\s|#\s*include\b|#import\b|require[\s(]|use\s|using\s|package\s|extern\s+crate\s"
+    r"|(?:const|let|var)\s+\S+\s*=\s*require\()"
+)
+
+# Tokens of the prompts built so far and of the files they were built from,
+# updated from the LLM stage workers
+prompt_tokens = Counter()
+_lock = threading.Lock()
+
+
+@dataclass(init=True)
+class Excerpt:
+    text: str
+    tokens: int
+    # Tokens of the whole file
+    full_tokens: int
+
+    @property
+    def saved(self) -> int:
+        return max(0, self.full_tokens - self.tokens)
+
+
+def token_budget(model: str) -> int:
+    return PROMPT_TOKEN_BUDGETS.get(model, PROMPT_DEFAULT_TOKEN_BUDGET)
+
+
+def build_excerpt(
+    code: str,
+    model: str,
+    spans: Iterable[dict] = (),
+    hit_lines: Iterable[int] = ()
+) -> Excerpt:
+    # The whole file when it fits in the budget of model. Otherwise, in this
+    # order and while there is room: import blocks, the lines around
+    # prefilter and signature hits, the units whose nearest neighbors are
+    # crypto references (closest first), and then the top of the file.
+    # Omitted lines are replaced by a marker.
+    lines = split_lines(code)
+    sizes = [count_tokens(line) for line in lines]
+    full_tokens = sum(sizes)
+    budget = max(0, token_budget(model) - RESERVED_TOKENS)
+    if full_tokens <= budget:
+        excerpt = Excerpt(text=code, tokens=full_tokens, full_tokens=full_tokens)
+        _record(excerpt)
+        return excerpt
+
+    selected = set()
+    used = 0
+
+    def take(first: int, last: int, limit: int) -> bool:
+        # Adds lines first..last (1-based) while they fit under limit;
+        # returns False once the limit is reached
+        nonlocal used
+        for number in range(max(1, first), min(len(lines), last) + 1):
+            if number in selected:
+                continue
+            cost = sizes[number - 1] + (MARKER_TOKENS if number - 1 not in selected else 0)
+            if used + cost > limit:
+                return False
+            selected.add(number)
+            used += cost
+        return True
+
+    import_limit = int(budget * IMPORT_BUDGET_SHARE)
+    for number, line in enumerate(lines, start=1):
+        if IMPORT_REGEX.match(line) and not take(number, number, import_limit):
+            break
+    for line in sorted(set(hit_lines)):
+        if not take(line - HIT_CONTEXT_LINES, line + HIT_CONTEXT_LINES, budget):
+            break
+    for span in sorted(spans, key=lambda span: span["distance"]):
+        if not take(span["start_line"], span["end_line"], budget):
+            break
+    take(1, len(lines), budget)
+
+    parts = []
+    omitted = 0
+    for number, line in enumerate(lines, start=1):
+        if number in selected:
+            if omitted:
+                parts.append(f"... ({omitted} lines omitted)\n")
+                omitted = 0
+            parts.append(line if line.endswith("\n") else line + "\n")
+        else:
+            omitted += 1
+    if omitted:
+        parts.append(f"... ({omitted} lines omitted)\n")
+    text = "".join(parts)
+    excerpt = Excerpt(text=text, tokens=count_tokens(text), full_tokens=full_tokens)
+    _record(excerpt)
+    return excerpt
+
+
+def _record(excerpt: Excerpt):
+    with _lock:
+        prompt_tokens["prompts"] += 1
+        prompt_tokens["tokens"] += excerpt.tokens
+        prompt_tokens["full_tokens"] += excerpt.full_tokens
+        prompt_tokens["saved"] += excerpt.saved
+
+
+def hit_lines_of(*results: Optional[object]) -> List[int]:
+    # Line numbers of the hits of prefilter and signature results
+    return [line for result in results if result is not None for line, _ in result.hits]
+
+
+if __name__ == '__main__':
+    # python prompts.py <file> [model]: the excerpt a file would be sent as
+    import sys
+    from prefilter import prefilter
+    from signatures import match_signatures
+    with open(sys.argv[1]) as f:
+        code = f.read()
+    model = sys.argv[2] if len(sys.argv) > 2 else "llama3.1"
+    excerpt = build_excerpt(code, model, hit_lines=hit_lines_of(prefilter(code), match_signatures(code)))
+    print(excerpt.text)
+    print(f"Tokens: {excerpt.tokens} of {excerpt.full_tokens} (budget {token_budget(model)}, saved {excerpt.saved})")
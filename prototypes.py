@@ -0,0 +1,262 @@
+import os
+import threading
+from typing import Dict, List, Optional, Sequence
+import numpy as np
+from config import PROTOTYPE_KMEANS_ITERATIONS, PROTOTYPES_DIR, PROTOTYPES_PER_CATEGORY
+
+
+def _squared_distances(queries: np.ndarray, vectors: np.ndarray) -> np.ndarray:
+    # Squared L2, the metric of the reference collection
+    distances = queries @ vectors.T
+    distances *= -2
+    distances += np.einsum("ij,ij->i", queries, queries)[:, None]
+    distances += np.einsum("ij,ij->i", vectors, vectors)[None, :]
+    return np.maximum(distances, 0.0)
+
+
+def kmeans(vectors: np.ndarray, k: int, iterations: int = PROTOTYPE_KMEANS_ITERATIONS) -> np.ndarray:
+    # Cluster index of every vector. Deterministic: seeded with the vector
+    # nearest to the mean and then, one at a time, the vector farthest from
+    # the seeds so far, so the prototypes cover the outlying variants too.
+    k = min(k, len(vectors))
+    seeds = [int(np.argmin(_squared_distances(vectors.mean(axis=0, keepdims=True), vectors)[0]))]
+    nearest = _squared_distances(vectors[seeds], vectors)[0]
+    while len(seeds) < k:
+        seeds.append(int(np.argmax(nearest)))
+        nearest = np.minimum(nearest, _squared_distances(vectors[seeds[-1:]], vectors)[0])
+    centroids = vectors[seeds].astype(np.float64)
+    assignment = np.zeros(len(vectors), dtype=np.int64)
+    for iteration in range(iterations):
+        updated = np.argmin(_squared_distances(vectors, centroids.astype(np.float32)), axis=1)
+        if iteration and np.array_equal(updated, assignment):
+            break
+        assignment = updated
+        for cluster in range(k):
+            members = vectors[assignment == cluster]
+            # An emptied cluster keeps its centroid
+            if len(members):
+                centroids[cluster] = members.mean(axis=0)
+    return assignment
+
+
+# A few centroids per category of the reference collection. Each one keeps
+# the sum and count of its members, so new references are folded in without
+# going over the collection again. Queried like the collection, it returns
+# prototypes whose metadata carries the category, which is all that the
+# aggregation and routing of categorize need.
+class PrototypeIndex:
+    def __init__(
+        self,
+        categories: List[str],
+        sums: np.ndarray,
+        counts: np.ndarray,
+        references: int
+    ):
+        self.categories = categories
+        self.sums = sums
+        self.counts = counts
+        # Size of the collection the prototypes were computed from
+        self.references = references
+        self._update_centroids()
+
+    def _update_centroids(self):
+        self.centroids = (self.sums / np.maximum(self.counts, 1)[:, None]).astype(np.float32)
+
+    @classmethod
+    def build(
+        cls,
+        embeddings: np.ndarray,
+        categories: Sequence[str],
+        per_category: int = PROTOTYPES_PER_CATEGORY
+    ) -> "PrototypeIndex":
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        labels = np.asarray(categories)
+        prototype_categories = []
+        sums = []
+        counts = []
+        for category in sorted(set(categories)):
+            members = embeddings[labels == category]
+            assignment = kmeans(members, per_category)
+            for cluster in range(assignment.max() + 1):
+                in_cluster = members[assignment == cluster]
+                if len(in_cluster):
+                    prototype_categories.append(category)
+                    sums.append(in_cluster.sum(axis=0, dtype=np.float64))
+                    counts.append(len(in_cluster))
+        dim = embeddings.shape[1] if embeddings.ndim == 2 else 0
+        return cls(
+            prototype_categories,
+            np.asarray(sums, dtype=np.float64).reshape(len(sums), dim),
+            np.asarray(counts, dtype=np.int64),
+            references=len(embeddings)
+        )
+
+    def add(self, embeddings: np.ndarray, categories: Sequence[str]):
+        # Folds new references into the nearest prototype of their category,
+        # or into a new one for a category not seen yet
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        for embedding, category in zip(embeddings, categories):
+            candidates = [index for index, c in enumerate(self.categories) if c == category]
+            if candidates:
+                distances = _squared_distances(embedding[None, :], self.centroids[candidates])[0]
+                nearest = candidates[int(np.argmin(distances))]
+                self.sums[nearest] += embedding
+                self.counts[nearest] += 1
+            else:
+                self.categories.append(category)
+                self.sums = np.vstack([self.sums.reshape(-1, len(embedding)), embedding[None, :].astype(np.float64)])
+                self.counts = np.append(self.counts, 1)
+            self._update_centroids()
+        self.references += len(embeddings)
+
+    def __len__(self) -> int:
+        return len(self.categories)
+
+    def query(self, query_embeddings: np.ndarray, n_results: int = 4) -> dict:
+        # The nearest prototype of every category, nearest first, in the
+        # shape of a collection query. The runner-up categories are kept as
+        # disagreeing neighbors, so that routing sees how close they are.
+        distances = _squared_distances(np.asarray(query_embeddings, dtype=np.float32), self.centroids)
+        labels = np.asarray(self.categories)
+        nearest = [
+            np.flatnonzero(labels == category)[np.argmin(distances[:, labels == category], axis=1)]
+            for category in sorted(set(self.categories))
+        ]
+        candidates = np.stack(nearest, axis=1) if nearest else np.zeros((len(distances), 0), dtype=np.int64)
+        candidate_distances = np.take_along_axis(distances, candidates, axis=1)
+        order = np.argsort(candidate_distances, axis=1, kind="stable")[:, :n_results]
+        kept = np.take_along_axis(candidates, order, axis=1)
+        ids, metadatas, kept_distances = [], [], []
+        for row, row_distances in zip(kept.tolist(), np.take_along_axis(distances, kept, axis=1).tolist()):
+            ids.append([f"prototype:{self.categories[i]}:{i}" for i in row])
+            metadatas.append([{"category": self.categories[i], "prototype": i, "members": int(self.counts[i])} for i in row])
+            kept_distances.append(row_distances)
+        return {"ids": ids, "metadatas": metadatas, "distances": kept_distances}
+
+    def without(self, embeddings: np.ndarray, categories: Sequence[str]) -> "PrototypeIndex":
+        # A copy with references taken out of the nearest prototype of their
+        # category, the reverse of add; prototypes left empty are dropped.
+        # Used to evaluate files that are themselves references.
+        sums = self.sums.copy()
+        counts = self.counts.copy()
+        labels = np.asarray(self.categories)
+        for embedding, category in zip(np.asarray(embeddings, dtype=np.float32), categories):
+            candidates = np.flatnonzero((labels == category) & (counts > 0))
+            if len(candidates) == 0:
+                continue
+            nearest = candidates[int(np.argmin(_squared_distances(embedding[None, :], self.centroids[candidates])[0]))]
+            sums[nearest] -= embedding
+            counts[nearest] -= 1
+        kept = counts > 0
+        return PrototypeIndex(
+            [category for category, keep in zip(self.categories, kept) if keep],
+            sums[kept],
+            counts[kept],
+            references=self.references - int(self.counts.sum() - counts.sum())
+        )
+
+    def margins(self, query_embeddings: np.ndarray) -> np.ndarray:
+        # How far ahead the nearest category is for every query: the gap
+        # between the nearest prototype of another category and the nearest
+        # one, relative to the former. 0 when they are as close, 1 when the
+        # query sits on a prototype; 1 as well with a single category.
+        distances = _squared_distances(np.asarray(query_embeddings, dtype=np.float32), self.centroids)
+        nearest = np.argmin(distances, axis=1)
+        labels = np.asarray(self.categories)
+        other = np.where(labels[None, :] == labels[nearest][:, None], np.inf, distances)
+        best = distances[np.arange(len(distances)), nearest]
+        runner_up = other.min(axis=1)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            margins = np.where(np.isinf(runner_up), 1.0, (runner_up - best) / runner_up)
+        return np.nan_to_num(margins, nan=0.0)
+
+    def save(self, path: str):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp = f"{path}.tmp"
+        with open(tmp, "wb") as f:
+            np.savez(
+                f,
+                categories=np.asarray(self.categories, dtype=str),
+                sums=self.sums,
+                counts=self.counts,
+                references=np.asarray(self.references)
+            )
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path: str) -> "PrototypeIndex":
+        with np.load(path) as data:
+            return cls(
+                [str(category) for category in data["categories"]],
+                data["sums"],
+                data["counts"],
+                references=int(data["references"])
+            )
+
+
+def prototypes_path(name: str) -> str:
+    return os.path.join(PROTOTYPES_DIR, f"{name}.npz")
+
+
+_indexes: Dict[str, PrototypeIndex] = {}
+_lock = threading.Lock()
+
+
+def _from_collection(collection) -> PrototypeIndex:
+    entries = collection.get(include=["embeddings", "metadatas"])
+    embeddings = np.asarray(entries["embeddings"], dtype=np.float32)
+    return PrototypeIndex.build(embeddings, [metadata["category"] for metadata in entries["metadatas"]])
+
+
+def for_collection(collection, name: str) -> Optional[PrototypeIndex]:
+    # The prototypes of a reference collection, loaded from disk or computed
+    # from its stored embeddings. They are recomputed when the collection
+    # changed size behind their back (references added without upsert
+    # below). None while the collection is empty.
+    with _lock:
+        index = _indexes.get(name)
+        if index is None:
+            path = prototypes_path(name)
+            count = collection.count()
+            if count == 0:
+                return None
+            if os.path.exists(path):
+                index = PrototypeIndex.load(path)
+            if index is None or index.references != count:
+                index = _from_collection(collection)
+                index.save(path)
+            _indexes[name] = index
+        return index
+
+
+def upsert(collection, name: str, ids: List[str], metadatas: List[dict], documents: List[str], embeddings: list):
+    # Upserts references and keeps the prototypes in step: new references
+    # are folded in, replaced ones make them be recomputed
+    with _lock:
+        replaced = collection.get(ids=ids, include=[])["ids"]
+        collection.upsert(ids=ids, metadatas=metadatas, documents=documents, embeddings=embeddings)
+        index = _indexes.get(name)
+        path = prototypes_path(name)
+        if index is None and os.path.exists(path):
+            index = PrototypeIndex.load(path)
+        if index is None or replaced or index.references + len(ids) != collection.count():
+            index = _from_collection(collection)
+        else:
+            index.add(np.asarray(embeddings, dtype=np.float32), [metadata["category"] for metadata in metadatas])
+        index.save(path)
+        _indexes[name] = index
+
+
+if __name__ == '__main__':
+    # python prototypes.py: recompute the prototypes of the reference
+    # collection and list them
+    from vecstore import collection, collection_name
+    name = collection_name()
+    with _lock:
+        _indexes[name] = _from_collection(collection)
+        _indexes[name].save(prototypes_path(name))
+    index = _indexes[name]
+    print(f"{len(index)} prototypes over {index.references} references, saved to {prototypes_path(name)}")
+    for category in sorted(set(index.categories)):
+        members = [int(count) for c, count in zip(index.categories, index.counts) if c == category]
+        print(f"  {category:24} {len(members)} prototypes, members {members}")
@@ -0,0 +1,136 @@
+import json
+import os
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+from config import PROTOTYPE_MARGIN, ROUTING_DEFAULT_THRESHOLD, ROUTING_TARGET_PRECISION, ROUTING_THRESHOLDS_PATH
+
+
+# Guards against a zero distance to an identical reference document
+DISTANCE_EPSILON = 1e-6
+
+# Key of the calibrated prototype margin among the thresholds; no category
+# is called "margin", so it never shadows one
+PROTOTYPE_MARGIN_KEY = "prototypes:margin"
+
+
+@dataclass(init=True)
+class RouteDecision:
+    category: str
+    # Share of the evidence that backs category, from 0 to 1
+    confidence: float
+    # Difference with the runner-up category
+    margin: float
+    # Whether the file has to go to the LLM
+    escalate: bool
+    scores: Dict[str, float]
+
+
+def category_scores(response: dict) -> Dict[str, float]:
+    # Blend of two shares, each one summing to 1 over the categories: the
+    # nearest references weighted by inverse distance, and the votes every
+    # chunk of the file cast among its own neighbors.
+    weights = {}
+    for metadata, distance in zip(response.get("categories", []), response.get("distances", [])):
+        category = metadata["category"]
+        weights[category] = weights.get(category, 0.0) + 1.0 / (distance + DISTANCE_EPSILON)
+    total_weight = sum(weights.values())
+    votes = response.get("votes") or {}
+    total_votes = sum(votes.values())
+
+    scores = {}
+    for category in set(weights) | set(votes):
+        weighted = weights.get(category, 0.0) / total_weight if total_weight else 0.0
+        voted = votes.get(category, 0.0) / total_votes if total_votes else weighted
+        scores[category] = (weighted + voted) / 2
+    return scores
+
+
+def load_thresholds(path: str = ROUTING_THRESHOLDS_PATH) -> Dict[str, float]:
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+thresholds = load_thresholds()
+
+
+def threshold_key(category: str, response: dict) -> str:
+    # Answers from the category prototypes have one neighbor per category,
+    # so their confidences run lower than those of the collection and are
+    # calibrated apart, under "prototypes:<category>"
+    return f"prototypes:{category}" if response.get("prototypes") else category
+
+
+def prototype_margin(category_thresholds: Optional[Dict[str, float]] = None) -> float:
+    category_thresholds = thresholds if category_thresholds is None else category_thresholds
+    return category_thresholds.get(PROTOTYPE_MARGIN_KEY, PROTOTYPE_MARGIN)
+
+
+def route(response: dict, category_thresholds: Optional[Dict[str, float]] = None) -> RouteDecision:
+    # Without calibrated thresholds only unanimous neighbors are trusted,
+    # which is what the old early_stop did.
+    category_thresholds = thresholds if category_thresholds is None else category_thresholds
+    scores = category_scores(response)
+    if not scores:
+        return RouteDecision(category="NOCRYPTO", confidence=0.0, margin=0.0, escalate=True, scores={})
+    ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+    category, confidence = ranked[0]
+    margin = confidence - (ranked[1][1] if len(ranked) > 1 else 0.0)
+    threshold = category_thresholds.get(threshold_key(category, response), ROUTING_DEFAULT_THRESHOLD)
+    return RouteDecision(
+        category=category,
+        confidence=confidence,
+        margin=margin,
+        # Rounding keeps a unanimous 0.999... from escalating
+        escalate=round(confidence, 9) < threshold,
+        scores=scores
+    )
+
+
+def calibrate(
+    samples: List[Tuple[str, float, str]],
+    target_precision: float = ROUTING_TARGET_PRECISION
+) -> Dict[str, float]:
+    # samples are (predicted category, confidence, right category). For each
+    # predicted category, the lowest threshold at which the decisions kept
+    # without the LLM are still right at least target_precision of the time.
+    calibrated = {}
+    for category in sorted({predicted for predicted, _, _ in samples}):
+        ranked = sorted(
+            ((confidence, predicted == actual) for predicted, confidence, actual in samples if predicted == category),
+            reverse=True
+        )
+        threshold = None
+        right = 0
+        for kept, (confidence, correct) in enumerate(ranked, start=1):
+            right += correct
+            # Only cut between distinct confidences
+            if kept < len(ranked) and ranked[kept][0] == confidence:
+                continue
+            if right / kept >= target_precision:
+                threshold = confidence
+        calibrated[category] = round(threshold, 6) if threshold is not None else ROUTING_DEFAULT_THRESHOLD
+    return calibrated
+
+
+def routing_cost(samples: List[Tuple[str, float, str]], category_thresholds: Dict[str, float]) -> dict:
+    # LLM call rate of a set of thresholds, and how often the decisions that
+    # skip the LLM are right
+    kept = [
+        predicted == actual
+        for predicted, confidence, actual in samples
+        if round(confidence, 9) >= category_thresholds.get(predicted, ROUTING_DEFAULT_THRESHOLD)
+    ]
+    return {
+        "files": len(samples),
+        "llm_calls": len(samples) - len(kept),
+        "llm_call_rate": (len(samples) - len(kept)) / len(samples) if samples else 0.0,
+        "kept_accuracy": sum(kept) / len(kept) if kept else 1.0,
+        "kept_errors": len(kept) - sum(kept),
+    }
+
+
+def save_thresholds(category_thresholds: Dict[str, float], path: str = ROUTING_THRESHOLDS_PATH):
+    with open(path, "w") as f:
+        json.dump(category_thresholds, f, indent=4, sort_keys=True)
@@ -1,211 +1,373 @@
-import re
-import sys
+import hashlib
+import json
 import os
-from typing import Dict, Optional
-from ollama import Client, Message, Options
-from categorize import classify_file
-from vecstore import Category
-
-POSSIBLE_CATEGORIES = [cat.value for cat in Category] + ["bcrypt"]
-
-options = Options(temperature=0.0)
-
-
-def identify_algorithm(code: str, algorithm_name: str, explanation=None):
-    print(algorithm_name)
-    return (algorithm_name, code, explanation)
-
-
-AVAILABLE_FUNCTIONS = {"identify_algorithm": identify_algorithm}
-
-def get_true_category_v2_codellama(file_path, categories):
-    question = open(file_path).read()
-    prompt = f"""
-    You are a machine capable of recognizing algorithms or fragments of use of algorithms.
-    Given the following code, identify if it is an implementation of a cryptographic
-    algorithm,  the use of a cryptographic algorithm, or it is just a general
-    code. Take into account that a use of cryptographic code can be considered
-    anything that tries to hash a password, digest a message, sign a token, or
-    pretty much anything that would be considered the use of a cryptographic primitive.
-
-    If the algorithm is an example of use of any cryptographic primitive, the possible
-    categories are:
-    - USES_AES: in case the algorithm is using the AES algorithm.
-    - PASSWORD_PBKDF2_SHA256: in case it is using a key derivation algorithm.
-    - PASSWORD_BCRYPT: in case it is using the bcrypt algorithm.
-
-    If the algorithm is an implementation, then the possible categories are:
-    - RSA
-    - DiffieHellman
-    - DSA
-    - ElipticCurves
-    - ED448
-    - ED25519
-    - AES
-    - CAMELLIA
-    - CHACHA20
-    - DES
-    - HMAC
-    - MD5
-    - SHA
-
-    If the code is not implementing nor using any cryptographic primitive, then the
-    output should be NO_CRYPTO.
-
-    The code is as follow:
-    {question}
-
-    If usefull, a previous model has classified this code as one of these categories:
-    {", ".join(categories)}
-
-    OUTPUT ONLY THE CATEGORY OF THE ALGORITHM AND NOTHING ELSE.
-    """
-    client = Client(host="http://localhost:11434")
-    llm_response: Dict = client.generate(
-        model="llama3.1",
-        prompt=prompt,
-        options=options,
-    )  # type: ignore
-    answer = llm_response.get("response", {})
-    regexes = [
-        re.compile(f"""({'|'.join(POSSIBLE_CATEGORIES)})"""),
-        re.compile(r"SHA\-256|SHA256|SHA\-1|SHA1|SHA\-512|SHA512|SHA\-3|SHA3"),
-    ]
-    matches = [regex.search(answer.strip()) for regex in regexes]
-    if any(m is not None for m in matches):
-        match = next(m for m in matches if m is not None)
-        return "LLM " + match.group(1).strip()
-    else:
-        return answer.strip()
-
-
-def get_true_category(file_path, categories):
-    question = open(file_path).read()
-    prompt = f"""
-    You are a machine capable of recognizing algorithms or fragments of use of algorithms.
-    Given the following code, identify if it is an implementation of a cryptographic
-    algorithm,  the use of a cryptographic algorithm, or it is just a general
-    code. Take into account that a use of cryptographic code can be considered
-    anything that tries to hash a password, digest a message, sign a token, or
-    pretty much anything that would be considered the use of a cryptographic primitive.
-
-    If the algorithm is an example of use of any cryptographic primitive, the possible
-    categories are:
-    - USES_AES: in case the algorithm is using the AES algorithm.
-    - PASSWORD_PBKDF2_SHA256: in case it is using a key derivation algorithm.
-    - PASSWORD_BCRYPT: in case it is using the bcrypt algorithm.
-
-    If the algorithm is an implementation, then the possible categories are:
-    - RSA
-    - DiffieHellman
-    - DSA
-    - ElipticCurves
-    - ED448
-    - ED25519
-    - AES
-    - CAMELLIA
-    - CHACHA20
-    - DES
-    - HMAC
-    - MD5
-    - SHA
-
-    If the code is not implementing nor using any cryptographic primitive, then the
-    output should be NO_CRYPTO.
-
-    The code is as follow:
-    {question}
-    """
-    client = Client(host="http://localhost:11434")
-    llm_response: Dict = client.chat(
-        model="llama3.1",
-        messages=[Message(content=prompt, role="user")],
-        options=options,
-        tools=[
-            {
-                "type": "function",
-                "function": {
-                    "name": "identify_algorithm",
-                    "description": "This function identifies a given fragment of code by name. It is used to detect cryptographic code.",
-                    "parameters": {
-                        "type": "object",
-                        "properties": {
-                            "code": {
-                                "type": "string",
-                                "description": "The code that was identified as with the algorithm_name parameter",
-                            },
-                            "algorithm_name": {
-                                "type": "string",
-                                "description": "The identified algorithm name or NO_CRYPTO if it is not a cryptographic code",
-                            },
-                            "explanation": {
-                                "type": "string",
-                                "description": "An explanation of why the algorithm is identified by that name",
-                            },
-                        },
-                        "required": ["algorithm_name", "code", "explanation"],
-                    },
-                },
-            }
-        ],
-    )  # type: ignore
-    print(llm_response)
-    if tool_calls := llm_response["message"].get("tool_calls", None):
-        for function_to_call in tool_calls:  # type: ignore
-            func = AVAILABLE_FUNCTIONS[function_to_call["function"]["name"]]  # type: ignore
-            args = function_to_call["function"]["arguments"]
-            if "description" in args:
-                desc = args.pop("description")
-                args['explanation'] = desc
-
-            return func(**args)[0]
-
-    answer = llm_response.get("message", {}).get("content", {})
-    regexes = [
-        re.compile(f"""({'|'.join(POSSIBLE_CATEGORIES)})"""),
-        re.compile(r"SHA\-256|SHA256|SHA\-1|SHA1|SHA\-512|SHA512|SHA\-3|SHA3"),
+import sys
+from collections import Counter
+from functools import partial
+from typing import Callable, Iterable, Iterator, Optional
+from cascade import CASCADE_PROMPT_VERSION, Cascade, normalize_category, tiers_from_config
+from categorize import embed_segments, query_segments
+from config import (
+    CLASSIFY_BATCH_SIZE,
+    DISCOVERY_MAX_FILE_SIZE,
+    EMBEDDING_BACKEND,
+    LLM_CACHE_MAX_ENTRIES,
+    LLM_CACHE_PATH,
+    METRICS_PORT,
+    NEARDUP_PATH,
+    SCAN_EMBED_WORKERS,
+    SCAN_LLM_WORKERS,
+    SCAN_MANIFEST_PATH,
+    SCAN_QUERY_WORKERS,
+    SCAN_QUEUE_SIZE,
+    SCAN_READ_WORKERS,
+    SCAN_SEGMENT_WORKERS,
+    VECTOR_BACKEND,
+)
+from discovery import LANGUAGE_EXTENSIONS, discover_files, git_changed_files
+from llm_cache import LLMCache
+from manifest import ManifestEntry, ScanManifest
+import metrics
+from neardup import NearDupIndex, sketch
+from pipeline import Pipeline, ScanItem, Stage
+from prefilter import prefilter
+from prompts import build_excerpt, hit_lines_of, prompt_tokens
+from routing import route
+from segmentation import segment_file
+from signatures import match_signatures
+from vecstore import collection, collection_name, content_hash
+
+# Bump the version of a prompt whenever its template changes, so that the
+# answers cached for the old template are no longer used
+PROMPT_VERSIONS = {
+    "cascade": CASCADE_PROMPT_VERSION,
+}
+
+llm_cache = LLMCache(LLM_CACHE_PATH, LLM_CACHE_MAX_ENTRIES) if LLM_CACHE_PATH else None
+cascade = Cascade(tiers_from_config(), llm_cache)
+
+
+def verdict_version() -> str:
+    # What a verdict depends on besides the file: the embedding and vector
+    # backends, the reference collection and its size, the prompts and the
+    # models asked. Verdicts recorded under another version are not reused.
+    material = json.dumps(
+        {
+            "embedding": EMBEDDING_BACKEND,
+            "vectors": VECTOR_BACKEND,
+            "collection": collection_name(),
+            "references": collection.count(),
+            "prompts": PROMPT_VERSIONS,
+            "models": [tier.model for tier in cascade.tiers],
+        },
+        sort_keys=True
+    )
+    return hashlib.sha256(material.encode()).hexdigest()[:16]
+
+
+neardup_index = NearDupIndex(NEARDUP_PATH, verdict_version()) if NEARDUP_PATH else None
+
+
+def reuse_manifest_entry(item: ScanItem, entry: ManifestEntry):
+    item.category = entry.category
+    item.stage = "manifest"
+    item.metadata = {
+        "ids": entry.neighbor_ids,
+        "distances": entry.neighbor_distances,
+        "manifest": {"path": entry.path, "stage": entry.stage}
+    }
+
+
+def stat_item(item: ScanItem, manifest: ScanManifest):
+    stat = os.stat(item.path)
+    item.size = stat.st_size
+    item.mtime_ns = stat.st_mtime_ns
+    entry = manifest.lookup_stat(os.path.realpath(item.path), item.size, item.mtime_ns)
+    if entry is not None:
+        reuse_manifest_entry(item, entry)
+
+
+def read_item(item: ScanItem, manifest: Optional[ScanManifest] = None):
+    with open(item.path) as f:
+        metrics.BYTES_READ.inc(os.fstat(f.fileno()).st_size)
+        item.code = f.read()
+    item.sha256 = content_hash(item.code)
+    if manifest is not None:
+        # Touched but unchanged files, and copies of known files
+        entry = manifest.lookup_hash(item.sha256)
+        if entry is not None:
+            reuse_manifest_entry(item, entry)
+
+
+def signature_item(item: ScanItem):
+    # Implementations that carry the tables of their algorithm (round
+    # constants, S-boxes, curve parameters) are labeled by them.
+    item.signatures = match_signatures(item.code)
+    if item.signatures.category is not None:
+        item.category = item.signatures.category
+        item.stage = "signatures"
+
+
+def prefilter_item(item: ScanItem):
+    # Files without any crypto signal, or with unambiguous library usage, are
+    # labeled here and skip the embedding, kNN and LLM stages.
+    item.prefilter = prefilter(item.code)
+    if item.prefilter.category is not None:
+        item.category = item.prefilter.category
+        item.stage = "prefilter"
+
+
+def reuse_near_duplicate(item: ScanItem, late: bool = False) -> bool:
+    # Copies of files the model stages already classified, vendored or
+    # pasted with small edits, take their verdict
+    if item.sketch is None or neardup_index is None:
+        return False
+    match = neardup_index.lookup(item.sketch, 0 if late else len(item.code), late=late)
+    if match is None:
+        return False
+    item.category = match.category
+    item.stage = "neardup"
+    item.metadata = item.metadata or {}
+    item.metadata["neardup"] = {"sha256": match.sha256, "path": match.path, "stage": match.stage, "similarity": match.similarity}
+    return True
+
+
+def neardup_item(item: ScanItem):
+    item.sketch = sketch(item.code)
+    reuse_near_duplicate(item)
+
+
+def remember_item(item: ScanItem):
+    if neardup_index is not None and item.sketch is not None:
+        neardup_index.add(item.sha256, item.path, item.category, item.stage, item.sketch)
+
+
+def record_item(item: ScanItem, manifest: ScanManifest):
+    # Files answered by their size and mtime were not read and are already
+    # recorded as they are.
+    if item.error is not None or item.sha256 is None:
+        return
+    metadata = item.metadata or {}
+    manifest.record(ManifestEntry(
+        path=os.path.realpath(item.path),
+        size=item.size,
+        mtime_ns=item.mtime_ns,
+        sha256=item.sha256,
+        category=item.category,
+        neighbor_ids=metadata.get("ids", []),
+        neighbor_distances=metadata.get("distances", []),
+        # A copy answered by the hash of a known file keeps the stage that
+        # decided it
+        stage=metadata["manifest"]["stage"] if item.stage == "manifest" else item.stage
+    ))
+
+
+def segment_item(item: ScanItem) -> ScanItem:
+    item.segments = segment_file(item.path, item.code)
+    return item
+
+
+def embed_items(items):
+    for item, embeddings in zip(items, embed_segments([item.segments for item in items])):
+        item.embeddings = embeddings
+
+
+def query_items(items):
+    responses = query_segments(
+        [item.segments for item in items],
+        n_results=4,
+        embeddings=[item.embeddings for item in items]
+    )
+    for item, response in zip(items, responses):
+        item.metadata = response
+
+
+def adjudicate_item(item: ScanItem):
+    categories = list(cat["category"] for cat in item.metadata.get("categories"))
+    decision = route(item.metadata)
+    item.metadata["route"] = {
+        "category": decision.category,
+        "confidence": decision.confidence,
+        "margin": decision.margin,
+        "escalate": decision.escalate
+    }
+    category = decision.category
+    item.stage = "knn"
+    # A copy that was still in flight when this file went past the neardup
+    # stage may have been classified since
+    if decision.escalate and reuse_near_duplicate(item, late=True):
+        return
+    if decision.escalate:
+        excerpts = {}
+
+        def excerpt_for(model):
+            if model not in excerpts:
+                excerpts[model] = build_excerpt(
+                    item.code,
+                    model,
+                    spans=item.metadata.get("spans", []),
+                    hit_lines=hit_lines_of(item.signatures, item.prefilter)
+                )
+            return excerpts[model]
+
+        answer, answers = cascade.classify(excerpt_for, categories)
+        item.metadata["prompt"] = {
+            model: {"tokens": excerpt.tokens, "full_tokens": excerpt.full_tokens, "saved": excerpt.saved}
+            for model, excerpt in excerpts.items()
+        }
+        item.metadata["cascade"] = [
+            {"model": a.model, "category": a.category, "confidence": a.confidence, "latency": a.latency, "cached": a.cached}
+            for a in answers
+        ]
+        # Without a usable answer the kNN vote stands
+        if answer is not None:
+            category = answer
+            item.stage = f"llm:{answers[-1].model}"
+    # References ingested before their labels were normalized may still
+    # carry a folder name such as ELIPTIC_CURVES
+    item.category = normalize_category(category) or category
+    remember_item(item)
+
+
+def scan_items(
+    folder_path,
+    batch_size=CLASSIFY_BATCH_SIZE,
+    ordered=True,
+    manifest: Optional[ScanManifest] = None,
+    since: Optional[str] = None,
+    use_prefilter: bool = True,
+    use_signatures: bool = True,
+    use_neardup: bool = True,
+    observer: Optional[Callable[[str, int, float], None]] = None,
+    paths: Optional[Iterable[str]] = None,
+    **discovery_options
+) -> Iterator[ScanItem]:
+    # discovery_options are passed to discovery.discover_files. With a
+    # manifest only new or changed files go through the model stages, and
+    # since restricts the scan to the files changed from that git ref.
+    # observer is handed to the pipeline; paths replaces the discovery of
+    # folder_path with a fixed list of files.
+    stages = [
+        Stage("read", partial(read_item, manifest=manifest), workers=SCAN_READ_WORKERS, queue_size=SCAN_QUEUE_SIZE),
+        Stage("signatures", signature_item, queue_size=SCAN_QUEUE_SIZE),
+        Stage("prefilter", prefilter_item, queue_size=SCAN_QUEUE_SIZE),
+        Stage("neardup", neardup_item, queue_size=SCAN_QUEUE_SIZE),
+        Stage("segment", segment_item, workers=SCAN_SEGMENT_WORKERS, kind="process", queue_size=SCAN_QUEUE_SIZE),
+        Stage("embed", embed_items, workers=SCAN_EMBED_WORKERS, batch_size=batch_size, queue_size=SCAN_QUEUE_SIZE),
+        Stage("query", query_items, workers=SCAN_QUERY_WORKERS, batch_size=batch_size, queue_size=SCAN_QUEUE_SIZE),
+        Stage("llm", adjudicate_item, workers=SCAN_LLM_WORKERS, queue_size=SCAN_QUEUE_SIZE),
     ]
-    matches = [regex.search(answer.strip()) for regex in regexes]
-    if any(m is not None for m in matches):
-        match = next(m for m in matches if m is not None)
-        return match.group(1).strip()
-    else:
-        return answer.strip()
-
-
-def early_stop(categories) -> Optional[str]:
-    # If all categories are the same, return that category
-    if len(set(categories)) == 1:
-        return categories[0]
-
-    # If there are 4 different categories, return None
-    if len(set(categories)) == 4:
-        return None
-
-
-def scan_folder(folder_path):
-    for folder in os.walk(folder_path):
-        file_names = folder[2]
-        for file_name in file_names:
-            file_path = os.path.join(folder[0], file_name)
-            file_metadata = classify_file(file_path, print_step=False)
-            categories_dict = file_metadata.get("categories")
-            categories = list(cat["category"] for cat in categories_dict)
-            category = early_stop(categories)
-            if category is None:
-                category = get_true_category_v2_codellama(file_path, categories)
-            if category == "ELLIPTIC_CURVES":
-                category = "ElipticCurves"
-            yield file_path, category
-
-        for sub_folder in folder[1]:
-            scan_folder(sub_folder)
+    if not use_signatures:
+        stages = [stage for stage in stages if stage.name != "signatures"]
+    if not use_prefilter:
+        stages = [stage for stage in stages if stage.name != "prefilter"]
+    if not use_neardup or neardup_index is None:
+        stages = [stage for stage in stages if stage.name != "neardup"]
+    if manifest is not None:
+        stages.insert(0, Stage("manifest", partial(stat_item, manifest=manifest), queue_size=SCAN_QUEUE_SIZE))
+    def observe(stage, items, seconds):
+        metrics.observe_stage(stage, items, seconds)
+        if observer is not None:
+            observer(stage, items, seconds)
+
+    pipeline = Pipeline(stages, ordered=ordered, observer=observe)
+
+    if paths is None:
+        paths = discover_files(folder_path, **discovery_options)
+    if since is not None:
+        changed = git_changed_files(folder_path, since)
+        paths = (path for path in paths if os.path.realpath(path) in changed)
+    items = (ScanItem(index=index, path=path) for index, path in enumerate(paths))
+    for item in pipeline.run(items):
+        metrics.record_item(item)
+        if manifest is not None:
+            record_item(item, manifest)
+        yield item
+
+
+def scan_folder(folder_path, batch_size=CLASSIFY_BATCH_SIZE, ordered=True, decided_by: Optional[Counter] = None, **options):
+    # decided_by counts the files labeled by each stage
+    for item in scan_items(folder_path, batch_size=batch_size, ordered=ordered, **options):
+        if item.error is not None:
+            print(f"Could not scan {item.path}: {item.error}", file=sys.stderr)
+            continue
+        if decided_by is not None:
+            decided_by[item.stage] += 1
+        yield item.path, item.category
 
 
 if __name__ == "__main__":
-    folder_path = sys.argv[1]
-    for file, cat in scan_folder(folder_path):
+    import argparse
+    parser = argparse.ArgumentParser(description="Detect cryptographic code in a folder")
+    parser.add_argument("folder_path")
+    parser.add_argument(
+        "--completion-order",
+        action="store_true",
+        help="print results as soon as they are ready instead of in path order"
+    )
+    parser.add_argument("--include", action="append", help="only scan files matching this glob")
+    parser.add_argument("--exclude", action="append", help="skip files and folders matching this glob")
+    parser.add_argument(
+        "--language",
+        action="append",
+        choices=sorted(LANGUAGE_EXTENSIONS),
+        help="only scan files of this language (default: all)"
+    )
+    parser.add_argument("--max-size", type=int, default=DISCOVERY_MAX_FILE_SIZE, help="skip larger files (bytes)")
+    parser.add_argument("--no-gitignore", action="store_true", help="do not honour .gitignore files")
+    parser.add_argument("--manifest", default=SCAN_MANIFEST_PATH, help="results of previous scans (SQLite)")
+    parser.add_argument("--no-manifest", action="store_true", help="scan every file and do not record the results")
+    parser.add_argument("--since", metavar="GIT_REF", help="only scan files changed since this git ref")
+    parser.add_argument("--no-prefilter", action="store_true", help="do not label files by their crypto keywords")
+    parser.add_argument("--no-signatures", action="store_true", help="do not label files by known crypto constants")
+    parser.add_argument("--no-neardup", action="store_true", help="do not reuse the verdicts of near-duplicate files")
+    parser.add_argument("--metrics-port", type=int, default=METRICS_PORT, help="serve Prometheus metrics on this port")
+    args = parser.parse_args()
+    if metrics.serve(args.metrics_port):
+        print(f"Serving metrics on :{args.metrics_port}/metrics", file=sys.stderr)
+    skipped = Counter()
+    decided_by = Counter()
+    results = scan_folder(
+        args.folder_path,
+        ordered=not args.completion_order,
+        manifest=None if args.no_manifest else ScanManifest(args.manifest, verdict_version()),
+        since=args.since,
+        use_prefilter=not args.no_prefilter,
+        use_signatures=not args.no_signatures,
+        use_neardup=not args.no_neardup,
+        decided_by=decided_by,
+        include=args.include,
+        exclude=args.exclude,
+        languages=args.language,
+        max_file_size=args.max_size,
+        use_gitignore=not args.no_gitignore,
+        stats=skipped
+    )
+    for file, cat in results:
         print(f"File: {file} Category: {cat}")
+    print(f"Discovery: {dict(skipped)}", file=sys.stderr)
+    print(f"Decided by: {dict(decided_by)}", file=sys.stderr)
+    if llm_cache is not None:
+        print(f"LLM cache: {llm_cache.hits} hits, {llm_cache.misses} misses", file=sys.stderr)
+    if neardup_index is not None and neardup_index.lookups:
+        print(
+            f"Near-duplicates: {neardup_index.hits} of {neardup_index.lookups} files reused an earlier verdict "
+            f"({neardup_index.late_hits} after the kNN stage), skipping {neardup_index.saved_bytes} bytes of "
+            f"embedding and {neardup_index.saved_llm_calls} LLM adjudications",
+            file=sys.stderr
+        )
+    for model, stats in cascade.summary().items():
+        if stats["calls"]:
+            print(f"LLM tier {model}: {stats}", file=sys.stderr)
+    if prompt_tokens["prompts"]:
+        print(
+            f"Prompt tokens: {prompt_tokens['tokens']} of {prompt_tokens['full_tokens']} "
+            f"({prompt_tokens['saved']} saved in {prompt_tokens['prompts']} prompts)",
+            file=sys.stderr
+        )
+    print("Metrics:", file=sys.stderr)
+    for line in metrics.summary():
+        print(f"  {line}", file=sys.stderr)
 
 
 # from typing import Dict
@@ -0,0 +1,227 @@
+import hashlib
+import importlib
+import os
+import sys
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from functools import lru_cache
+from typing import List, Optional, Tuple
+from chunking import Chunk, chunk_text, split_lines
+from config import CHUNK_MAX_TOKENS, PARSE_CACHE_SIZE
+
+
+LANGUAGES_BY_EXTENSION = {
+    ".py": "python",
+    ".js": "javascript",
+    ".mjs": "javascript",
+    ".cjs": "javascript",
+    ".jsx": "javascript",
+    ".go": "go",
+    ".rb": "ruby",
+    ".c": "c",
+    ".h": "c",
+    ".rs": "rust",
+}
+
+# Nodes emitted as a single unit
+FUNCTION_NODES = {
+    "python": {"function_definition"},
+    "javascript": {"function_declaration", "generator_function_declaration", "method_definition"},
+    "go": {"function_declaration", "method_declaration"},
+    "ruby": {"method", "singleton_method"},
+    "c": {"function_definition"},
+    "rust": {"function_item"},
+}
+
+# Nodes whose functions are emitted one by one. A container without any
+# function inside is emitted as a whole.
+CONTAINER_NODES = {
+    "python": {"class_definition", "decorated_definition"},
+    "javascript": {"class_declaration", "class", "export_statement"},
+    "go": set(),
+    "ruby": {"class", "module", "singleton_class"},
+    "c": set(),
+    "rust": {"impl_item", "trait_item", "mod_item"},
+}
+
+
+@dataclass(init=True)
+class Unit:
+    kind: str
+    name: str
+    start_line: int
+    end_line: int
+    text: str
+    # Only set for the module unit, whose lines are not contiguous
+    line_numbers: List[int] = field(default_factory=list)
+
+
+_trees = OrderedDict()
+_lock = threading.Lock()
+
+
+def language_for_file(file_path: str) -> Optional[str]:
+    return LANGUAGES_BY_EXTENSION.get(os.path.splitext(file_path)[1].lower())
+
+
+@lru_cache(maxsize=None)
+def _parser(language: str):
+    # Loaded on first use, from tree_sitter_language_pack or else from the
+    # grammar package of the language alone. None when neither is installed:
+    # the files of that language are then chunked as plain text.
+    try:
+        from tree_sitter_language_pack import get_parser
+        return get_parser(language)
+    except ImportError:
+        pass
+    try:
+        from tree_sitter import Language, Parser
+        grammar = importlib.import_module(f"tree_sitter_{language}")
+        return Parser(Language(grammar.language()))
+    except ImportError as e:
+        print(f"No tree-sitter parser for {language} ({e}), chunking its files as text", file=sys.stderr)
+        return None
+
+
+def parse(code: str, language: str):
+    # Trees are cached by content so that identical files, and repeated
+    # scans of the same file, are only parsed once per process. None without
+    # a parser for the language.
+    parser = _parser(language)
+    if parser is None:
+        return None
+    key = (language, hashlib.sha256(code.encode()).hexdigest())
+    with _lock:
+        tree = _trees.get(key)
+        if tree is not None:
+            _trees.move_to_end(key)
+            return tree
+        tree = parser.parse(code.encode())
+        _trees[key] = tree
+        if len(_trees) > PARSE_CACHE_SIZE:
+            _trees.popitem(last=False)
+        return tree
+
+
+def _unit_nodes(root, language: str) -> list:
+    # Iterative walk that stops at function nodes. A container is kept as a
+    # unit only when no function was found anywhere below it.
+    functions = FUNCTION_NODES[language]
+    containers = CONTAINER_NODES[language]
+    nodes = []
+    stack = [[root, iter(root.named_children), False, 0]]
+    while stack:
+        frame = stack[-1]
+        child = next(frame[1], None)
+        if child is None:
+            node, _, found, mark = stack.pop()
+            if not stack:
+                break
+            if found:
+                stack[-1][2] = True
+            elif node.type in containers:
+                del nodes[mark:]
+                nodes.append(node)
+        elif child.type in functions:
+            nodes.append(child)
+            frame[2] = True
+        else:
+            stack.append([child, iter(child.named_children), False, len(nodes)])
+    return sorted(nodes, key=lambda node: node.start_byte)
+
+
+def _name_of(node) -> str:
+    # C keeps the name inside nested declarators, decorated and exported
+    # definitions wrap the node that has it.
+    while node is not None:
+        if node.type in ("identifier", "field_identifier"):
+            return node.text.decode(errors="replace")
+        name = node.child_by_field_name("name")
+        if name is not None:
+            return name.text.decode(errors="replace")
+        node = (
+            node.child_by_field_name("declarator")
+            or node.child_by_field_name("definition")
+            or node.child_by_field_name("declaration")
+        )
+    return ""
+
+
+def extract_units(code: str, language: str) -> List[Unit]:
+    tree = parse(code, language)
+    if tree is None:
+        return []
+    source = code.encode()
+    units = [
+        Unit(
+            kind=node.type,
+            name=_name_of(node),
+            start_line=node.start_point[0] + 1,
+            end_line=node.end_point[0] + 1,
+            text=source[node.start_byte:node.end_byte].decode(errors="replace")
+        )
+        for node in _unit_nodes(tree.root_node, language)
+    ]
+
+    # Whatever is left (imports, globals, top level statements) becomes one
+    # more unit; imports are often the strongest hint of crypto usage.
+    lines = split_lines(code)
+    covered = set()
+    for unit in units:
+        covered.update(range(unit.start_line, unit.end_line + 1))
+    rest = [(number, line) for number, line in enumerate(lines, start=1) if number not in covered]
+    if units and any(line.strip() for _, line in rest):
+        units.insert(0, Unit(
+            kind="module",
+            name="",
+            start_line=rest[0][0],
+            end_line=rest[-1][0],
+            text="".join(line for _, line in rest),
+            line_numbers=[number for number, _ in rest]
+        ))
+    return units
+
+
+def line_runs(numbers: List[int], lines: List[str]) -> List[Tuple[int, int]]:
+    # (first, last) runs of consecutive line numbers, without the blank lines
+    # at their ends; runs of blank lines only are dropped
+    runs = []
+    for number in numbers:
+        if runs and runs[-1][1] == number - 1:
+            runs[-1][1] = number
+        else:
+            runs.append([number, number])
+    trimmed = []
+    for first, last in runs:
+        while first <= last and not lines[first - 1].strip():
+            first += 1
+        while last >= first and not lines[last - 1].strip():
+            last -= 1
+        if first <= last:
+            trimmed.append((first, last))
+    return trimmed
+
+
+def segment_file(file_path: str, code: str, max_tokens: int = CHUNK_MAX_TOKENS) -> List[Chunk]:
+    language = language_for_file(file_path)
+    units = extract_units(code, language) if language is not None else []
+    if not units:
+        return chunk_text(code, max_tokens=max_tokens)
+
+    chunks = []
+    for unit in units:
+        if unit.kind == "module":
+            # Embedded together, imports and top level code say more as a
+            # whole, but reported as the runs of lines they are made of
+            lines = split_lines(code)
+            for chunk in chunk_text(unit.text, max_tokens=max_tokens):
+                chunk.line_runs = line_runs(unit.line_numbers[chunk.start_line - 1:chunk.end_line], lines)
+                chunk.start_line = unit.line_numbers[chunk.start_line - 1]
+                chunk.end_line = unit.line_numbers[chunk.end_line - 1]
+                chunks.append(chunk)
+        else:
+            for chunk in chunk_text(unit.text, max_tokens=max_tokens, first_line=unit.start_line):
+                chunk.name = unit.name
+                chunks.append(chunk)
+    return chunks
@@ -0,0 +1,396 @@
+import math
+import re
+from collections import deque
+from dataclasses import dataclass
+from functools import lru_cache
+from itertools import chain
+from typing import Dict, List, Optional, Sequence, Tuple
+from config import SIGNATURE_MIN_CONFIDENCE
+from vecstore import Category
+
+
+# Candidate tokens: anything starting with a digit, "\xNN" escapes of byte
+# strings and a few magic strings. All the alternatives start with one of
+# [0-9\\e], which lets the regex engine skip ahead without trying each of
+# them at every offset. Digits inside identifiers ("sha256") are also picked
+# up; they never sit in the middle of a constant table, so they are harmless.
+TOKEN_REGEX = re.compile(r"[0-9\\e](?:(?<=[0-9])[0-9a-zA-Z_]*|(?<=\\)x[0-9a-fA-F]{2}|(?<=e)xpand [13][62]-byte k)")
+# Hex and decimal literals, with digit separators and C/Rust/JS suffixes
+NUMBER_REGEX = re.compile(r"(?:0[xX]([0-9a-fA-F_]*[0-9a-fA-F][0-9a-fA-F_]*)|([0-9][0-9_]*))(?:[uUlLnN]{1,3}|_?[ui](?:8|16|32|64|128|size))?")
+
+# Magic strings get symbols no literal can produce
+MAGIC_STRINGS = {"expand 32-byte k": -1, "expand 16-byte k": -2}
+
+WORD_MASK = 0xFFFFFFFF
+
+
+def literal_words(digits: str, base: int) -> List[int]:
+    # Values of more than 32 bits are split into big-endian 32 bit words, so
+    # that a single big literal and an array of limbs look the same. Leading
+    # zeros of hex literals count ("0x0000000000008082" is two words).
+    value = int(digits, base)
+    bits = value.bit_length()
+    if base == 16:
+        bits = max(bits, 4 * len(digits))
+    count = max(1, (bits + 31) // 32)
+    return [(value >> (32 * i)) & WORD_MASK for i in reversed(range(count))]
+
+
+def _words(value: int, bits: int) -> List[int]:
+    return [(value >> (32 * i)) & WORD_MASK for i in reversed(range(max(1, (bits + 31) // 32)))]
+
+
+def _icbrt(n: int) -> int:
+    x = 1 << ((n.bit_length() + 2) // 3)
+    while True:
+        y = (2 * x + n // (x * x)) // 3
+        if y >= x:
+            return x
+        x = y
+
+
+def _primes(count: int) -> List[int]:
+    primes = []
+    n = 2
+    while len(primes) < count:
+        if all(n % p for p in primes if p * p <= n):
+            primes.append(n)
+        n += 1
+    return primes
+
+
+def _aes_sboxes() -> Tuple[List[int], List[int]]:
+    sbox = [0] * 256
+    p = q = 1
+    while True:
+        # p * 3 and q / 3 in GF(2^8), so q is always the inverse of p
+        p = p ^ ((p << 1) & 0xFF) ^ (0x1B if p & 0x80 else 0)
+        q ^= q << 1
+        q ^= q << 2
+        q ^= q << 4
+        q &= 0xFF
+        if q & 0x80:
+            q ^= 0x09
+        x = q
+        for shift in range(1, 5):
+            x ^= ((q << shift) | (q >> (8 - shift))) & 0xFF
+        sbox[p] = x ^ 0x63
+        if p == 1:
+            break
+    sbox[0] = 0x63
+    inverse = [0] * 256
+    for i, s in enumerate(sbox):
+        inverse[s] = i
+    return sbox, inverse
+
+
+def _aes_te0(sbox: List[int]) -> List[int]:
+    def times2(x):
+        return ((x << 1) ^ (0x1B if x & 0x80 else 0)) & 0xFF
+    return [(times2(s) << 24) | (s << 16) | (s << 8) | (times2(s) ^ s) for s in sbox]
+
+
+def _keccak_round_constants() -> List[int]:
+    constants = []
+    r = 1
+    for _ in range(24):
+        rc = 0
+        for j in range(7):
+            if r & 1:
+                rc ^= 1 << ((1 << j) - 1)
+            r = ((r << 1) ^ 0x71) & 0xFF if r & 0x80 else r << 1
+        constants.append(rc)
+    return constants
+
+
+PRIMES = _primes(80)
+SHA256_K = [_icbrt(p << 96) & WORD_MASK for p in PRIMES[:64]]
+SHA256_H = [math.isqrt(p << 64) & WORD_MASK for p in PRIMES[:8]]
+SHA512_K = [_icbrt(p << 192) & 0xFFFFFFFFFFFFFFFF for p in PRIMES]
+SHA512_H = [math.isqrt(p << 128) & 0xFFFFFFFFFFFFFFFF for p in PRIMES[:8]]
+SHA1_CONSTANTS = [0x5A827999, 0x6ED9EBA1, 0x8F1BBCDC, 0xCA62C1D6, 0xC3D2E1F0]
+KECCAK_RC = _keccak_round_constants()
+MD5_T = [int(abs(math.sin(i + 1)) * 2 ** 32) & WORD_MASK for i in range(64)]
+AES_SBOX, AES_INV_SBOX = _aes_sboxes()
+AES_TE0 = _aes_te0(AES_SBOX)
+DES_S1 = [
+    14, 4, 13, 1, 2, 15, 11, 8, 3, 10, 6, 12, 5, 9, 0, 7,
+    0, 15, 7, 4, 14, 2, 13, 1, 10, 6, 12, 11, 9, 5, 3, 8,
+    4, 1, 14, 8, 13, 6, 2, 11, 15, 12, 9, 7, 3, 10, 5, 0,
+    15, 12, 8, 2, 4, 9, 1, 7, 5, 11, 3, 14, 10, 0, 6, 13,
+]
+DES_IP = [
+    58, 50, 42, 34, 26, 18, 10, 2, 60, 52, 44, 36, 28, 20, 12, 4,
+    62, 54, 46, 38, 30, 22, 14, 6, 64, 56, 48, 40, 32, 24, 16, 8,
+    57, 49, 41, 33, 25, 17, 9, 1, 59, 51, 43, 35, 27, 19, 11, 3,
+    61, 53, 45, 37, 29, 21, 13, 5, 63, 55, 47, 39, 31, 23, 15, 7,
+]
+CAMELLIA_SIGMA = [
+    0xA09E667F3BCC908B, 0xB67AE8584CAA73B2, 0xC6EF372FE94F82BE,
+    0x54FF53A5F1D36F1C, 0x10E527FADE682D1D, 0xB05688C2B3E6C1FD,
+]
+# "expand 32-byte k" as little-endian words
+CHACHA_WORDS = [0x61707865, 0x3320646E, 0x79622D32, 0x6B206574]
+P256 = [
+    0xFFFFFFFF00000001000000000000000000000000FFFFFFFFFFFFFFFFFFFFFFFF,
+    0x5AC635D8AA3A93E7B3EBBD55769886BC651D06B0CC53B0F63BCE3C3E27D2604B,
+    0xFFFFFFFF00000000FFFFFFFFFFFFFFFFBCE6FAADA7179E84F3B9CAC2FC632551,
+    0x6B17D1F2E12C4247F8BCE6E563A440F277037D812DEB33A0F4A13945D898C296,
+    0x4FE342E2FE1A7F9B8EE7EB4A7C0F9E162BCE33576B315ECECBB6406837BF51F5,
+]
+SECP256K1 = [
+    0xFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFEFFFFFC2F,
+    0xFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFEBAAEDCE6AF48A03BBFD25E8CD0364141,
+    0x79BE667EF9DCBBAC55A06295CE870B07029BFCDB2DCE28D959F2815B16F81798,
+    0x483ADA7726A3C4655DA4FBFC0E1108A8FD17B448A68554199C47D08FFB10D4B8,
+]
+ED25519 = [
+    2 ** 255 - 19,
+    # d and the order of the base point
+    0x52036CEE2B6FFE738CC740797779E89800700A4D4141D8AB75EB4DCA135978A3,
+    0x1000000000000000000000000000000014DEF9DEA2F79CD65812631A5CF5D3ED,
+]
+ED448 = [
+    2 ** 448 - 2 ** 224 - 1,
+    2 ** 446 - 0x8335DC163BB124B65129C96FDE933D8D723A70AADC873D6D54A7BB0D,
+]
+# Start of every RFC 2409/3526 MODP prime, the binary expansion of pi
+MODP_PREFIX = 0xFFFFFFFFFFFFFFFFC90FDAA22168C234C4C6628B80DC1CD129024E088A67CC74
+
+
+@dataclass(init=True)
+class Table:
+    name: str
+    category: str
+    # Each pattern is a sequence of words: a whole table entry, or `window`
+    # consecutive entries for tables of small values
+    patterns: List[Tuple[int, ...]]
+    # Distinct patterns that have to be found for full confidence
+    required: int
+    # Confidence of a table that is fully matched
+    weight: float = 1.0
+
+
+def _value_table(name, category, values, bits, required, weight=1.0) -> Table:
+    # Tables of large, distinctive values: every entry is a pattern, except
+    # the few small ones that show up in any code (Te0 has a zero)
+    return Table(name, category, [tuple(_words(value, bits)) for value in values if value >= 1 << 16], required, weight)
+
+
+def _window_table(name, category, values, window, required, weight=1.0) -> Table:
+    # Tables of small values: runs of `window` consecutive entries
+    return Table(
+        name,
+        category,
+        [tuple(values[i:i + window]) for i in range(len(values) - window + 1)],
+        required,
+        weight
+    )
+
+
+def _constant_table(name, category, values, bits, required, weight=1.0) -> Table:
+    # Big constants as one literal or as arrays of 32 bit limbs, 64 bit limbs
+    # or bytes, in both limb orders
+    patterns = []
+    for value in values:
+        words = _words(value, bits)
+        pairs = [words[i:i + 2] for i in range(0, len(words), 2)]
+        data = value.to_bytes((bits + 7) // 8, "big")
+        patterns.append(tuple(words))
+        patterns.append(tuple(reversed(words)))
+        patterns.append(tuple(word for pair in reversed(pairs) for word in pair))
+        patterns.append(tuple(data))
+        patterns.append(tuple(reversed(data)))
+    return Table(name, category, patterns, required, weight)
+
+
+TABLES = [
+    _value_table("sha256_k", Category.SHA.value, SHA256_K, 32, 8),
+    _value_table("sha256_h", Category.SHA.value, SHA256_H, 32, 4),
+    _value_table("sha512_k", Category.SHA.value, SHA512_K, 64, 8),
+    _value_table("sha1", Category.SHA.value, SHA1_CONSTANTS, 32, 3),
+    _value_table("keccak_rc", Category.SHA.value, [rc for rc in KECCAK_RC if rc >= 1 << 32], 64, 6),
+    _value_table("md5_t", Category.MD5.value, MD5_T, 32, 8),
+    _window_table("aes_sbox", Category.AES.value, AES_SBOX, 8, 4),
+    _window_table("aes_inv_sbox", Category.AES.value, AES_INV_SBOX, 8, 4),
+    _value_table("aes_te0", Category.AES.value, AES_TE0, 32, 8),
+    _window_table("des_s1", Category.DES.value, DES_S1, 8, 4),
+    _window_table("des_ip", Category.DES.value, DES_IP, 8, 4),
+    _window_table("des_ip0", Category.DES.value, [x - 1 for x in DES_IP], 8, 4),
+    _value_table("camellia_sigma", Category.CAMELLIA.value, CAMELLIA_SIGMA, 64, 4),
+    _value_table("camellia_sigma32", Category.CAMELLIA.value, [w for s in CAMELLIA_SIGMA for w in _words(s, 64)], 32, 6),
+    _value_table("chacha_words", Category.CHACHA20.value, CHACHA_WORDS, 32, 4),
+    Table("chacha_magic", Category.CHACHA20.value, [(symbol,) for symbol in MAGIC_STRINGS.values()], 1),
+    _constant_table("p256", Category.ELIPTIC_CURVE.value, P256, 256, 1),
+    _constant_table("secp256k1", Category.ELIPTIC_CURVE.value, SECP256K1, 256, 1),
+    # 2**256 - 2**32 - 977 and friends, as written in Python implementations
+    Table("curve_expressions", Category.ELIPTIC_CURVE.value, [(2, 256, 2, 32, 977), (2, 256, 2, 224, 2, 192, 2, 96, 1)], 1),
+    _constant_table("ed25519", Category.ED25519.value, ED25519, 256, 1, 0.9),
+    Table("ed25519_expressions", Category.ED25519.value, [(2, 255, 19), (121665,), (121666,), (2, 252, 27742317777372353535851937790883648493)], 2, 0.9),
+    _constant_table("ed448", Category.ED448.value, ED448, 448, 1),
+    Table("ed448_expressions", Category.ED448.value, [(2, 448, 2, 224, 1), (39081,)], 2, 0.9),
+    _constant_table("modp_prime", Category.DIFFIE_HELLMAN.value, [MODP_PREFIX], 256, 1, 0.8),
+    _value_table("modp_prime32", Category.DIFFIE_HELLMAN.value, _words(MODP_PREFIX, 256)[2:], 32, 4, 0.8),
+    _value_table("hmac_pads", Category.HMAC.value, [0x36363636, 0x5C5C5C5C], 32, 2, 0.8),
+    # The usual public exponent alone is only a hint
+    Table("rsa_exponent", Category.RSA.value, [(65537,)], 1, 0.5),
+]
+
+
+# Aho-Corasick automaton over word sequences: every literal of a file is fed
+# once, and all the patterns of all the tables are matched in that pass.
+class Automaton:
+    def __init__(self, patterns: Sequence[Tuple[Tuple[int, ...], object]]):
+        self.goto: List[Dict[int, int]] = [{}]
+        self.outputs: List[List[object]] = [[]]
+        for symbols, output in patterns:
+            state = 0
+            for symbol in symbols:
+                next_state = self.goto[state].get(symbol)
+                if next_state is None:
+                    next_state = len(self.goto)
+                    self.goto[state][symbol] = next_state
+                    self.goto.append({})
+                    self.outputs.append([])
+                state = next_state
+            self.outputs[state].append(output)
+        self.alphabet = {symbol for edges in self.goto for symbol in edges}
+
+        self.fail = [0] * len(self.goto)
+        pending = deque(self.goto[0].values())
+        while pending:
+            state = pending.popleft()
+            for symbol, next_state in self.goto[state].items():
+                pending.append(next_state)
+                fallback = self.fail[state]
+                while fallback and symbol not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                target = self.goto[fallback].get(symbol, 0)
+                self.fail[next_state] = target if target != next_state else 0
+                self.outputs[next_state] = self.outputs[next_state] + self.outputs[self.fail[next_state]]
+
+    def search(self, symbols: Sequence[int]):
+        # Yields (index of the last symbol, output) of every match
+        goto = self.goto
+        fail = self.fail
+        outputs = self.outputs
+        alphabet = self.alphabet
+        state = 0
+        for index, symbol in enumerate(symbols):
+            if symbol not in alphabet:
+                # No pattern goes through this symbol
+                state = 0
+                continue
+            while state and symbol not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(symbol, 0)
+            for output in outputs[state]:
+                yield index, output
+
+
+AUTOMATON = Automaton([
+    (pattern, (table_index, pattern_index))
+    for table_index, table in enumerate(TABLES)
+    for pattern_index, pattern in enumerate(table.patterns)
+])
+
+
+@dataclass(init=True)
+class SignatureResult:
+    # Category with enough confidence, None when there is none or several
+    category: Optional[str]
+    confidence: float
+    # Confidence of every category with at least one hit
+    scores: Dict[str, float]
+    # (line number, table name) of every hit
+    hits: List[tuple]
+
+
+@lru_cache(maxsize=65536)
+def token_words(token: str) -> Tuple[int, ...]:
+    if token.startswith("\\x"):
+        return (int(token[2:], 16),)
+    if token.startswith("e"):
+        return (MAGIC_STRINGS[token],)
+    match = NUMBER_REGEX.fullmatch(token)
+    if match is None:
+        # "32_t", "1e5", "3des"...
+        return ()
+    hex_digits, decimal_digits = match.groups()
+    if hex_digits is not None:
+        return tuple(literal_words(hex_digits.replace("_", ""), 16))
+    return tuple(literal_words(decimal_digits.replace("_", ""), 10))
+
+
+def literal_symbols(code: str) -> List[int]:
+    # Words of every literal of the file, in order
+    return list(chain.from_iterable(map(token_words, TOKEN_REGEX.findall(code))))
+
+
+def symbol_offsets(code: str) -> List[int]:
+    # Offset in the file of every symbol of literal_symbols. Only needed to
+    # report where the hits are, so it is not part of the fast path.
+    offsets = []
+    for match in TOKEN_REGEX.finditer(code):
+        offsets.extend([match.start()] * len(token_words(match.group())))
+    return offsets
+
+
+def match_signatures(code: str) -> SignatureResult:
+    symbols = literal_symbols(code)
+    found: Dict[int, set] = {}
+    matched = []
+    for index, (table_index, pattern_index) in AUTOMATON.search(symbols):
+        found.setdefault(table_index, set()).add(pattern_index)
+        matched.append((index, table_index))
+    if not matched:
+        return SignatureResult(category=None, confidence=0.0, scores={}, hits=[])
+    offsets = symbol_offsets(code)
+    located = [(offsets[index], TABLES[table_index].name) for index, table_index in matched]
+
+    missing: Dict[str, float] = {}
+    for table_index, pattern_indices in found.items():
+        table = TABLES[table_index]
+        confidence = table.weight * min(1.0, len(pattern_indices) / table.required)
+        missing[table.category] = missing.get(table.category, 1.0) * (1.0 - confidence)
+    scores = {category: 1.0 - value for category, value in missing.items()}
+
+    hits = []
+    line = 1
+    position = 0
+    for start, name in sorted(set(located)):
+        line += code.count("\n", position, start)
+        position = start
+        hits.append((line, name))
+
+    confident = [category for category, score in scores.items() if score >= SIGNATURE_MIN_CONFIDENCE]
+    category = confident[0] if len(confident) == 1 else None
+    confidence = max(scores.values(), default=0.0)
+    return SignatureResult(category=category, confidence=confidence, scores=scores, hits=hits)
+
+
+if __name__ == '__main__':
+    # python signatures.py <folder>...: labels and throughput of the engine
+    import sys
+    import time
+    from discovery import discover_files
+
+    size = 0
+    labeled = 0
+    elapsed = 0.0
+    files = 0
+    for folder in sys.argv[1:]:
+        for file_path in discover_files(folder):
+            with open(file_path, errors="replace") as f:
+                code = f.read()
+            start = time.perf_counter()
+            result = match_signatures(code)
+            elapsed += time.perf_counter() - start
+            size += len(code)
+            files += 1
+            if result.scores:
+                scores = ", ".join(f"{category} {score:.2f}" for category, score in sorted(result.scores.items()))
+                print(f"{file_path}: {result.category} ({scores})")
+            if result.category is not None:
+                labeled += 1
+    print(f"Files: {files}, labeled: {labeled}, {size / 1e6 / max(elapsed, 1e-9):.1f} MB/s")
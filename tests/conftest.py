@@ -0,0 +1,45 @@
+import os
+import socket
+import sys
+import tempfile
+import pytest
+
+
+# config reads the environment on import, so everything the scanner stores
+# goes to a temporary folder, embeddings are computed in-process and the LLM
+# is a fake server, before any module of the scanner loads
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+STATE = tempfile.mkdtemp(prefix="tfm-tests-")
+with socket.socket() as s:
+    s.bind(("127.0.0.1", 0))
+    PORT = s.getsockname()[1]
+os.environ.update({
+    "TFM_OLLAMA_HOST": f"http://127.0.0.1:{PORT}",
+    "TFM_EMBEDDING_BACKEND": "hashing",
+    "TFM_HASHING_IDF_PATH": "",
+    "TFM_EMBEDDING_CACHE_DIR": "",
+    "TFM_LLM_CACHE_PATH": "",
+    "TFM_VECTOR_BACKEND": "numpy",
+    "TFM_NPINDEX_DIR": os.path.join(STATE, "npindex"),
+    "TFM_PROTOTYPES_DIR": os.path.join(STATE, "prototypes"),
+    "TFM_NEARDUP_PATH": os.path.join(STATE, "neardup.sqlite"),
+    "TFM_ROUTING_THRESHOLDS_PATH": os.path.join(STATE, "routing_thresholds.json"),
+    "TFM_SCAN_MANIFEST_PATH": os.path.join(STATE, "scan_manifest.sqlite"),
+})
+
+
+@pytest.fixture(scope="session")
+def fake_ollama():
+    from fake_ollama import FakeOllama
+    with FakeOllama(port=PORT) as fake:
+        yield fake
+
+
+@pytest.fixture(scope="session")
+def references():
+    # The labeled examples, as benchmark.seed_references does
+    from ingest import ingest, labeled_tree
+    from vecstore import collection
+    ingest(labeled_tree(os.path.join(ROOT, "examples")), progress=False)
+    return collection
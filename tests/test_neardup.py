@@ -0,0 +1,47 @@
+import os
+from neardup import NearDupIndex, similarity, sketch
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def read_example(*parts: str) -> str:
+    with open(os.path.join(ROOT, "examples", *parts)) as f:
+        return f.read()
+
+
+def test_identical_code_is_fully_similar():
+    code = read_example("RSA", "RSA.py")
+    assert similarity(sketch(code), sketch(code)) == 1.0
+
+
+def test_renamed_and_reformatted_copy_is_similar():
+    code = read_example("RSA", "RSA.py")
+    edited = code.replace("    ", "\t") + "\n# Copied from the examples\n"
+    assert similarity(sketch(code), sketch(edited)) >= 0.8
+
+
+def test_unrelated_code_is_dissimilar():
+    rsa = sketch(read_example("RSA", "RSA.py"))
+    chat = sketch(read_example("NOCRYPTO", "chat.py"))
+    assert similarity(rsa, chat) < 0.2
+
+
+def test_similarity_estimates_jaccard():
+    a = sketch(" ".join(f"token{i}" for i in range(400)))
+    b = sketch(" ".join(f"token{i}" for i in range(200, 600)))
+    # The shingle sets share about a third of their union
+    assert abs(similarity(a, b) - 1 / 3) < 0.1
+
+
+def test_code_without_tokens_has_no_sketch():
+    assert sketch("  \n\t") is None
+
+
+def test_lookup_ignores_other_versions(tmp_path):
+    code = read_example("SHA", "SHA.py")
+    signature = sketch(code)
+    old = NearDupIndex(str(tmp_path / "neardup.sqlite"), "v1")
+    old.add("abc", "SHA.py", "SHA", "knn", signature)
+    assert old.lookup(signature).category == "SHA"
+    assert NearDupIndex(str(tmp_path / "neardup.sqlite"), "v2").lookup(signature) is None
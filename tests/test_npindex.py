@@ -0,0 +1,65 @@
+import numpy as np
+import pytest
+from npindex import NumpyIndex
+
+
+def brute_force(vectors: np.ndarray, queries: np.ndarray, k: int):
+    distances = ((queries[:, None, :] - vectors[None, :, :]) ** 2).sum(axis=2)
+    # Ties by insertion order, as top_k breaks them
+    indices = np.argsort(distances, axis=1, kind="stable")[:, :k]
+    return indices, np.take_along_axis(distances, indices, axis=1)
+
+
+def random_index(path, quantization: str, rerank: int = 64, count: int = 500, dim: int = 32, seed: int = 0):
+    vectors = np.random.default_rng(seed).normal(size=(count, dim)).astype(np.float32)
+    index = NumpyIndex(str(path), quantization=quantization, rerank=rerank)
+    index.upsert([f"id{i}" for i in range(count)], embeddings=vectors)
+    return index, vectors
+
+
+@pytest.mark.parametrize("quantization", ["none", "int8", "binary"])
+def test_exact_top_k_matches_brute_force(tmp_path, quantization):
+    index, vectors = random_index(tmp_path, quantization)
+    queries = np.random.default_rng(1).normal(size=(20, vectors.shape[1])).astype(np.float32)
+    indices, distances = index.top_k(queries, 5, exact=True)
+    expected_indices, expected_distances = brute_force(vectors, queries, 5)
+    np.testing.assert_array_equal(indices, expected_indices)
+    np.testing.assert_allclose(distances, expected_distances, rtol=1e-4, atol=1e-4)
+
+
+@pytest.mark.parametrize("quantization", ["int8", "binary"])
+def test_reranked_distances_are_exact(tmp_path, quantization):
+    # Whatever the candidates, the distances returned are the float ones,
+    # and with every row a candidate the result is the brute force one
+    index, vectors = random_index(tmp_path, quantization, rerank=16)
+    queries = vectors[:10] + 0.01
+    indices, distances = index.top_k(queries, 3)
+    exact = ((queries[:, None, :] - vectors[indices]) ** 2).sum(axis=2)
+    np.testing.assert_allclose(distances, exact, rtol=1e-4, atol=1e-4)
+    np.testing.assert_array_equal(indices[:, 0], np.arange(10))
+
+    index.rerank = len(vectors)
+    expected_indices, _ = brute_force(vectors, queries, 3)
+    np.testing.assert_array_equal(index.top_k(queries, 3)[0], expected_indices)
+
+
+def test_top_k_after_reload_and_upserts(tmp_path):
+    index, vectors = random_index(tmp_path, "none", count=50)
+    replaced = np.zeros((1, vectors.shape[1]), dtype=np.float32)
+    index.upsert(["id7"], embeddings=replaced)
+    index.upsert([], embeddings=[])
+    vectors[7] = replaced[0]
+
+    reloaded = NumpyIndex(str(tmp_path), quantization="none")
+    assert reloaded.count() == 50
+    queries = np.random.default_rng(2).normal(size=(5, vectors.shape[1])).astype(np.float32)
+    indices, distances = reloaded.top_k(queries, 50)
+    expected_indices, expected_distances = brute_force(vectors, queries, 50)
+    np.testing.assert_array_equal(indices, expected_indices)
+    np.testing.assert_allclose(distances, expected_distances, rtol=1e-4, atol=1e-4)
+
+
+def test_top_k_of_an_empty_index(tmp_path):
+    index = NumpyIndex(str(tmp_path), quantization="none")
+    indices, distances = index.top_k(np.zeros((2, 8), dtype=np.float32), 4)
+    assert indices.shape == (2, 0) and distances.shape == (2, 0)
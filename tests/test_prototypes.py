@@ -0,0 +1,71 @@
+import os
+import numpy as np
+import routing
+from categorize import embed_segments, query_prototypes, query_segments
+from conftest import ROOT
+from prototypes import PrototypeIndex
+from segmentation import segment_file
+
+
+def clusters(seed: int = 0):
+    # Two categories around opposite corners
+    rng = np.random.default_rng(seed)
+    a = rng.normal(loc=1.0, scale=0.1, size=(20, 8))
+    b = rng.normal(loc=-1.0, scale=0.1, size=(20, 8))
+    return np.vstack([a, b]).astype(np.float32), ["A"] * 20 + ["B"] * 20
+
+
+def test_query_returns_the_nearest_prototype_of_every_category():
+    embeddings, categories = clusters()
+    index = PrototypeIndex.build(embeddings, categories, per_category=3)
+    documents = index.query(np.full((1, 8), 0.9, dtype=np.float32), n_results=4)
+    assert [metadata["category"] for metadata in documents["metadatas"][0]] == ["A", "B"]
+    assert documents["distances"][0][0] < documents["distances"][0][1]
+
+
+def test_margins_are_large_near_a_category_and_small_between_two():
+    embeddings, categories = clusters()
+    index = PrototypeIndex.build(embeddings, categories, per_category=1)
+    margins = index.margins(np.asarray([np.full(8, 1.0), np.zeros(8)], dtype=np.float32))
+    assert margins[0] > 0.9
+    assert margins[1] < 0.1
+
+
+def test_without_takes_references_back_out():
+    embeddings, categories = clusters()
+    index = PrototypeIndex.build(embeddings, categories, per_category=2)
+    extra = np.full((1, 8), 2.0, dtype=np.float32)
+    index.add(extra, ["A"])
+    restored = index.without(extra, ["A"])
+    assert restored.references == len(embeddings)
+    np.testing.assert_allclose(restored.counts.sum(), len(embeddings))
+
+
+def segments_of(*parts: str):
+    path = os.path.join(ROOT, "examples", *parts)
+    with open(path) as f:
+        segments = [segment_file(path, f.read())]
+    return segments, embed_segments(segments)
+
+
+def test_uncalibrated_prototype_answers_fall_through_to_the_collection(references, monkeypatch):
+    monkeypatch.setattr(routing, "thresholds", {})
+    segments, embeddings = segments_of("NOCRYPTO", "chat.py")
+    assert query_prototypes(segments, embeddings, margin=0.0) == [None]
+    response = query_segments(segments, embeddings=embeddings)[0]
+    assert not response.get("prototypes")
+    assert routing.route(response).category == "NOCRYPTO"
+
+
+def test_calibrated_prototype_answers_skip_the_collection(references, monkeypatch):
+    categories = {metadata["category"] for metadata in references.get(include=["metadatas"])["metadatas"]}
+    thresholds = {f"prototypes:{category}": 0.0 for category in categories}
+    monkeypatch.setattr(routing, "thresholds", {**thresholds, routing.PROTOTYPE_MARGIN_KEY: 0.0})
+    segments, embeddings = segments_of("NOCRYPTO", "chat.py")
+    response = query_segments(segments, embeddings=embeddings)[0]
+    assert response["prototypes"]
+    assert routing.route(response).category == "NOCRYPTO"
+    assert not routing.route(response).escalate
+    # Files not ahead of the runner-up by the margin still go through it
+    monkeypatch.setitem(routing.thresholds, routing.PROTOTYPE_MARGIN_KEY, 1.1)
+    assert query_prototypes(segments, embeddings) == [None]
@@ -0,0 +1,64 @@
+import pytest
+from config import ROUTING_DEFAULT_THRESHOLD
+from routing import calibrate, route, routing_cost
+
+
+def test_calibrate_keeps_the_lowest_precise_threshold():
+    samples = [
+        ("RSA", 0.9, "RSA"),
+        ("RSA", 0.8, "RSA"),
+        ("RSA", 0.7, "RSA"),
+        ("RSA", 0.6, "SHA"),
+        ("RSA", 0.5, "RSA"),
+    ]
+    # Down to 0.7 every kept decision is right, at 0.5 four out of five
+    assert calibrate(samples, target_precision=1.0) == {"RSA": 0.7}
+    assert calibrate(samples, target_precision=0.8) == {"RSA": 0.5}
+
+
+def test_calibrate_per_predicted_category():
+    samples = [
+        ("RSA", 0.9, "RSA"),
+        ("RSA", 0.4, "RSA"),
+        ("SHA", 0.9, "SHA"),
+        ("SHA", 0.4, "MD5"),
+    ]
+    assert calibrate(samples, target_precision=1.0) == {"RSA": 0.4, "SHA": 0.9}
+
+
+def test_calibrate_only_cuts_between_distinct_confidences():
+    # The wrong and the right decision at 0.6 are kept or escalated together
+    samples = [("RSA", 0.9, "RSA"), ("RSA", 0.6, "RSA"), ("RSA", 0.6, "SHA")]
+    assert calibrate(samples, target_precision=1.0) == {"RSA": 0.9}
+
+
+def test_calibrate_escalates_categories_never_precise_enough():
+    samples = [("MD5", 0.9, "SHA"), ("MD5", 0.5, "SHA")]
+    assert calibrate(samples, target_precision=0.95) == {"MD5": ROUTING_DEFAULT_THRESHOLD}
+
+
+def test_routing_cost_of_calibrated_thresholds():
+    samples = [
+        ("RSA", 0.9, "RSA"),
+        ("RSA", 0.8, "RSA"),
+        ("RSA", 0.6, "SHA"),
+        ("SHA", 0.5, "SHA"),
+    ]
+    cost = routing_cost(samples, calibrate(samples, target_precision=1.0))
+    assert cost["llm_calls"] == 1
+    assert cost["llm_call_rate"] == pytest.approx(0.25)
+    assert cost["kept_errors"] == 0
+    assert cost["kept_accuracy"] == 1.0
+
+
+def test_route_uses_the_thresholds_of_prototype_answers():
+    response = {
+        "categories": [{"category": "RSA"}, {"category": "SHA"}],
+        "distances": [0.1, 0.3],
+        "votes": {"RSA": 0.75, "SHA": 0.25},
+    }
+    thresholds = {"RSA": 0.9, "prototypes:RSA": 0.5}
+    assert route(response, thresholds).escalate
+    decision = route({**response, "prototypes": True}, thresholds)
+    assert decision.category == "RSA"
+    assert not decision.escalate
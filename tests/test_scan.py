@@ -0,0 +1,58 @@
+import os
+import shutil
+import pytest
+from cascade import Category
+from conftest import ROOT
+from ingest import labeled_tree
+from manifest import ScanManifest
+from run import scan_items, verdict_version
+
+
+EXAMPLES = os.path.join(ROOT, "examples")
+
+
+@pytest.fixture
+def llm_requests(fake_ollama):
+    before = fake_ollama.snapshot().get("/api/generate", 0)
+    return lambda: fake_ollama.snapshot().get("/api/generate", 0) - before
+
+
+def test_scan_labels_the_examples(references, llm_requests):
+    expected = dict(labeled_tree(EXAMPLES))
+    items = list(scan_items(EXAMPLES))
+    assert sorted(item.path for item in items) == sorted(expected)
+    assert all(item.error is None for item in items)
+    assert {item.category for item in items} <= {category.value for category in Category}
+    # The cheap stages label some files, the LLM adjudicates others
+    stages = {item.stage for item in items}
+    assert {"signatures", "prefilter"} <= stages
+    escalated = [item for item in items if item.stage.startswith("llm:")]
+    assert escalated and llm_requests() >= len(escalated)
+    right = sum(item.category == expected[item.path] for item in items)
+    assert right / len(items) >= 0.9
+
+
+def test_manifest_skips_unchanged_files(references, llm_requests, tmp_path):
+    paths = [os.path.join(EXAMPLES, "RSA", "RSA.js"), os.path.join(EXAMPLES, "SHA", "SHA256.c")]
+    manifest = ScanManifest(str(tmp_path / "manifest.sqlite"), verdict_version())
+    first = {item.path: item for item in scan_items(EXAMPLES, manifest=manifest, paths=paths)}
+    requests = llm_requests()
+    second = {item.path: item for item in scan_items(EXAMPLES, manifest=manifest, paths=paths)}
+    assert {item.stage for item in second.values()} == {"manifest"}
+    assert {path: item.category for path, item in second.items()} == {path: item.category for path, item in first.items()}
+    assert llm_requests() == requests
+
+
+def test_near_duplicate_takes_the_verdict_of_its_original(references, llm_requests, tmp_path):
+    original = os.path.join(EXAMPLES, "ELIPTIC_CURVES", "ElipticCurves.rb")
+    [item] = scan_items(EXAMPLES, paths=[original])
+    assert item.stage not in ("signatures", "prefilter")
+    copy = str(tmp_path / "curves.rb")
+    shutil.copyfile(original, copy)
+    with open(copy, "a") as f:
+        f.write("\n# Vendored copy\n")
+    requests = llm_requests()
+    [duplicate] = scan_items(str(tmp_path), paths=[copy])
+    assert duplicate.stage == "neardup"
+    assert duplicate.category == item.category
+    assert llm_requests() == requests
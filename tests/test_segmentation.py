@@ -0,0 +1,50 @@
+import sys
+import segmentation
+from chunking import chunk_text
+from segmentation import line_runs, segment_file
+
+
+CODE = """import hashlib
+
+
+def digest(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def check(data, expected):
+    return digest(data) == expected
+
+
+ROUNDS = 10
+"""
+
+
+def test_functions_are_segmented_apart():
+    chunks = segment_file("digest.py", CODE)
+    assert [chunk.name for chunk in chunks] == ["", "digest", "check"]
+    assert [(chunk.start_line, chunk.end_line) for chunk in chunks[1:]] == [(4, 5), (8, 9)]
+
+
+def test_module_lines_are_reported_as_runs():
+    module = segment_file("digest.py", CODE)[0]
+    assert module.line_runs == [(1, 1), (12, 12)]
+
+
+def test_line_runs_trim_blank_lines():
+    lines = ["a", "", "b", "", "", "c"]
+    assert line_runs([1, 2, 3, 5, 6], lines) == [(1, 3), (6, 6)]
+
+
+def test_chunked_as_text_without_a_parser(monkeypatch):
+    monkeypatch.setattr(segmentation, "_parser", lambda language: None)
+    chunks = segment_file("digest.py", CODE)
+    assert [(chunk.text, chunk.start_line, chunk.end_line) for chunk in chunks] == [
+        (chunk.text, chunk.start_line, chunk.end_line) for chunk in chunk_text(CODE)
+    ]
+
+
+def test_no_parser_without_the_grammar_packages(monkeypatch):
+    # None in sys.modules makes the import fail as if it were not installed
+    monkeypatch.setitem(sys.modules, "tree_sitter_language_pack", None)
+    monkeypatch.setitem(sys.modules, "tree_sitter_python", None)
+    assert segmentation._parser.__wrapped__("python") is None
@@ -1,28 +1,121 @@
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
-from chromadb.utils import embedding_functions
+from typing import Dict, List, Optional, Tuple
+import hashlib
+import os
+import re
 from ollama import Client, Options
-import chromadb
+from config import (
+    EMBEDDING_BACKEND,
+    EMBEDDING_BATCH_SIZE,
+    EMBEDDING_CACHE_DIR,
+    EMBEDDING_CACHE_MAX_ENTRIES,
+    EMBEDDING_CONCURRENCY,
+    EMBEDDING_MODEL,
+    NPINDEX_DIR,
+    OLLAMA_HOST,
+    VECTOR_BACKEND,
+)
+from embedding_cache import EmbeddingCache
+import metrics
+import prototypes
+from segmentation import segment_file
 
+# chromadb takes about a second to import, which the numpy backend skips;
+# Chroma only needs embedding functions to be callables then
+if VECTOR_BACKEND == "chroma":
+    from chromadb import EmbeddingFunction
+else:
+    EmbeddingFunction = object
 
 options = Options(
     temperature=0.0
 )
-client = Client(host="http://localhost:11434")
+client = Client(host=OLLAMA_HOST)
+embedding_cache = EmbeddingCache(EMBEDDING_CACHE_DIR, EMBEDDING_CACHE_MAX_ENTRIES) if EMBEDDING_CACHE_DIR else None
 
 
-class OllamaEmbedding(chromadb.EmbeddingFunction):
-    def __call__(self, input: chromadb.Documents) -> chromadb.Embeddings:
-        embeddings = []
-        for doc in input:
+def content_hash(code: str) -> str:
+    # Line endings are normalized so that a checkout with CRLF endings maps to
+    # the same document id and cache entry as the original file.
+    return hashlib.sha256(code.replace("\r\n", "\n").encode()).hexdigest()
+
+
+class OllamaEmbedding(EmbeddingFunction):
+    def __init__(
+        self,
+        model: str = EMBEDDING_MODEL,
+        batch_size: int = EMBEDDING_BATCH_SIZE,
+        concurrency: int = EMBEDDING_CONCURRENCY,
+        cache: Optional[EmbeddingCache] = embedding_cache
+    ):
+        self.model = model
+        self.batch_size = max(1, batch_size)
+        self.concurrency = max(1, concurrency)
+        self.cache = cache
+        # The two endpoints return differently scaled vectors for the same text
+        self._cache_namespace = model if self.batch_size > 1 else f"{model}:embeddings"
+        self._executor = None
+
+    def _embed_one(self, doc: str) -> List[float]:
+        metrics.EMBEDDING_REQUESTS.labels("embeddings").inc()
+        with metrics.EMBEDDING_REQUEST_SECONDS.labels("embeddings").time():
             response = client.embeddings(
-                model="nomic-embed-text",
+                model=self.model,
                 prompt=doc,
                 options=options
             )
-            embedding = response.get("embedding", None)
-            if embedding is None:
-                raise ValueError("Could not get embedding")
-            embeddings.append(embedding)
+        embedding = response.get("embedding", None)
+        if embedding is None:
+            raise ValueError("Could not get embedding")
+        return embedding
+
+    def _embed_batch(self, batch: List[str]) -> List[List[float]]:
+        if self.batch_size == 1:
+            return [self._embed_one(doc) for doc in batch]
+        metrics.EMBEDDING_REQUESTS.labels("embed").inc()
+        with metrics.EMBEDDING_REQUEST_SECONDS.labels("embed").time():
+            response = client.embed(
+                model=self.model,
+                input=batch,
+                options=options
+            )
+        embeddings = response.get("embeddings", None)
+        if embeddings is None or len(embeddings) != len(batch):
+            raise ValueError("Could not get embedding")
+        return embeddings
+
+    def __call__(self, input: List[str]) -> List[List[float]]:
+        docs = list(input)
+        if self.cache is None:
+            return self._embed(docs)
+
+        keys = [content_hash(doc) for doc in docs]
+        cached = self.cache.get_many(self._cache_namespace, keys)
+        metrics.EMBEDDING_CACHE.labels("hit").inc(len(cached))
+        metrics.EMBEDDING_CACHE.labels("miss").inc(len(keys) - len(cached))
+        missing = {}
+        for key, doc in zip(keys, docs):
+            if key not in cached:
+                missing.setdefault(key, doc)
+        if missing:
+            embeddings = self._embed(list(missing.values()))
+            self.cache.put_many(self._cache_namespace, list(missing), embeddings)
+            cached.update(zip(missing, embeddings))
+        return [cached[key] for key in keys]
+
+    def _embed(self, docs: List[str]) -> List[List[float]]:
+        batches = [docs[i:i + self.batch_size] for i in range(0, len(docs), self.batch_size)]
+        if len(batches) <= 1 or self.concurrency == 1:
+            results = map(self._embed_batch, batches)
+        else:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.concurrency)
+            # map() keeps the input order no matter which request finishes first
+            results = self._executor.map(self._embed_batch, batches)
+        embeddings = []
+        for batch_embeddings in results:
+            embeddings.extend(batch_embeddings)
         return embeddings
 
 
@@ -47,20 +140,89 @@ class Category(Enum):
     PASSWORD_BCRYPT = "PASSWORD_BCRYPT"
 
 
-chroma_client = chromadb.PersistentClient('chroma.db')
-collection = chroma_client.get_or_create_collection("CodeSamples", embedding_function=OllamaEmbedding())
+def make_embedding_function(backend: str = EMBEDDING_BACKEND) -> EmbeddingFunction:
+    if backend == "ollama":
+        return OllamaEmbedding()
+    if backend == "hashing":
+        from hashing_embedding import HashingEmbedding
+        return HashingEmbedding()
+    raise ValueError(f"Unknown embedding backend {backend}")
+
+
+def collection_name(backend: str = EMBEDDING_BACKEND) -> str:
+    # Vectors from different backends are not comparable, so each backend
+    # keeps its own reference collection.
+    if backend == "ollama":
+        return "CodeSamples"
+    return f"CodeSamples_{backend}"
+
+
+def documents_for_file(file_path: str, code: str, category: str) -> Tuple[List[str], List[Dict], List[str]]:
+    # Reference files are indexed as function/class level units, each one
+    # keeping the id of the whole file so that hits can be traced back to it.
+    sha256 = content_hash(code)
+    segments = segment_file(file_path, code)
+    ids = [sha256] if len(segments) == 1 else [f"{sha256}:{i}" for i in range(len(segments))]
+    metadatas = [
+        {
+            "category": category,
+            "sha256": sha256,
+            "path": file_path,
+            "name": segment.name,
+            "start_line": segment.start_line,
+            "end_line": segment.end_line
+        }
+        for segment in segments
+    ]
+    return ids, metadatas, [segment.text for segment in segments]
+
+
+# Ids of references: the content hash of their file, with ":<segment>" when
+# the file has several
+REFERENCE_ID_REGEX = re.compile(r"[0-9a-f]{64}(?::\d+)?")
+
+
+def reference_of(id: str, metadata: Optional[Dict]) -> Optional[str]:
+    # Content hash of the file a reference was taken from: its sha256
+    # metadata or, for references indexed before that was recorded, its id.
+    # None when neither tells.
+    sha256 = (metadata or {}).get("sha256")
+    if sha256:
+        return sha256
+    return id.split(":", 1)[0] if REFERENCE_ID_REGEX.fullmatch(id) else None
+
+
+def open_collection(backend: str = VECTOR_BACKEND):
+    if backend == "numpy":
+        from npindex import NumpyIndex
+        return NumpyIndex(os.path.join(NPINDEX_DIR, collection_name()), embedding_function)
+    if backend == "chroma":
+        import chromadb
+        chroma_client = chromadb.PersistentClient('chroma.db')
+        return chroma_client.get_or_create_collection(
+            collection_name(),
+            embedding_function=embedding_function
+        )
+    raise ValueError(f"Unknown vector backend {backend}")
+
+
+embedding_function = make_embedding_function()
+collection = open_collection()
+
+
+def upsert_references(ids: List[str], metadatas: List[Dict], documents: List[str]):
+    # Adds or replaces reference documents, keeping the category prototypes
+    # of the collection up to date
+    embeddings = embedding_function(documents)
+    prototypes.upsert(collection, collection_name(), ids, metadatas, documents, embeddings)
+
 
 if __name__ == '__main__':
     import sys
-    import hashlib
     file_path = sys.argv[1]
     category = sys.argv[2]
 
     with open(file_path) as f:
         code = f.read()
-        sha256 = hashlib.sha256(code.encode()).hexdigest()
-        collection.upsert(
-            ids=[sha256],
-            metadatas=[{"category": category}],
-            documents=[code]
-        )
+    ids, metadatas, documents = documents_for_file(file_path, code, category)
+    upsert_references(ids, metadatas, documents)
@@ -1,3 +1,12 @@
+import requests
+from ollama import Options
+from config import VULN_CHECKER_MODEL
+from llm_client import shared_client
+
+
+options = Options(temperature=0.0)
+
+
 class VulnerabilityChecker:
     @staticmethod
     def ecosystem_for_language(language: str) -> str:
@@ -26,7 +35,11 @@ class VulnerabilityChecker:
         self.vulnerabilities = response.json().get("vulns", [])
 
     def vulns_for_algorithm(self, algorithm: str):
+        # The questions for every vulnerability are sent at once and answered
+        # concurrently by the shared LLM client; results keep the OSV order.
         vuln_details_url = "https://api.osv.dev/v1/vulns"
+        client = shared_client()
+        pending = []
         for vuln in self.vulnerabilities:
             vuln_id = vuln.get("id")
             response = requests.get(f"{vuln_details_url}/{vuln_id}")
@@ -46,8 +59,11 @@ class VulnerabilityChecker:
             Does the vulnerability affect the algorithm {algorithm}?
             Output a single word and only a single word: 'yes' or 'no'.
             """
-            client = Client(host="http://localhost:11434")
-            llm_response = client.generate(model="codellama:7b", prompt=llm_prompt, options=options)
+            future = client.submit("generate", model=VULN_CHECKER_MODEL, prompt=llm_prompt, options=options)
+            pending.append((vuln_details, future))
+
+        for vuln_details, future in pending:
+            llm_response = future.result()
             answer = llm_response.get("response")
 
             print(f"Answer: {answer.strip()}")